@@ -0,0 +1,170 @@
+# Vectorized allocation engine (optional, requires NumPy).
+#
+# The greedy loops of power_regulation walk the equipments one by one and may send a command for each of them. This
+# engine gathers the state of the whole fleet (current power, bounds, minimum power, readiness, forced and auto flags)
+# into arrays, computes the full target vector with prefix sums, and then only changes (and publishes) the equipments
+# which target differs from their current power.
+#
+# Priority semantics are the ones of the greedy loops:
+# - decrease: from the lowest priority, equipments are turned down until the excess power is cancelled. A variable
+#   equipment which would end below its minimum power is turned off, a constant one is always turned off entirely.
+# - increase: from the highest priority, the available power is given to each equipment up to its maximum power. An
+#   equipment which can't take its minimum power (MINIMUM_POWER for variable equipments, nominal_power for constant
+#   ones) with what is left is skipped and the power is offered to the next ones.
+# - an UnknownPowerEquipment stops the allocation ("wait for the next measurement"), as in the greedy loops.
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is only required by this engine
+    np = None
+
+from debug import debug as debug
+from equipment import (ConstantPowerEquipment, TempDrivenVariablePowerEquipment, UnknownPowerEquipment,
+                       VariablePowerEquipment)
+
+KIND_VARIABLE = 0
+KIND_CONSTANT = 1
+KIND_UNKNOWN = 2
+
+
+class VectorAllocator:
+    def __init__(self):
+        if np is None:
+            raise ImportError("the numpy allocation engine requires numpy (pip install numpy)")
+        self._fleet = None
+
+    def _static(self, equipments):
+        # arrays which only depend on the list of equipments, computed once per list
+        if self._fleet is not equipments:
+            kinds = []
+            bounds = []
+            minimums = []
+            for e in equipments:
+                if isinstance(e, (VariablePowerEquipment, TempDrivenVariablePowerEquipment)):
+                    kinds.append(KIND_VARIABLE)
+                    bounds.append(e.max_power)
+                    minimums.append(e.MINIMUM_POWER)
+                elif isinstance(e, ConstantPowerEquipment):
+                    kinds.append(KIND_CONSTANT)
+                    bounds.append(e.nominal_power)
+                    minimums.append(e.nominal_power)
+                else:
+                    kinds.append(KIND_UNKNOWN)
+                    bounds.append(0)
+                    minimums.append(0)
+            self._kind = np.array(kinds, dtype=np.int8)
+            self._bound = np.array(bounds, dtype=float)
+            self._minimum = np.array(minimums, dtype=float)
+            self._fleet = equipments
+        return self._kind, self._bound, self._minimum
+
+    @staticmethod
+    def _current(equipments):
+        return np.fromiter(((e.get_current_power() or 0) for e in equipments), dtype=float, count=len(equipments))
+
+    @staticmethod
+    def _apply(equipments, current, target, indexes):
+        changed = 0
+        for i in indexes:
+            e = equipments[i]
+            if isinstance(e, UnknownPowerEquipment):
+                continue
+            e.set_current_power(float(target[i]))
+            debug(4, "changing power of {} from {}W to {}W".format(e.name, current[i], target[i]))
+            changed += 1
+        return changed
+
+    def decrease(self, equipments, excess_power, off_peak):
+        """ Return the number of equipments which power changed """
+        kind, bound, minimum = self._static(equipments)
+        # forced (during off-peak hours) and manual equipments are not touched
+        usable = np.fromiter((not (e.needToBeForced() and off_peak) and e.isAutoMode() for e in equipments),
+                             dtype=bool, count=len(equipments))
+        current = self._current(equipments)
+
+        # lowest priority first
+        order = np.flatnonzero(usable)[::-1]
+        cancelled = np.cumsum(current[order])
+        # the equipments before "last" are turned off entirely, "last" is the one which cancels the remaining power
+        last = int(np.searchsorted(cancelled, excess_power, side='left'))
+        target = current.copy()
+
+        unknown_on = np.flatnonzero((kind[order] == KIND_UNKNOWN) & np.fromiter(
+            (equipments[i].is_on for i in order), dtype=bool, count=len(order)))
+        if len(unknown_on) and unknown_on[0] <= last:
+            # an unknown equipment is reached: it's turned off and we wait for the next measurement
+            u = unknown_on[0]
+            target[order[:u]] = 0
+            equipments[order[u]].decrease_power_by(excess_power - (cancelled[u - 1] if u else 0))
+        else:
+            target[order[:last]] = 0
+            if last < len(order):
+                i = order[last]
+                left = excess_power - (cancelled[last - 1] if last else 0)
+                if kind[i] == KIND_VARIABLE and current[i] - left >= minimum[i]:
+                    target[i] = current[i] - left
+                else:
+                    target[i] = 0
+
+        changed = np.flatnonzero(target != current)
+        debug(2, "decreasing power of {} equipments".format(len(changed)))
+        return self._apply(equipments, current, target, changed)
+
+    def increase(self, equipments, available_power, off_peak):
+        """ Return the number of equipments which power changed """
+        kind, bound, minimum = self._static(equipments)
+        # same checks as the greedy loop, isReady() may turn an equipment off so the powers are read afterwards
+        usable = np.fromiter((not (e.needToBeForced() and off_peak) and not e.isReady() and e.isAutoMode()
+                              for e in equipments), dtype=bool, count=len(equipments))
+        current = self._current(equipments)
+
+        # highest priority first, an unknown equipment which is off stops the allocation
+        order = np.flatnonzero(usable)
+        stop = None
+        unknown_off = (kind[order] == KIND_UNKNOWN) & ~np.fromiter(
+            (equipments[i].is_on for i in order), dtype=bool, count=len(order))
+        if unknown_off.any():
+            u = int(np.argmax(unknown_off))
+            stop = order[u]
+            order = order[:u]
+
+        # power each equipment can take: headroom of variable equipments, nominal power of constant ones which are
+        # off, and the minimum amount needed to switch on an equipment which is off
+        cur = current[order]
+        k = kind[order]
+        demand = np.where(k == KIND_VARIABLE, np.maximum(bound[order] - cur, 0),
+                          np.where((k == KIND_CONSTANT) & (cur == 0), bound[order], 0))
+        needed = np.where(k == KIND_VARIABLE, np.clip(minimum[order] - cur, 0, demand), demand)
+
+        take = np.zeros(len(order))
+        remaining = available_power
+        p = 0
+        while p < len(order) and remaining > 0:
+            # equipments which can take something with the remaining power. This set only shrinks when the remaining
+            # power decreases, so all of them are served entirely up to the first cumulative overflow
+            can = (demand[p:] > 0) & (needed[p:] <= remaining)
+            served = np.cumsum(np.where(can, demand[p:], 0))
+            over = int(np.searchsorted(served, remaining, side='right'))
+            full = np.flatnonzero(can[:over]) + p
+            take[full] = demand[full]
+            if over >= len(served):
+                remaining -= served[-1]
+                break
+            remaining -= served[over - 1] if over else 0
+            # the overflowing equipment takes what is left if it is variable and if this reaches its minimum power,
+            # otherwise it is skipped
+            i = p + over
+            if k[i] == KIND_VARIABLE and needed[i] <= remaining:
+                take[i] = remaining
+                remaining = 0
+            p = i + 1
+
+        target = current.copy()
+        target[order] = cur + take
+        if stop is not None and remaining > 0:
+            # the unknown equipment is reached: it's turned on and we wait for the next measurement
+            equipments[stop].increase_power_by(remaining)
+
+        changed = np.flatnonzero(target != current)
+        debug(2, "increasing power of {} equipments".format(len(changed)))
+        return self._apply(equipments, current, target, changed)
@@ -0,0 +1,241 @@
+# asyncio engine of the power regulation (REGULATION_ENGINE=asyncio).
+#
+# The default engine uses paho's blocking network loop, a thread for the InfluxDB writer, a thread per regulation
+# worker and a timer thread per periodic task. This engine runs all of them as non-blocking tasks of a single asyncio
+# event loop:
+# - MQTT: the paho client socket is watched by the event loop (add_reader/add_writer), messages are received and
+#   commands published without any network thread
+# - InfluxDB: batches are sent by a task, with aiohttp when it's installed (one HTTP session reused for every
+#   request), otherwise by the InfluxDB client in the default executor so that the loop never waits on the database
+# - the evaluations, the command publisher ticks and the energy resets of the equipments are timers of the loop
+#   (clock.LoopClock, regulation_worker.LoopRegulationWorker)
+# Since everything runs in the loop thread, the handlers, actions and evaluations never run concurrently.
+
+import asyncio
+import functools
+import signal
+import time
+
+import paho.mqtt.client as mqtt
+
+import clock
+from checkpoint import Checkpointer, load_checkpoint
+import equipment
+import power_regulation
+from config import (INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_USERNAME, INFLUXDB_PASSWORD, INFLUXDB_DATABASE,
+                    MEASUREMENT_BATCH_SIZE, MEASUREMENT_FLUSH_INTERVAL, MEASUREMENT_QUEUE_SIZE, SITES_CONFIG,
+                    SPOOL_RETRY_INTERVAL, CHECKPOINT_FILE, CHECKPOINT_INTERVAL, EQUIPMENT_CONFIG_RELOAD_INTERVAL)
+from debug import debug as debug
+from measurement_writer import MeasurementWriter, split_by_retention
+from regulation_worker import LoopRegulationWorker
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - aiohttp is optional, the InfluxDB client is used in an executor instead
+    aiohttp = None
+
+
+class AsyncioMqttHelper:
+    """ Drive the network I/O of a paho client from an asyncio event loop """
+
+    def __init__(self, loop, client, reconnect_delay=5):
+        self.loop = loop
+        self.client = client
+        self.reconnect_delay = reconnect_delay
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self._misc is None:
+            self._misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # keepalive pings and retries, and reconnection when the broker went away
+        while True:
+            if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                debug(0, "MQTT connection lost, reconnecting in {}s".format(self.reconnect_delay))
+                await asyncio.sleep(self.reconnect_delay)
+                try:
+                    self.client.reconnect()
+                except OSError as e:
+                    debug(0, "MQTT reconnection failed: {}".format(e))
+                continue
+            await asyncio.sleep(1)
+
+
+class AsyncMeasurementWriter(MeasurementWriter):
+    """ MeasurementWriter which batches are sent by a task of the event loop """
+
+    def __init__(self, client, batch_size=500, flush_interval=2.0, max_queue=10000, spool=None, retry_interval=30.0,
+                 prepare=None, url=None, params=None, auth=None):
+        MeasurementWriter.__init__(self, client, batch_size, flush_interval, max_queue, spool, retry_interval, prepare)
+        self.url = url
+        self.params = params or {}
+        self.auth = auth
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._session = None
+
+    def write(self, point):
+        MeasurementWriter.write(self, point)
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self, loop=None):
+        if self._task is not None:
+            return
+        self._loop = loop or asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        if aiohttp is not None and self.url is not None:
+            self._session = aiohttp.ClientSession(auth=self.auth)
+        self._task = self._loop.create_task(self._run_async())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            self._loop.create_task(self._session.close())
+            self._session = None
+
+    async def _run_async(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_async()
+
+    async def _send(self, batch):
+        if not self._prepared:
+            await self._loop.run_in_executor(None, self.prepare)
+            self._prepared = True
+        for retention_policy, points in split_by_retention(batch):
+            if self._session is not None:
+                from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+                from influxdb.line_protocol import make_lines
+                data = make_lines({'points': points}, precision='ms').encode()
+                params = dict(self.params, rp=retention_policy) if retention_policy else self.params
+                async with self._session.post(self.url, params=params, data=data) as response:
+                    if 400 <= response.status < 500:
+                        # rejected points, see measurement_writer.is_rejected()
+                        raise InfluxDBClientError(await response.text(), response.status)
+                    if response.status >= 300:
+                        raise InfluxDBServerError("HTTP {}: {}".format(response.status, await response.text()))
+            else:
+                await self._loop.run_in_executor(None, functools.partial(self.client.write_points, points,
+                                                                         time_precision='ms',
+                                                                         retention_policy=retention_policy))
+
+    async def flush_async(self):
+        """ Send every queued point, batch by batch. Return the number of points written """
+        written = 0
+        batch = self._take_batch()
+        while batch:
+            if self.spool is not None and self._offline():
+                self.spool.append(batch)
+                batch = self._take_batch()
+                continue
+            start = time.monotonic()
+            try:
+                await self._send(batch)
+            except Exception as e:
+                self._failed(batch, e)
+            else:
+                written += len(batch)
+                self.points_written += len(batch)
+            self._batch_sent(batch, start)
+            batch = self._take_batch()
+        if self.spool is not None and self.spool.pending():
+            # the spool files are read and sent in bulk by the InfluxDB client, out of the loop
+            await self._loop.run_in_executor(None, self.drain_spool)
+        return written
+
+
+def setup_sites(loop, mqtt_client, measurement_writer, sites_config=None):
+    """ Load the sites with their workers and timers in the event loop, return their regulators and checkpointer """
+    clock.set_clock(clock.LoopClock(loop))
+    sites = power_regulation.load_sites(measurement_writer, sites_config)
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    for r in sites:
+        # evaluations are scheduled in the loop instead of a worker thread
+        r.regulation_worker = LoopRegulationWorker(r.evaluate, power_regulation.EVALUATION_PERIOD, loop)
+        r.load_equipments(mqtt_client, checkpoint)
+    power_regulation.route_sites(sites)
+    if EQUIPMENT_CONFIG_RELOAD_INTERVAL:
+        for r in sites:
+            r.watch_equipment_config(EQUIPMENT_CONFIG_RELOAD_INTERVAL, lambda: power_regulation.route_sites(sites))
+    checkpointer = None
+    if CHECKPOINT_FILE:
+        checkpointer = Checkpointer(CHECKPOINT_FILE, sites, CHECKPOINT_INTERVAL)
+        checkpointer.start()
+    return sites, checkpointer
+
+
+async def run():
+    from influxdb import InfluxDBClient
+    from config import (MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE, MQTT_USERNAME, MQTT_PASSWORD)
+
+    loop = asyncio.get_running_loop()
+
+    client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME,
+                            password=INFLUXDB_PASSWORD, database=INFLUXDB_DATABASE)
+    auth = None
+    if aiohttp is not None and INFLUXDB_USERNAME:
+        auth = aiohttp.BasicAuth(INFLUXDB_USERNAME, INFLUXDB_PASSWORD)
+    measurement_writer = AsyncMeasurementWriter(client, batch_size=MEASUREMENT_BATCH_SIZE,
+                                                flush_interval=MEASUREMENT_FLUSH_INTERVAL,
+                                                max_queue=MEASUREMENT_QUEUE_SIZE,
+                                                spool=power_regulation.open_spool('power_regulation'),
+                                                retry_interval=SPOOL_RETRY_INTERVAL,
+                                                prepare=functools.partial(power_regulation.connect_database, client),
+                                                url='http://{}:{}/write'.format(INFLUXDB_HOST, INFLUXDB_PORT),
+                                                params={'db': INFLUXDB_DATABASE, 'precision': 'ms'}, auth=auth)
+
+    mqtt_client = mqtt.Client()
+    mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    mqtt_client.on_connect = power_regulation.on_connect
+    mqtt_client.on_message = power_regulation.on_message
+    AsyncioMqttHelper(loop, mqtt_client)
+    mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE)
+
+    measurement_writer.start(loop)
+    equipment.setup(mqtt_client, not power_regulation.SIMULATION)
+    sites, checkpointer = setup_sites(loop, mqtt_client, measurement_writer, SITES_CONFIG)
+    for r in sites:
+        r.start()
+
+    # runs until interrupted or terminated (systemd stop)
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        # last save, the next start resumes from the current state
+        for r in sites:
+            r.regulation_worker.stop()
+        if checkpointer is not None:
+            checkpointer.stop()
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
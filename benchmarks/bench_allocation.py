@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Benchmark of the allocation engines: the greedy loops of power_regulation compared with the vectorized NumPy
+# engine (allocation.VectorAllocator), on synthetic fleets of hundreds of equipments. For each fleet and scenario,
+# the latency of one allocation, the number of commands published and whether both engines reach the same powers
+# are reported.
+#
+# Usage: python benchmarks/bench_allocation.py [--sizes 100,300,1000] [--iterations N]
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from allocation import VectorAllocator  # noqa: E402
+from bench_evaluate import apply_state, initial_state, setup  # noqa: E402
+from debug import logger  # noqa: E402
+
+
+def run(reg, engine, mode, power, state, iterations):
+    fleet = reg.equipments
+    latencies = []
+    mqtt = reg.mqtt_client
+    commands = 0
+    for _ in range(iterations):
+        apply_state(fleet, state)
+        before = mqtt.publish_count()
+        start = time.perf_counter()
+        engine(fleet, mode, power)
+        latencies.append(time.perf_counter() - start)
+        commands = mqtt.publish_count() - before
+    return statistics.median(latencies) * 1000, commands, [e.get_current_power() for e in fleet]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Greedy vs NumPy allocation engines')
+    parser.add_argument('--sizes', default='100,300,1000')
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    allocator = VectorAllocator()
+
+    def vector(equipments, mode, power):
+        if mode == 'increase':
+            allocator.increase(equipments, power, False)
+        else:
+            allocator.decrease(equipments, power, False)
+
+    print("{:<18} {:>12} {:>12} {:>9} {:>16} {:>10}".format('fleet/scenario', 'greedy ms', 'numpy ms', 'speedup',
+                                                          'commands g/n', 'same'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        reg = setup(size)
+        fleet = reg.equipments
+        for e in fleet:
+            # every command of the engines is counted, without the deadband of the command publisher
+            e.publisher = None
+
+        def greedy(equipments, mode, power):
+            if mode == 'increase':
+                reg.increase_load(power, False)
+            else:
+                reg.decrease_load(power, False)
+
+        capacity = sum(getattr(e, 'max_power', None) or e.nominal_power for e in fleet)
+        state = initial_state(fleet)
+        for mode in ('increase', 'decrease'):
+            power = capacity / 2
+            g_ms, g_cmd, g_powers = run(reg, greedy, mode, power, state, args.iterations)
+            n_ms, n_cmd, n_powers = run(reg, vector, mode, power, state, args.iterations)
+            same = all(abs(a - b) < 1e-6 for a, b in zip(g_powers, n_powers))
+            print("{:<18} {:>12.3f} {:>12.3f} {:>8.1f}x {:>16} {:>10}".format(
+                '{}/{}'.format(size, mode), g_ms, n_ms, g_ms / n_ms, '{}/{}'.format(g_cmd, n_cmd), str(same)))
+
+
+if __name__ == '__main__':
+    main()
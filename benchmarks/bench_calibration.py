@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Benchmark of the SCR calibrations (calibration.py). The default one is compared with the former per-command
+# computation (regression constants re-declared on each call and acos of the power share), and the interpolated table
+# of a measured curve with the interpolation of the measured points on each command. The best time per conversion over
+# several runs and the largest difference of each pair over the whole power range are reported.
+#
+# Usage: python benchmarks/bench_calibration.py [--samples N] [--runs N]
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calibration import default_calibration, load_calibration, measured_response  # noqa: E402
+
+
+def legacy_percent(z):
+    # copy of the code formerly in VariablePowerEquipment.set_current_power
+    a = 1156.7360635374
+    b = -2733.09296216279
+    c = 2365.91298447422
+    d = -924.443712230202
+    e = 218.242717162968
+    f = -0.010002294517421
+    g = 11.3205979917473
+
+    percent = math.acos(1 - (2 * z)) / math.pi * 100
+    return percent
+
+
+def timed(func, shares, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for z in shares:
+            func(z)
+        elapsed = (time.perf_counter() - start) / len(shares) * 1e9
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def max_difference(f, g):
+    return max(abs(f(z) - g(z)) for z in [i / 100000.0 for i in range(100001)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SCR calibrations vs per-call computation')
+    parser.add_argument('--samples', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    max_power = 2400
+    rnd = random.Random(0)
+    shares = [rnd.uniform(0, max_power) / max_power for _ in range(args.samples)]
+    points = [[0, 0], [300, 24], [500, 31], [800, 40], [1200, 52], [1600, 64], [2000, 79], [2400, 100]]
+
+    default = default_calibration()
+    measured = load_calibration(points, max_power)
+    interpolate = measured_response(points, max_power)
+
+    legacy_ns = timed(legacy_percent, shares, args.runs)
+    default_ns = timed(default.percent, shares, args.runs)
+    interpolate_ns = timed(interpolate, shares, args.runs)
+    measured_ns = timed(measured.percent, shares, args.runs)
+
+    print("legacy math                {:8.1f} ns/command".format(legacy_ns))
+    print("default                    {:8.1f} ns/command  speedup {:.2f}x  max difference {:.4f}%".format(
+        default_ns, legacy_ns / default_ns, max_difference(default.percent, legacy_percent)))
+    print("measured, per-call search  {:8.1f} ns/command".format(interpolate_ns))
+    print("measured, table            {:8.1f} ns/command  speedup {:.2f}x  max difference {:.4f}%".format(
+        measured_ns, interpolate_ns / measured_ns, max_difference(measured.percent, interpolate)))
+
+
+if __name__ == '__main__':
+    main()
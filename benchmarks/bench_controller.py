@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Convergence of the regulation controllers (controller.py) on synthetic traces, in closed loop (replay.Replay): the
+# power of the equipments is added to the household consumption before it reaches the regulation.
+# - step: the surplus jumps from 0 to 2000 W (and back to 0 ten minutes later), as on a cloud edge
+# - ramp: the surplus rises from 0 to 3000 W in 10 minutes, then falls back to 0 in 10 minutes
+# - clouds: the surplus alternates between 2500 W and 300 W every 2 minutes
+# For each controller, the settling time after the steps (until the grid power stays within the balance threshold,
+# or the equipments are saturated), the energy imported from and exported to the grid, the number of commands and
+# the number of sign changes of the correction (oscillations) are reported. With --delay, the meter reports the
+# power of the equipments as it was a few seconds earlier, the controllers should then be given a settle time above
+# this delay (--settle-time).
+#
+# Usage: python benchmarks/bench_controller.py [--delay 0] [--settle-time 2] [--controllers step,gain,pi]
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import power_regulation  # noqa: E402
+from controller import make_controller  # noqa: E402
+from debug import logger  # noqa: E402
+from replay import Replay  # noqa: E402
+
+START = 1717225200  # 2024-06-01 09:00 Paris time, out of the off-peak hours
+BASE_LOAD = 400
+
+CONFIG = """
+equipment:
+  - type: TempDrivenVariablePowerEquipment
+    id: 0
+    name: "water_heater"
+    max_power: 2400
+    temp_min: 45
+    temp_eco: 50
+    temp_sol_min: 55
+    temp_max: 70
+  - type: ConstantPowerEquipment
+    id: 1
+    name: "pool_pump"
+    nominal_power: 600
+    plug_id: 1
+"""
+
+
+def step_surplus(t):
+    return 2000 if 60 <= t < 660 else 0
+
+
+def ramp_surplus(t):
+    if t < 600:
+        return 3000 * t / 600.0
+    return max(0.0, 3000 * (1200 - t) / 600.0)
+
+
+def cloud_surplus(t):
+    return 2500 if (t // 120) % 2 == 0 else 300
+
+
+SCENARIOS = {
+    'step': (step_surplus, 1200, (60, 660)),
+    'ramp': (ramp_surplus, 1200, ()),
+    'clouds': (cloud_surplus, 1200, tuple(range(0, 1200, 120))),
+}
+
+
+class DelayedReplay(Replay):
+    """ Closed loop replay where the meter sees the equipments power of delay seconds ago """
+
+    def __init__(self, config_file, delay, controller, settle_time):
+        Replay.__init__(self, config_file, closed_loop=True)
+        self.delay = delay
+        self.settle_time = settle_time
+        self.controller = controller
+        self._loads = deque()
+        self.grid = []
+
+    def setup(self, start_ts):
+        Replay.setup(self, start_ts)
+        self.reg.controller = make_controller(self.controller, self.reg.equipments,
+                                              deadband=power_regulation.BALANCE_THRESHOLD,
+                                              settle_time=self.settle_time)
+
+    def _load_power(self):
+        now = self._last_ts
+        load = Replay._load_power(self)
+        self._loads.append((now, load))
+        while len(self._loads) > 1 and self._loads[1][0] <= now - self.delay:
+            self._loads.popleft()
+        return self._loads[0][1]
+
+    def step(self, ts, topic, payload):
+        Replay.step(self, ts, topic, payload)
+        if topic == self.reg.topic_consumed:
+            self.grid.append((ts, self._grid_power))
+
+
+def trace(surplus, duration):
+    yield START, 'scr/0/temperature', '50'
+    for i in range(duration):
+        net = BASE_LOAD - (BASE_LOAD + surplus(i))
+        yield START + i, 'tic/SINSTI', str(int(max(-net, 0)))
+        yield START + i, 'tic/SINSTS', str(int(max(net, 0)))
+
+
+def settling_times(replay, edges, saturated=2400 + 600):
+    times = []
+    threshold = power_regulation.BALANCE_THRESHOLD + power_regulation.MARGIN
+    grid = replay.grid
+    for k, edge in enumerate(edges):
+        end = edges[k + 1] if k + 1 < len(edges) else grid[-1][0] - START
+        window = [(ts - START, g) for ts, g in grid if edge <= ts - START < end]
+        settled = None
+        for i in range(len(window)):
+            # settled when the grid stays balanced, or when all the power is used (surplus above the fleet power)
+            if all(-threshold <= g <= threshold or g < -saturated + threshold for _, g in window[i:]):
+                settled = window[i][0] - edge
+                break
+        times.append(settled)
+    return times
+
+
+def oscillations(replay):
+    signs = [g > 0 for _, g in replay.grid if abs(g) > power_regulation.BALANCE_THRESHOLD]
+    return sum(1 for a, b in zip(signs, signs[1:]) if a != b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convergence of the regulation controllers')
+    parser.add_argument('--delay', type=float, default=0, help='seconds before the meter sees a load change')
+    parser.add_argument('--settle-time', type=float, default=2, help='CONTROLLER_SETTLE_TIME of the controllers')
+    parser.add_argument('--controllers', default='step,gain,pi')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as f:
+        f.write(CONFIG)
+        config_file = f.name
+
+    print("meter delay {}s, evaluation period {}s".format(args.delay, power_regulation.EVALUATION_PERIOD))
+    print("{:<8} {:<8} {:>12} {:>12} {:>12} {:>10} {:>8}".format('trace', 'ctrl', 'settling s', 'import Wh',
+                                                                 'export Wh', 'commands', 'osc'))
+    try:
+        for name, (surplus, duration, edges) in SCENARIOS.items():
+            for controller in args.controllers.split(','):
+                replay = DelayedReplay(config_file, args.delay, controller, args.settle_time)
+                result = replay.run(trace(surplus, duration))
+                times = [t for t in settling_times(replay, edges) if t is not None] if edges else []
+                settling = '{:.0f}'.format(statistics.mean(times)) if times else '-'
+                if edges and len(times) < len(edges):
+                    settling += '*'
+                print("{:<8} {:<8} {:>12} {:>12.1f} {:>12.1f} {:>10} {:>8}".format(
+                    name, controller, settling, result['grid_import_wh'], result['grid_export_wh'],
+                    result['commands'], oscillations(replay)))
+    finally:
+        os.remove(config_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of power_regulation.evaluate() on synthetic fleets of equipments.
+#
+# Fleets of 10, 100 and 1000 equipments (a mix of VariablePowerEquipment, TempDrivenVariablePowerEquipment and
+# ConstantPowerEquipment) are regulated with in-memory MQTT/InfluxDB stand-ins and a virtual clock, in three
+# scenarios: surplus (PV power in excess, the increase loop walks the fleet by priority), deficit (the decrease loop
+# walks it in reverse order) and balanced. For each one the latency of an evaluation and the memory allocated during it are measured.
+#
+# Results are compared with benchmarks/baselines/bench_evaluate.json, --save replaces the baseline and --check
+# returns an error when an evaluation became slower than the baseline by more than --tolerance.
+#
+# Usage: python benchmarks/bench_evaluate.py [--sizes 10,100,1000] [--iterations N] [--save] [--check]
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import clock  # noqa: E402
+import equipment  # noqa: E402
+import power_regulation  # noqa: E402
+from debug import logger  # noqa: E402
+from measurement_writer import MeasurementWriter  # noqa: E402
+from equipment import (ConstantPowerEquipment, TempDrivenVariablePowerEquipment,  # noqa: E402
+                       VariablePowerEquipment)
+from replay import MemoryInfluxClient, MemoryMqttClient  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'bench_evaluate.json')
+
+# noon, outside of the off-peak hours (2024-06-01 12:00 Europe/Paris)
+START_TS = 1717236000
+
+# measurements of each scenario (SINSTS, SINSTI) for a fleet of the given total power, so that the allocation loop
+# walks a large part of the fleet whatever its size. The fleet state is re-initialized before each evaluation.
+SCENARIOS = {
+    'surplus': lambda capacity: (0, 2 * capacity),
+    'deficit': lambda capacity: (2 * capacity, 0),
+    'balanced': lambda capacity: (0, power_regulation.BALANCE_THRESHOLD // 2),
+}
+
+
+def build_fleet(size, seed=0):
+    rnd = random.Random(seed)
+    fleet = []
+    for i in range(size):
+        kind = i % 3
+        if kind == 0:
+            e = VariablePowerEquipment(i, 'variable_{}'.format(i), rnd.choice([500, 1000, 2000, 3000]),
+                                       min_energy=rnd.choice([500, 2000]), period=86400)
+        elif kind == 1:
+            e = TempDrivenVariablePowerEquipment(i, 'temp_{}'.format(i), rnd.choice([1200, 2400]),
+                                                 temp_min=45, temp_eco=50, temp_sol_min=55, temp_max=60)
+            e.setCurrentTemp(rnd.uniform(46, 58))
+        else:
+            e = ConstantPowerEquipment(i, 'constant_{}'.format(i), rnd.choice([100, 300, 800, 1500]))
+        fleet.append(e)
+    return fleet
+
+
+def initial_state(fleet, seed=1):
+    # half of the equipments are on at a random power, in the same way for every evaluation
+    rnd = random.Random(seed)
+    state = []
+    for e in fleet:
+        if rnd.random() < 0.5:
+            if isinstance(e, ConstantPowerEquipment):
+                state.append(e.nominal_power)
+            else:
+                state.append(rnd.uniform(VariablePowerEquipment.MINIMUM_POWER, e.max_power))
+        else:
+            state.append(0)
+    return state
+
+
+def apply_state(fleet, state):
+    for e, p in zip(fleet, state):
+        e.current_power = p
+        e.is_on = p > 0
+        e.is_ready = False
+
+
+def setup(size):
+    """ Return a regulator of a synthetic fleet of the given size """
+    mqtt = MemoryMqttClient()
+    clock.set_clock(clock.VirtualClock(START_TS))
+    equipment.setup(mqtt, True)
+    reg = power_regulation.Regulator(MeasurementWriter(MemoryInfluxClient()))
+    fleet = build_fleet(size)
+    for e in fleet:
+        e.set_current_power(0)
+    reg.setup(mqtt, fleet)
+    return reg
+
+
+def run_scenario(reg, scenario, iterations):
+    fleet = reg.equipments
+    capacity = sum(getattr(e, 'max_power', None) or e.nominal_power for e in fleet)
+    consumed, injected = SCENARIOS[scenario](capacity)
+    state = initial_state(fleet)
+    pr = power_regulation
+    latencies = []
+    peaks = []
+    for i in range(iterations):
+        apply_state(fleet, state)
+        reg.power_consumed_tot = consumed
+        reg.power_available = injected
+        reg.power_reactive = 0
+        clock.get_clock().advance_to(clock.now() + pr.EVALUATION_PERIOD)
+
+        trace = i % 4 == 3
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        reg.evaluate()
+        elapsed = time.perf_counter() - start
+        if trace:
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        else:
+            latencies.append(elapsed)
+        reg.measurement_writer.flush()
+
+    latencies.sort()
+    return {
+        'median_ms': round(statistics.median(latencies) * 1000, 3),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+        'peak_alloc_kb': round(max(peaks) / 1024, 1) if peaks else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of evaluate() on synthetic fleets')
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--iterations', type=int, default=40)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='exit with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print("{:<16} {:>10} {:>10} {:>12} {:>10}".format('fleet/scenario', 'median ms', 'p95 ms', 'peak alloc kB',
+                                                      'baseline'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        reg = setup(size)
+        for scenario in SCENARIOS:
+            key = '{}/{}'.format(size, scenario)
+            r = run_scenario(reg, scenario, args.iterations)
+            results[key] = r
+            ref = baseline.get(key)
+            ratio = ''
+            if ref:
+                ratio = '{:+.0%}'.format(r['median_ms'] / ref['median_ms'] - 1) if ref['median_ms'] else ''
+                if ref['median_ms'] and r['median_ms'] > ref['median_ms'] * (1 + args.tolerance):
+                    regressions.append(key)
+            print("{:<16} {:>10} {:>10} {:>12} {:>10}".format(key, r['median_ms'], r['p95_ms'], r['peak_alloc_kb'],
+                                                              ratio))
+
+    if args.save:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("baseline saved to {}".format(BASELINE))
+    if regressions:
+        print("regressions: {}".format(', '.join(regressions)))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
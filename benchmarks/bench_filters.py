@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Effect of the measurement filters (filters.py) on the switching of the loads, in closed loop (replay.Replay).
+# The synthetic trace is a steady 1500 W surplus with consumption spikes: a 2 frames spike of 2000 W (compressor
+# inrush) every 45 s and a 2 kW kettle for 4 frames every 5 minutes, over one hour. For each filter pipeline of the
+# SINSTS channel, the number of load sheds (evaluations which reduced the power of the equipments), commands, the
+# spikes rejected and the energy imported from the grid are reported.
+#
+# Usage: python benchmarks/bench_filters.py [--pipelines "none;spike:800:3;median:5;spike:800:3,median:3;ewma:0.3"]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debug import logger  # noqa: E402
+from filters import parse_pipeline  # noqa: E402
+from replay import Replay  # noqa: E402
+
+START = 1717225200  # 2024-06-01 09:00 Paris time, out of the off-peak hours
+DURATION = 3600
+SURPLUS = 1500
+
+CONFIG = """
+equipment:
+  - type: TempDrivenVariablePowerEquipment
+    id: 0
+    name: "water_heater"
+    max_power: 2400
+    temp_min: 45
+    temp_eco: 50
+    temp_sol_min: 55
+    temp_max: 70
+"""
+
+
+def household(t):
+    """ Return the consumption in excess of the PV production at t (negative: surplus) """
+    spike = 0
+    if t % 45 in (29, 30):
+        spike = 2000
+    if t % 300 in (98, 99, 100, 101):
+        spike = 2000
+    return spike - SURPLUS
+
+
+def trace():
+    yield START, 'scr/0/temperature', '50'
+    for i in range(DURATION):
+        net = household(i)
+        yield START + i, 'tic/SINSTI', str(int(max(-net, 0)))
+        yield START + i, 'tic/SINSTS', str(int(max(net, 0)))
+
+
+class CountingReplay(Replay):
+    def __init__(self, config_file, pipeline):
+        Replay.__init__(self, config_file, closed_loop=True)
+        self.pipeline = pipeline
+        self.sheds = 0
+
+    def setup(self, start_ts):
+        Replay.setup(self, start_ts)
+        self.reg.consumed_filter = parse_pipeline(self.pipeline)
+        self.reg.injected_filter = parse_pipeline(self.pipeline)
+
+    def _deliver(self, topic, payload):
+        before = self._load_power()
+        Replay._deliver(self, topic, payload)
+        if self._load_power() < before:
+            self.sheds += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load switching with and without measurement filters')
+    parser.add_argument('--pipelines', default='none;spike:800:3;median:5;spike:800:3,median:3;ewma:0.3')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as f:
+        f.write(CONFIG)
+        config_file = f.name
+
+    print("{:<22} {:>8} {:>10} {:>10} {:>12}".format('filters', 'sheds', 'commands', 'rejected', 'import Wh'))
+    try:
+        for pipeline in args.pipelines.split(';'):
+            spec = '' if pipeline == 'none' else pipeline
+            replay = CountingReplay(config_file, spec)
+            result = replay.run(trace())
+            print("{:<22} {:>8} {:>10} {:>10} {:>12.1f}".format(
+                pipeline, replay.sheds, result['commands'], replay.reg.consumed_filter.stats()['rejected'],
+                result['grid_import_wh']))
+    finally:
+        os.remove(config_file)
+
+
+if __name__ == '__main__':
+    main()
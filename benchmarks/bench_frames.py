@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Per-label MQTT messages (tic/SINSTI, tic/SINSTS, tic/ERQT) against one combined tic/frame message per TIC frame, in
+# closed loop (replay.Replay). The synthetic trace alternates every 20 s between a 1500 W surplus and a 600 W import
+# (clouds and a cycling load), over one hour. With per-label messages, an evaluation may run between the SINSTI and
+# the SINSTS of a frame, and see the new value of one and the previous value of the other. For each mode, the MQTT
+# messages and bytes, the evaluations, the incoherent evaluations (run on measurements of two different frames), the
+# commands and the energy imported from the grid are reported.
+#
+# Usage: python benchmarks/bench_frames.py
+
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clock  # noqa: E402
+from debug import logger  # noqa: E402
+from replay import Replay, group_frames  # noqa: E402
+
+START = 1717225200  # 2024-06-01 09:00 Paris time, out of the off-peak hours
+DURATION = 3600
+
+CONFIG = """
+equipment:
+  - type: TempDrivenVariablePowerEquipment
+    id: 0
+    name: "water_heater"
+    max_power: 2400
+    temp_min: 45
+    temp_eco: 50
+    temp_sol_min: 55
+    temp_max: 70
+"""
+
+
+def household(t):
+    """ Return the consumption in excess of the PV production at t (negative: surplus) """
+    return -1500 if (t // 20) % 2 == 0 else 600
+
+
+def trace():
+    yield START, 'scr/0/temperature', '50'
+    index = 100000
+    for i in range(DURATION):
+        net = household(i)
+        # the meter sends SINSTS before SINSTI
+        yield START + i, 'tic/SINSTS', str(int(max(net, 0)))
+        yield START + i, 'tic/SINSTI', str(int(max(-net, 0)))
+        if i % 30 == 0:
+            index += 1
+        yield START + i, 'tic/ERQT', str(index)
+
+
+class CoherenceReplay(Replay):
+    def __init__(self, config_file):
+        Replay.__init__(self, config_file, closed_loop=True)
+        self.bytes = 0
+        self.incoherent = 0
+        self._frame_ts = {}
+
+    def _deliver(self, topic, payload):
+        self.bytes += len(topic) + len(payload)
+        if topic in (self.reg.topic_consumed, self.reg.topic_injected):
+            self._frame_ts[topic] = self._last_ts
+        elif topic == self.reg.topic_frame:
+            self._frame_ts = {}
+        evaluations = self.reg.status_publisher.updates
+        Replay._deliver(self, topic, payload)
+        if self.reg.status_publisher.updates != evaluations and len(set(self._frame_ts.values())) > 1:
+            self.incoherent += 1
+
+    def step(self, ts, topic, payload):
+        reg = self.reg
+        if topic not in (reg.topic_consumed, reg.topic_injected):
+            Replay.step(self, ts, topic, payload)
+            return
+        # the closed loop of Replay delivers both directions on each per-label message, the meter only sends one
+        clock.get_clock().advance_to(ts)
+        self._integrate(ts)
+        if topic == reg.topic_consumed:
+            self.recorded_consumed = int(payload)
+        else:
+            self.recorded_injected = int(payload)
+        net = self.recorded_consumed - self.recorded_injected + self._load_power()
+        self._deliver(topic, str(int(max(net, 0) if topic == reg.topic_consumed else max(-net, 0))))
+        self._grid_power = self.recorded_consumed - self.recorded_injected + self._load_power()
+
+
+def main():
+    logger.setLevel(logging.WARNING)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as f:
+        f.write(CONFIG)
+        config_file = f.name
+
+    print("{:<8} {:>10} {:>10} {:>12} {:>12} {:>10} {:>10}".format('mode', 'messages', 'bytes', 'evaluations',
+                                                                   'incoherent', 'commands', 'import Wh'))
+    try:
+        for mode, messages in (('labels', trace()), ('frames', group_frames(trace()))):
+            replay = CoherenceReplay(config_file)
+            result = replay.run(messages)
+            print("{:<8} {:>10} {:>10} {:>12} {:>12} {:>10} {:>10.1f}".format(
+                mode, result['messages'], replay.bytes, result['evaluations'], replay.incoherent,
+                result['commands'], result['grid_import_wh']))
+    finally:
+        os.remove(config_file)
+
+
+if __name__ == '__main__':
+    main()
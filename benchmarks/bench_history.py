@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Benchmark of the in-memory history (timeseries.TimeSeriesStore): a series is filled with 24 hours of samples at one
+# per second, then the append time and the time of the window aggregates (mean, min, max over the last minute, hour
+# and day) are reported, along with the memory taken by the series. The same aggregates computed by a scan of a plain
+# list of (timestamp, value) tuples, the simplest in-process alternative, are given for reference. The same is
+# measured with the last --recent seconds only at 1 s and the older samples in 1 minute buckets (HISTORY_RECENT, the
+# regulation keeps the whole history at 1 s by default).
+#
+# Usage: python benchmarks/bench_history.py [--duration 86400] [--recent 3600] [--queries 200]
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from timeseries import TimeSeriesStore  # noqa: E402
+
+WINDOWS = (60, 3600, 86400)
+
+
+def scan_aggregates(samples, since):
+    values = [v for ts, v in samples if ts >= since]
+    return sum(values) / len(values), min(values), max(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory history appends and window aggregates')
+    parser.add_argument('--duration', type=int, default=86400, help='seconds of history, one sample per second')
+    parser.add_argument('--recent', type=int, default=3600, help='seconds kept at 1 s, 1 minute buckets beyond')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    store = TimeSeriesStore(args.duration, 1)
+    tiered = TimeSeriesStore(args.duration, 1, args.recent, 60)
+    samples = []
+    start_ts = 1700000000.0
+    # twice the duration, so that the ring has wrapped
+    values = [rnd.uniform(0, 6000) for _ in range(2 * args.duration)]
+    start = time.perf_counter()
+    for i, v in enumerate(values):
+        store.append('SINSTS', v, start_ts + i)
+    append_us = 1e6 * (time.perf_counter() - start) / len(values)
+    start = time.perf_counter()
+    for i, v in enumerate(values):
+        tiered.append('SINSTS', v, start_ts + i)
+    tiered_append_us = 1e6 * (time.perf_counter() - start) / len(values)
+    now = start_ts + len(values) - 1
+    samples = [(start_ts + i, v) for i, v in enumerate(values)][-args.duration:]
+
+    print("{} samples, {:.2f} us per append, {:.1f} MB".format(args.duration, append_us,
+                                                              store.stats()['bytes'] / 1e6))
+    print("last {}s at 1 s and 1 minute buckets: {:.2f} us per append, {:.3f} MB".format(
+        args.recent, tiered_append_us, tiered.stats()['bytes'] / 1e6))
+    print("{:<10} {:>14} {:>14} {:>16} {:>12}".format('window', 'ring ms', 'list scan ms', 'buckets ms',
+                                                      'mean error'))
+    for window in WINDOWS:
+        if window > args.duration:
+            continue
+        ring = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            for how in ('mean', 'min', 'max'):
+                store.query('SINSTS', window, how, now)
+            ring.append(time.perf_counter() - t)
+        buckets = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            for how in ('mean', 'min', 'max'):
+                tiered.query('SINSTS', window, how, now)
+            buckets.append(time.perf_counter() - t)
+        scan = []
+        for _ in range(max(1, args.queries // 10)):
+            t = time.perf_counter()
+            scan_aggregates(samples, now - window)
+            scan.append(time.perf_counter() - t)
+        error = abs(tiered.query('SINSTS', window, 'mean', now) - store.query('SINSTS', window, 'mean', now))
+        print("{:<10} {:>14.3f} {:>14.3f} {:>16.3f} {:>11.2f}W".format(
+            '{}s'.format(window), 1000 * statistics.median(ring), 1000 * statistics.median(scan),
+            1000 * statistics.median(buckets), error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Change of the equipment configuration while the regulation runs, in closed loop (replay.Replay), with a hot reload
+# (equipment_reload.py) and with a restart of the regulation without checkpoint. The synthetic trace is a steady
+# 2500 W surplus for two hours; after one hour the nominal power of the pool pump changes and a dehumidifier is added,
+# the water heater is not touched. For each mode, the energy counter of the water heater before and after the change,
+# the commands sent in the minute after the change, the energy imported from and exported to the grid in the 10
+# minutes after the change and the time spent applying the new configuration are reported.
+#
+# Usage: python benchmarks/bench_hot_reload.py
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debug import logger  # noqa: E402
+from equipment_reload import EquipmentConfigWatcher  # noqa: E402
+from replay import Replay  # noqa: E402
+
+START = 1717225200  # 2024-06-01 09:00 Paris time, out of the off-peak hours
+DURATION = 7200
+CHANGE = 3600
+SURPLUS = 2500
+
+CONFIG = """
+equipment:
+  - type: TempDrivenVariablePowerEquipment
+    id: 0
+    name: "water_heater"
+    max_power: 2000
+    temp_min: 45
+    temp_eco: 50
+    temp_sol_min: 55
+    temp_max: 70
+  - type: ConstantPowerEquipment
+    id: 1
+    name: "pool_pump"
+    nominal_power: {pump}
+    plug_id: 1
+{extra}"""
+
+DEHUMIDIFIER = """  - type: ConstantPowerEquipment
+    id: 2
+    name: "dehumidifier"
+    nominal_power: 300
+    plug_id: 2
+"""
+
+
+def trace():
+    yield START, 'scr/0/temperature', '50'
+    for i in range(DURATION):
+        yield START + i, 'tic/SINSTS', '0'
+        yield START + i, 'tic/SINSTI', str(SURPLUS)
+
+
+def write_config(path, pump, extra=''):
+    with open(path, 'w') as f:
+        f.write(CONFIG.format(pump=pump, extra=extra))
+
+
+def run(mode, path):
+    write_config(path, 600)
+    replay = Replay(path, closed_loop=True)
+    elapsed = 0.0
+    before = after = None
+    commands = 0
+    imported = exported = 0.0
+    for ts, topic, payload in trace():
+        if replay.reg is None:
+            replay.setup(ts)
+            watcher = EquipmentConfigWatcher(path, lambda entries: replay.reg.regulation_worker.submit(
+                lambda: replay.reg.reload_equipments(entries)))
+        reg = replay.reg
+        if ts == START + CHANGE and topic == 'tic/SINSTS':
+            before = reg.equipments[0].get_energy()
+            sent = reg.command_publisher.sent
+            imported, exported = replay.grid_import_wh, replay.grid_export_wh
+            write_config(path, 500, DEHUMIDIFIER)
+            # the mtime may not have moved within its resolution
+            watcher._signature = None
+            start = time.perf_counter()
+            if mode == 'reload':
+                watcher.check()
+                reg.regulation_worker.run_once()
+            else:
+                reg.load_equipments(replay.mqtt)
+            elapsed = time.perf_counter() - start
+            after = reg.equipments[0].get_energy()
+        replay.step(ts, topic, payload)
+        if ts == START + CHANGE + 60 and topic == 'tic/SINSTI':
+            commands = reg.command_publisher.sent - sent
+        if ts == START + CHANGE + 600 and topic == 'tic/SINSTI':
+            imported = replay.grid_import_wh - imported
+            exported = replay.grid_export_wh - exported
+    return before, after, commands, imported, exported, elapsed
+
+
+def main():
+    logger.setLevel(logging.WARNING)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as f:
+        path = f.name
+
+    print("{:<8} {:>22} {:>10} {:>11} {:>11} {:>10}".format('mode', 'water heater Wh', 'commands', 'import Wh',
+                                                            'export Wh', 'apply ms'))
+    try:
+        for mode in ('reload', 'restart'):
+            before, after, commands, imported, exported, elapsed = run(mode, path)
+            print("{:<8} {:>10.1f} -> {:>8.1f} {:>10} {:>11.1f} {:>11.1f} {:>10.2f}".format(
+                mode, before, after, commands, imported, exported, elapsed * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Power derived from an energy index of the meter: IndexPowerEstimator (index_estimator.py) against the thresholds
+# formerly used for the reactive power (a new power once the index moved by 5 Wh, or by 2 Wh after 60 s, 0 after
+# 120 s without 2 Wh). The synthetic trace is one frame per second of an integer index in Wh, with a power going
+# through steps (1500, 300, 80, 0, 600 W) and a slow ramp. For each estimator, the mean absolute error, the time for
+# the estimate to come within 10% (or 30 W) of each new power level and the time of one estimate are reported.
+#
+# Usage: python benchmarks/bench_index_power.py [--windows 30,60,120]
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from index_estimator import IndexPowerEstimator  # noqa: E402
+
+START = 1717225200
+LEVELS = ((0, 1500), (600, 300), (1200, 80), (1800, 0), (2400, 600))
+RAMP = (3000, 4200, 0, 1200)
+DURATION = 4800
+
+
+def power_at(t):
+    if RAMP[0] <= t < RAMP[1]:
+        return RAMP[2] + (RAMP[3] - RAMP[2]) * (t - RAMP[0]) / (RAMP[1] - RAMP[0])
+    if t >= RAMP[1]:
+        return RAMP[3]
+    level = 0
+    for edge, power in LEVELS:
+        if t >= edge:
+            level = power
+    return level
+
+
+def trace():
+    energy = 123456789.0
+    for t in range(DURATION):
+        yield START + t, int(energy), power_at(t)
+        energy += power_at(t) / 3600.0
+
+
+class LegacyEstimator:
+    """ The former thresholds of power_regulation.evaluate_power """
+
+    def __init__(self):
+        self.previous = None
+        self.power = 0.0
+
+    def add(self, ts, index):
+        if self.previous is None:
+            self.previous = (ts, index)
+            return self.power
+        delta_ts = ts - self.previous[0]
+        delta_index = index - self.previous[1]
+        if delta_index > 4 or (delta_ts > 60 and delta_index > 1):
+            self.power = float(round(delta_index / delta_ts * 3600))
+            self.previous = (ts, index)
+        elif delta_ts > 120:
+            self.power = 0.0
+            self.previous = (ts, index)
+        return self.power
+
+
+def run(estimator):
+    errors = []
+    settle = []
+    edge = None
+    start = time.perf_counter()
+    for ts, index, power in trace():
+        estimate = estimator.add(ts, index)
+        if estimate is None:
+            estimate = 0.0
+        errors.append(abs(estimate - power))
+        t = ts - START
+        if any(t == e for e, _ in LEVELS):
+            edge = t
+        if edge is not None and abs(estimate - power) <= max(0.1 * power, 30):
+            settle.append(t - edge)
+            edge = None
+    elapsed = time.perf_counter() - start
+    return {
+        'mae': statistics.mean(errors),
+        'settling': settle,
+        'us': elapsed / DURATION * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Power derived from an energy index')
+    parser.add_argument('--windows', default='30,60,120', help='windows in seconds of IndexPowerEstimator')
+    args = parser.parse_args()
+
+    estimators = [('legacy', LegacyEstimator())]
+    for window in args.windows.split(','):
+        estimators.append(('window {}s'.format(window), IndexPowerEstimator(float(window))))
+
+    levels = ' '.join('{:>5}'.format(power) for _, power in LEVELS)
+    print("{:<14} {:>8} {:>10}   settling s at {}".format('estimator', 'MAE W', 'us/frame', levels))
+    for name, estimator in estimators:
+        result = run(estimator)
+        settling = ' '.join('{:>5}'.format(t) for t in result['settling'])
+        print("{:<14} {:>8.1f} {:>10.1f}   {:>13} {}".format(name, result['mae'], result['us'], '', settling))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Benchmark of the subset selection of constant power equipments (knapsack.ConstantLoadSelector) against the one by
+# one switching of the greedy loop, on random sets of plugs of mixed nominal powers. For each number of plugs, the
+# share of the available power actually used by each method and the time of a selection are reported, the latter
+# both with the dynamic programming table already cached (the usual case between two evaluations) and without.
+#
+# Usage: python benchmarks/bench_knapsack.py [--plugs 10,30,60] [--trials N]
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import equipment  # noqa: E402
+from debug import logger  # noqa: E402
+from equipment import ConstantPowerEquipment  # noqa: E402
+from knapsack import ConstantLoadSelector  # noqa: E402
+from replay import MemoryMqttClient  # noqa: E402
+
+POWERS = [60, 100, 150, 300, 450, 600, 800, 1000, 1500, 2000]
+
+
+def greedy_used(plugs, available_power):
+    used = 0
+    for e in plugs:
+        if used + e.nominal_power <= available_power:
+            used += e.nominal_power
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Greedy vs knapsack selection of constant power equipments')
+    parser.add_argument('--plugs', default='10,30,60')
+    parser.add_argument('--trials', type=int, default=200)
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    equipment.setup(MemoryMqttClient(), True)
+    rnd = random.Random(0)
+
+    print("{:<8} {:>12} {:>12} {:>14} {:>14}".format('plugs', 'greedy use', 'knapsack use', 'cached ms',
+                                                       'build ms'))
+    for n in [int(p) for p in args.plugs.split(',')]:
+        plugs = [ConstantPowerEquipment(i, 'plug_{}'.format(i), rnd.choice(POWERS), plug_id=i) for i in range(n)]
+        total = sum(e.nominal_power for e in plugs)
+        selector = ConstantLoadSelector()
+        greedy_ratio = []
+        knapsack_ratio = []
+        cached = []
+        for _ in range(args.trials):
+            available = rnd.uniform(0.1, 0.9) * total
+            start = time.perf_counter()
+            selected = selector.select(plugs, available)
+            cached.append(time.perf_counter() - start)
+            greedy_ratio.append(greedy_used(plugs, available) / available)
+            knapsack_ratio.append(sum(e.nominal_power for e in selected) / available)
+
+        builds = []
+        for _ in range(5):
+            start = time.perf_counter()
+            ConstantLoadSelector().select(plugs, total / 2)
+            builds.append(time.perf_counter() - start)
+
+        print("{:<8} {:>11.1f}% {:>11.1f}% {:>14.3f} {:>14.3f}".format(
+            n, 100 * statistics.mean(greedy_ratio), 100 * statistics.mean(knapsack_ratio),
+            1000 * statistics.median(cached), 1000 * statistics.median(builds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Points written to InfluxDB by teleinfo.py for a day of synthetic TIC frames (standard mode labels of
+# bench_tic_parser.py, one frame per second, a consumption between 200 and 3000 W and a PV production during the
+# day), with every label written on every frame and with the slow labels (tic_parser.SLOW_LABELS) only written on
+# change or at the heartbeat (status_publisher.SeriesFilter, as teleinfo.add_measures does).
+#
+# Usage: python benchmarks/bench_label_cache.py [--heartbeat 300] [--mode standard|historic]
+
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_tic_parser import HISTORIC_LABELS, STANDARD_LABELS  # noqa: E402
+from status_publisher import SeriesFilter  # noqa: E402
+from tic_parser import MODE_HISTORIC, SLOW_LABELS  # noqa: E402
+
+START = 1717200000
+DURATION = 86400
+
+
+def powers(t):
+    """ Return (consumption, production) in W at t seconds after midnight """
+    consumption = 1600 + 1200 * math.sin(2 * math.pi * t / 86400) + 200 * math.sin(2 * math.pi * t / 300)
+    production = max(0.0, 3000 * math.sin(math.pi * (t - 6 * 3600) / (14 * 3600))) if 6 * 3600 < t < 20 * 3600 else 0
+    return consumption, production
+
+
+def frames(mode):
+    labels = [(label, value) for label, value in HISTORIC_LABELS] if mode == MODE_HISTORIC else \
+        [(label, value) for label, _, value in STANDARD_LABELS]
+    east = 12345678.0
+    eait = 2345678.0
+    erq = 345678.0
+    for t in range(DURATION):
+        consumption, production = powers(t)
+        net = consumption - production
+        east += max(net, 0) / 3600
+        eait += max(-net, 0) / 3600
+        erq += 0.2 * consumption / 3600
+        values = {'east': int(east), 'eait': int(eait), 'erq': int(erq), 'sinsts': int(max(net, 0)),
+                  'sinsti': int(max(-net, 0)), 'smax': 4000}
+        yield START + t, {label: value.format(**values) for label, value in labels}
+
+
+def measure(value):
+    # as teleinfo.add_measures
+    return int(value) if str(value).isnumeric() else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Points written with and without the cache of the slow labels')
+    parser.add_argument('--heartbeat', type=float, default=300)
+    parser.add_argument('--mode', default='standard')
+    args = parser.parse_args()
+
+    cache = SeriesFilter(args.heartbeat)
+    every = 0
+    written = 0
+    elapsed = 0.0
+    for ts, frame in frames(args.mode):
+        for key, value in frame.items():
+            if key == "ADCO":
+                continue
+            every += 1
+            value = measure(value)
+            start = time.perf_counter()
+            if key not in SLOW_LABELS or cache.changed(key, value, ts):
+                written += 1
+            elapsed += time.perf_counter() - start
+
+    print("{} frames, heartbeat {:.0f}s".format(DURATION, args.heartbeat))
+    print("{:<22} {:>12}".format('every label', every))
+    print("{:<22} {:>12}  ({:.1f}x fewer, {} slow label points suppressed, {:.2f} us per label)".format(
+        'slow labels on change', written, every / written, cache.skipped, elapsed / every * 1e6))
+
+
+if __name__ == '__main__':
+    main()
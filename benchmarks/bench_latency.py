@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Message-to-command latency of the threaded and asyncio engines under load.
+#
+# Several sites, each with one SCR driven water heater, receive consumption measurements at a given total rate. The
+# measurements alternate between a surplus and a deficit so that every evaluation sends a new command to the heater
+# of the site. For every message, the time between its delivery to power_regulation.on_message (as the MQTT network
+# would do it) and the publication of the next command of its site is measured. The MQTT broker and InfluxDB are
+# replaced by in-memory stand-ins, the clock is the wall clock.
+#
+# - threads: messages are delivered by a thread (the paho network thread), evaluations run in the worker threads
+# - asyncio: messages are delivered by a task, evaluations run in the event loop (async_engine)
+#
+# Usage: python benchmarks/bench_latency.py [--sites 20] [--rate 500] [--duration 5] [--period 0]
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clock  # noqa: E402
+import equipment  # noqa: E402
+import power_regulation  # noqa: E402
+from async_engine import AsyncMeasurementWriter  # noqa: E402
+from debug import logger  # noqa: E402
+from equipment import TempDrivenVariablePowerEquipment  # noqa: E402
+from measurement_writer import MeasurementWriter  # noqa: E402
+from regulation_worker import LoopRegulationWorker  # noqa: E402
+from replay import MemoryInfluxClient, MemoryMqttClient, ReplayMessage  # noqa: E402
+
+
+class TimingMqttClient(MemoryMqttClient):
+    """ Measure the time between the messages of a site and the next command sent to its heater """
+
+    def __init__(self):
+        MemoryMqttClient.__init__(self)
+        self.received = {}
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def delivered(self, site):
+        with self._lock:
+            self.received[site].append(time.perf_counter())
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        MemoryMqttClient.publish(self, topic, payload, qos, retain)
+        if '/scr/' in topic:
+            now = time.perf_counter()
+            site = topic.split('/', 1)[0]
+            with self._lock:
+                pending = self.received[site]
+                while pending:
+                    self.latencies.append(now - pending.popleft())
+
+
+def build_sites(count, mqtt, writer):
+    sites = []
+    for i in range(count):
+        name = 'site{}'.format(i)
+        r = power_regulation.Regulator(writer, name=name, prefix=name + '/')
+        heater = TempDrivenVariablePowerEquipment(0, 'heater', 2400, temp_min=45, temp_eco=50, temp_sol_min=55,
+                                                  temp_max=60)
+        heater.setCurrentTemp(50)
+        # every evaluation must send a command
+        r.command_publisher.deadband = 0
+        r.command_publisher.min_interval = 0
+        r.power_available = 1500
+        r.setup(mqtt, [heater])
+        mqtt.received[name] = deque()
+        sites.append(r)
+    power_regulation.route_sites(sites)
+    return sites
+
+
+def messages(sites, rate, duration):
+    """ Yield (due time, site name, message) for the whole run, spread evenly over the sites """
+    n = int(rate * duration)
+    for k in range(n):
+        r = sites[k % len(sites)]
+        value = '0' if (k // len(sites)) % 2 == 0 else '3000'
+        yield k / float(rate), r.name, ReplayMessage(r.topic_consumed, value)
+
+
+def report(name, mqtt, sites, elapsed):
+    lat = sorted(mqtt.latencies)
+    if not lat:
+        print("{:<8} no command".format(name))
+        return
+    evaluations = sum(r.regulation_worker.evaluations for r in sites)
+    print("{:<8} {:>9} {:>9} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>8.0f}".format(
+        name, len(lat), evaluations, 1000 * statistics.median(lat), 1000 * lat[int(len(lat) * 0.95) - 1],
+        1000 * lat[int(len(lat) * 0.99) - 1], 1000 * lat[-1], len(lat) / elapsed))
+
+
+def run_threads(args):
+    clock.set_clock(None)
+    mqtt = TimingMqttClient()
+    equipment.setup(mqtt, True)
+    writer = MeasurementWriter(MemoryInfluxClient())
+    writer.start()
+    sites = build_sites(args.sites, mqtt, writer)
+    for r in sites:
+        r.regulation_worker.period = args.period
+        r.regulation_worker.start()
+
+    def network():
+        start = time.perf_counter()
+        for due, site, msg in messages(sites, args.rate, args.duration):
+            delay = start + due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            mqtt.delivered(site)
+            power_regulation.on_message(mqtt, None, msg)
+
+    start = time.perf_counter()
+    t = threading.Thread(target=network)
+    t.start()
+    t.join()
+    time.sleep(max(args.period, 0.1) + 0.1)
+    elapsed = time.perf_counter() - start
+    for r in sites:
+        r.regulation_worker.stop()
+        r.command_publisher.stop()
+    writer.stop()
+    report('threads', mqtt, sites, elapsed)
+
+
+async def run_asyncio(args):
+    loop = asyncio.get_running_loop()
+    clock.set_clock(clock.LoopClock(loop))
+    mqtt = TimingMqttClient()
+    equipment.setup(mqtt, True)
+    writer = AsyncMeasurementWriter(MemoryInfluxClient())
+    writer.start(loop)
+    sites = build_sites(args.sites, mqtt, writer)
+    for r in sites:
+        r.regulation_worker = LoopRegulationWorker(r.evaluate, args.period, loop)
+
+    start = time.perf_counter()
+    for due, site, msg in messages(sites, args.rate, args.duration):
+        delay = start + due - time.perf_counter()
+        # yield to the loop between messages, as the socket reader would
+        await asyncio.sleep(max(delay, 0))
+        mqtt.delivered(site)
+        power_regulation.on_message(mqtt, None, msg)
+    await asyncio.sleep(max(args.period, 0.1) + 0.1)
+    elapsed = time.perf_counter() - start
+    for r in sites:
+        r.regulation_worker.stop()
+        r.command_publisher.stop()
+    writer.stop()
+    clock.set_clock(None)
+    report('asyncio', mqtt, sites, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Message-to-command latency of the regulation engines')
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=500, help='messages per second, all sites together')
+    parser.add_argument('--duration', type=float, default=5, help='seconds')
+    parser.add_argument('--period', type=float, default=0, help='evaluation period in seconds')
+    parser.add_argument('--engine', choices=['threads', 'asyncio', 'both'], default='both')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    power_regulation.EVALUATION_PERIOD = args.period
+
+    print("{} sites, {} messages/s for {}s, evaluation period {}s".format(args.sites, args.rate, args.duration,
+                                                                          args.period))
+    print("{:<8} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10} {:>8}".format('engine', 'messages', 'evals', 'p50 ms',
+                                                                      'p95 ms', 'p99 ms', 'max ms', 'msg/s'))
+    if args.engine in ('threads', 'both'):
+        run_threads(args)
+    if args.engine in ('asyncio', 'both'):
+        asyncio.run(run_asyncio(args))
+
+
+if __name__ == '__main__':
+    main()
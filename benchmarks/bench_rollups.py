@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Cost and size of the in-memory rollups (rollup.py) on a synthetic day of TIC frames, one per second, with the
+# indexes and powers teleinfo.py aggregates (12 indexes, 6 powers). The time spent in the rollups per frame, the points
+# written per day (raw and per tier) and the points a dashboard panel reads for one series over 30 days are reported,
+# with a check that the energy of the rollups matches the indexes.
+#
+# Usage: python benchmarks/bench_rollups.py [--days 1]
+
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rollup import Rollups, TIERS  # noqa: E402
+
+START = 1717200000  # 2024-06-01 00:00 UTC
+INDEX_KEYS = ("EAST", "EASF01", "EASF02", "EAIT", "ERQ1", "ERQ2", "ERQ3", "ERQ4", "ERQT", "BASE", "HCHC", "HCHP")
+POWER_KEYS = ("SINSTI", "SINSTS", "PAPP", "IINST", "IRMS1", "URMS1")
+
+
+def consumption(t):
+    """ Return a consumption between 200 and 3000 W, with a daily shape and faster variations """
+    return 1600 + 1200 * math.sin(2 * math.pi * t / 86400) + 200 * math.sin(2 * math.pi * t / 300)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost and size of the rollups')
+    parser.add_argument('--days', type=float, default=1)
+    args = parser.parse_args()
+
+    duration = int(args.days * 86400)
+    rollups = Rollups()
+    points = []
+    energy = {k: 1e8 for k in INDEX_KEYS}
+    first = {k: int(v) for k, v in energy.items()}
+    elapsed = 0.0
+    for i in range(duration):
+        ts = START + i
+        p = consumption(i)
+        for k in INDEX_KEYS:
+            energy[k] += p / 3600
+        start = time.perf_counter()
+        for k in INDEX_KEYS:
+            points.extend(rollups.add_index(k, ts, int(energy[k])))
+        for k in POWER_KEYS:
+            points.extend(rollups.add_power(k, ts, int(p)))
+        elapsed += time.perf_counter() - start
+    points.extend(rollups.flush())
+
+    raw = duration * (len(INDEX_KEYS) + len(POWER_KEYS))
+    print("{:.0f} frames, {:.2f} us per frame in the rollups ({} series)".format(duration, elapsed / duration * 1e6,
+                                                                              len(INDEX_KEYS) + len(POWER_KEYS)))
+    print("{:<12} {:>14} {:>22}".format('tier', 'points/day', 'points/series/30 days'))
+    print("{:<12} {:>14.0f} {:>22}".format('raw', raw / args.days, 30 * 86400))
+    for period, retention_policy in TIERS:
+        n = sum(1 for p in points if p['retention_policy'] == retention_policy)
+        print("{:<12} {:>14.0f} {:>22}".format(retention_policy, n / args.days, 30 * 86400 // period))
+
+    for period, retention_policy in TIERS:
+        total = sum(p['fields']['energy'] for p in points
+                    if p['retention_policy'] == retention_policy and p['measurement'] == 'EAST')
+        power = sum(p['fields']['energy'] for p in points
+                    if p['retention_policy'] == retention_policy and p['measurement'] == 'SINSTS')
+        print("{}: EAST energy {:.0f} Wh (index {:.0f} Wh), SINSTS energy {:.0f} Wh".format(
+            retention_policy, total, int(energy['EAST']) - first['EAST'], power))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of the TIC frame parsing: frames per second of the previous readline/str based loop compared with
+# the TicFrameAssembler, on recorded captures or, when none is given, on synthetic standard and historic captures.
+#
+# A capture is the raw output of the serial port, it can be recorded on the Raspberry Pi with:
+#   stty -F /dev/ttyAMA0 9600 cs7 parenb -parodd -cstopb raw && timeout 600 cat /dev/ttyAMA0 > capture.bin
+#
+# Usage: python benchmarks/bench_tic_parser.py [--mode standard|historic|auto] [--chunk N] [capture.bin ...]
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tic_parser import TicFrameAssembler, checksum, MODE_HISTORIC, MODE_STANDARD  # noqa: E402
+
+STANDARD_LABELS = [
+    ('ADSC', None, '041876097418'), ('VTIC', None, '02'), ('DATE', 'E240101120000', ''),
+    ('NGTF', None, '      BASE      '), ('LTARF', None, '       BASE     '), ('EAST', None, '{east:09d}'),
+    ('EASF01', None, '{east:09d}'), ('EASF02', None, '000000000'), ('EASF03', None, '000000000'),
+    ('EASF04', None, '000000000'), ('EASF05', None, '000000000'), ('EASF06', None, '000000000'),
+    ('EASF07', None, '000000000'), ('EASF08', None, '000000000'), ('EASF09', None, '000000000'),
+    ('EASF10', None, '000000000'), ('EASD01', None, '{east:09d}'), ('EASD02', None, '000000000'),
+    ('EASD03', None, '000000000'), ('EASD04', None, '000000000'), ('EAIT', None, '{eait:09d}'),
+    ('ERQ1', None, '{erq:09d}'), ('ERQ2', None, '000001234'), ('ERQ3', None, '000000012'),
+    ('ERQ4', None, '000004567'), ('IRMS1', None, '003'), ('URMS1', None, '234'), ('PREF', None, '09'),
+    ('PCOUP', None, '09'), ('SINSTS', None, '{sinsts:05d}'), ('SMAXSN', 'E240101083012', '{smax:05d}'),
+    ('SMAXSN-1', 'E231231112233', '04310'), ('SINSTI', None, '{sinsti:05d}'), ('SMAXIN', 'E240101131415', '02980'),
+    ('SMAXIN-1', 'E231231123456', '03010'), ('CCASN', 'E240101120000', '00640'), ('CCASN-1', 'E240101113000', '00580'),
+    ('UMOY1', 'E240101120000', '233'), ('STGE', None, '003A0001'), ('MSG1', None, 'PAS DE          MESSAGE         '),
+    ('PRM', None, '09876543210123'), ('RELAIS', None, '000'), ('NTARF', None, '01'), ('NJOURF', None, '00'),
+    ('NJOURF+1', None, '00'), ('PJOURF+1', None, '00008001 NONUTILE NONUTILE NONUTILE NONUTILE NONUTILE '),
+]
+
+HISTORIC_LABELS = [
+    ('ADCO', '041876097418'), ('OPTARIF', 'HC..'), ('ISOUSC', '45'), ('HCHC', '{east:09d}'),
+    ('HCHP', '{eait:09d}'), ('PTEC', 'HP..'), ('IINST', '005'), ('IMAX', '090'), ('PAPP', '{sinsts:05d}'),
+    ('HHPHC', 'A'), ('MOTDETAT', '000000'),
+]
+
+
+def standard_group(label, date, value):
+    body = label + '\t' + (date + '\t' if date else '') + value + '\t'
+    return b'\n' + body.encode('ascii') + bytes([checksum(body.encode('ascii'))]) + b'\r'
+
+
+def historic_group(label, value):
+    body = (label + ' ' + value).encode('ascii')
+    return b'\n' + body + b' ' + bytes([checksum(body)]) + b'\r'
+
+
+def synthetic_capture(mode, frames):
+    out = bytearray(b'\r\nGARBAGE\r')
+    for n in range(frames):
+        values = {'east': 12345678 + n, 'eait': 2345678 + n // 3, 'erq': 345678 + n // 7,
+                  'sinsts': (n * 37) % 6000, 'sinsti': (n * 53) % 3000, 'smax': 4000 + n % 100}
+        out.append(0x02)
+        if mode == MODE_HISTORIC:
+            for label, value in HISTORIC_LABELS:
+                out += historic_group(label, value.format(**values))
+        else:
+            for label, date, value in STANDARD_LABELS:
+                out += standard_group(label, date, value.format(**values))
+        out.append(0x03)
+    return bytes(out)
+
+
+def legacy_verif_checksum(data, checksum_char):
+    data_unicode = 0
+    for caractere in data:
+        data_unicode += ord(caractere)
+    sum_unicode = (data_unicode & 63) + 32
+    return checksum_char == chr(sum_unicode)
+
+
+def legacy_parse(capture):
+    # the parsing loop previously used in teleinfo.main, standard mode only
+    ser = io.BytesIO(capture)
+    line = ser.readline()
+    while b'\x02' not in line:
+        line = ser.readline()
+    line = ser.readline()
+    frames = 0
+    frame = {}
+    while line:
+        line_str = line.decode("utf-8")
+        arr = line_str.split("\t")
+        if len(arr) >= 2:
+            key = arr[0]
+            rest = arr[len(arr) - 1]
+            val = line_str[0:len(line_str) - len(rest) - 1][len(key) + 1:]
+            checksum_char = (rest.replace('\x03\x02', '')).replace("\r\n", "")
+            if legacy_verif_checksum(f"{key}\t{val}\t", checksum_char):
+                frame[key] = val
+        if b'\x03' in line:
+            frames += 1
+            frame = {}
+        line = ser.readline()
+    return frames
+
+
+def assembler_parse(capture, mode, chunk):
+    assembler = TicFrameAssembler(mode)
+    frames = 0
+    view = memoryview(capture)
+    for i in range(0, len(capture), chunk):
+        frames += len(assembler.feed(view[i:i + chunk]))
+    return frames, assembler
+
+
+def bench(name, fn, repeat):
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("  {:<28} {:>7} frames  {:>10.0f} frames/s".format(name, frames, frames / best if best else 0))
+
+
+def run(title, capture, mode, chunk, repeat):
+    print("{} ({} bytes)".format(title, len(capture)))
+    if mode != MODE_HISTORIC:
+        bench('readline + str (legacy)', lambda: legacy_parse(capture), repeat)
+    bench('assembler, {} byte reads'.format(chunk), lambda: assembler_parse(capture, mode, chunk)[0], repeat)
+    bench('assembler, 64 byte reads', lambda: assembler_parse(capture, mode, 64)[0], repeat)
+    print("  parser counters: {}".format(assembler_parse(capture, mode, chunk)[1].stats()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('captures', nargs='*', help='raw TIC captures')
+    parser.add_argument('--mode', default='auto', choices=['auto', MODE_STANDARD, MODE_HISTORIC])
+    parser.add_argument('--chunk', type=int, default=4096, help='size of the simulated serial reads')
+    parser.add_argument('--frames', type=int, default=2000, help='number of synthetic frames')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    mode = None if args.mode == 'auto' else args.mode
+
+    if args.captures:
+        for path in args.captures:
+            with open(path, 'rb') as f:
+                run(path, f.read(), mode, args.chunk, args.repeat)
+    else:
+        run('synthetic standard capture', synthetic_capture(MODE_STANDARD, args.frames), mode, args.chunk,
+            args.repeat)
+        run('synthetic historic capture', synthetic_capture(MODE_HISTORIC, args.frames), mode or MODE_HISTORIC,
+            args.chunk, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
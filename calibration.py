@@ -0,0 +1,87 @@
+# SCR calibration: conversion of a power command into the conduction percentage sent to a digitally controlled SCR.
+#
+# The default response is the theoretical one of a phase angle controller driving a resistive load: for a share z of
+# the maximum power, the conduction angle is acos(1 - 2z) / pi. A measured response curve can be given for a given
+# SCR in equipment_config.yml instead, as a list of [power in watts, percent] points:
+#
+#   calibration:
+#     - [0, 0]
+#     - [500, 31]
+#     - [1200, 52]
+#     - [2400, 100]
+#
+# A measured curve is sampled once into a table of STEPS + 1 percentages regularly spaced in power, a command is then
+# a linear interpolation between the two neighbouring entries of this table instead of a search of the segment of the
+# curve. The theoretical response is computed directly: a single acos is cheaper in Python than the table lookup
+# (see benchmarks/bench_calibration.py).
+
+import math
+
+# number of intervals of the precomputed table of a measured curve
+STEPS = 4096
+
+
+class Calibration:
+    def __init__(self, response, steps=STEPS):
+        """ response(z) gives the percentage for a share z (0 to 1) of the maximum power """
+        self.steps = steps
+        self._table = [min(max(response(i / steps), 0.0), 100.0) for i in range(steps + 1)]
+
+    def percent(self, z):
+        """ Return the percentage for a share z of the maximum power """
+        if 0 < z < 1:
+            x = z * self.steps
+            i = int(x)
+            table = self._table
+            low = table[i]
+            return low + (table[i + 1] - low) * (x - i)
+        return self._table[0] if z <= 0 else self._table[-1]
+
+
+class PhaseAngleCalibration:
+    """ The theoretical response of a phase angle controller, computed for each command """
+
+    def percent(self, z):
+        if 0 < z < 1:
+            return math.acos(1 - (2 * z)) / math.pi * 100
+        return 0.0 if z <= 0 else 100.0
+
+
+def measured_response(points, max_power):
+    """ Return a response function interpolating [power, percent] measured points """
+    points = sorted((float(p) / max_power, float(pct)) for p, pct in points)
+    if len(points) < 2:
+        raise ValueError("a calibration needs at least 2 points")
+    ratios = [p[0] for p in points]
+    percents = [p[1] for p in points]
+
+    def response(z):
+        if z <= ratios[0]:
+            return percents[0]
+        for i in range(1, len(ratios)):
+            if z <= ratios[i]:
+                span = ratios[i] - ratios[i - 1]
+                if span == 0:
+                    return percents[i]
+                return percents[i - 1] + (percents[i] - percents[i - 1]) * (z - ratios[i - 1]) / span
+        return percents[-1]
+
+    return response
+
+
+_default = None
+
+
+def default_calibration():
+    """ Return the calibration of the theoretical response, shared by all the equipments """
+    global _default
+    if _default is None:
+        _default = PhaseAngleCalibration()
+    return _default
+
+
+def load_calibration(points, max_power):
+    """ Return the calibration for the measured points of equipment_config.yml, the default one if there is none """
+    if not points:
+        return default_calibration()
+    return Calibration(measured_response(points, max_power))
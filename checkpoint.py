@@ -0,0 +1,116 @@
+# Warm restart of the regulation.
+#
+# The energy counters of the equipments, their mode (auto/manual), the temperatures set over MQTT, their power set
+# points and the state of the reactive power estimation only live in memory. They are saved periodically in a JSON
+# file so that a restart resumes from them instead of switching every equipment off and counting the energy from 0.
+# The file is replaced atomically (written to a temporary file, flushed to disk, then renamed), a crash during a save
+# leaves the previous checkpoint intact.
+# The state of a site is taken by its regulation worker, between two evaluations, so that the energy counters and set
+# points of its equipments are consistent; the file is written once the states of all the sites are taken.
+
+import json
+import os
+import threading
+
+import clock
+from debug import debug as debug
+
+VERSION = 1
+
+
+def load_checkpoint(path):
+    """ Return the saved states by site with the date of the save, None when there is no valid checkpoint """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as e:
+        debug(0, "ignoring the checkpoint {}: {}".format(path, e))
+        return None
+    if checkpoint.get('version') != VERSION:
+        debug(0, "ignoring the checkpoint {}: version {}".format(path, checkpoint.get('version')))
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, sites, ts):
+    """ Write the state of the regulators of the sites to path, atomically """
+    write_checkpoint(path, {r.name: r.get_state() for r in sites}, ts)
+
+
+def write_checkpoint(path, states, ts):
+    """ Write the states of the sites (by site name) to path, atomically """
+    checkpoint = {
+        'version': VERSION,
+        'date': ts,
+        'sites': states,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpointer:
+    def __init__(self, path, sites, interval=60):
+        self.path = path
+        self.sites = sites
+        self.interval = interval
+        self._timer = None
+        self._lock = threading.Lock()
+        # states taken so far by the workers for the save in progress, and its number
+        self._states = None
+        self._round = 0
+
+        # counters
+        self.saves = 0
+        self.failures = 0
+
+    def save(self):
+        """ Ask the regulation worker of each site for its state, the last one to answer writes the file """
+        with self._lock:
+            self._round += 1
+            self._states = {}
+            current = self._round
+        for r in self.sites:
+            r.regulation_worker.submit(lambda r=r: self._take(r, current))
+
+    def _take(self, r, current):
+        state = r.get_state()
+        with self._lock:
+            if current != self._round:
+                # a later save was started meanwhile
+                return
+            self._states[r.name] = state
+            if len(self._states) < len(self.sites):
+                return
+            states, self._states = self._states, None
+        self._write(states)
+
+    def _write(self, states):
+        try:
+            write_checkpoint(self.path, states, clock.now())
+        except Exception as e:
+            self.failures += 1
+            debug(0, "unable to save the checkpoint {}: {}".format(self.path, e))
+        else:
+            self.saves += 1
+
+    def start(self):
+        if self._timer is None:
+            self._timer = clock.repeat(self.interval, self.save)
+
+    def stop(self):
+        """ Stop the periodic saves and save a last time, to be called once the regulation workers are stopped """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        with self._lock:
+            self._round += 1
+            self._states = None
+        self._write({r.name: r.get_state() for r in self.sites})
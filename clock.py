@@ -0,0 +1,127 @@
+# Time source of the regulation.
+# The regulation and the equipments never read the wall clock directly, they call now() (monotonic() to measure an
+# interval) and schedule their periodic tasks with repeat(). By default this is the wall clock and real timer threads, the replay mode installs a
+# VirtualClock instead so that a recorded day can be re-run as fast as the CPU allows, and the asyncio engine a
+# LoopClock running the timers in its event loop.
+
+import heapq
+import time
+from threading import Timer
+
+from debug import debug as debug
+
+_clock = None
+
+
+class RepeatTimer(Timer):
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.function(*self.args,**self.kwargs)
+            debug(4,'*** retarting timer for next period : sleeping process for ' + str(self.interval) + ' seconds')
+
+
+class VirtualTimer:
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+    def __init__(self, start):
+        self._now = start
+        self._timers = []
+        self._seq = 0
+
+    def now(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def repeat(self, interval, function):
+        timer = VirtualTimer(interval, function)
+        self._schedule(self._now + interval, timer)
+        return timer
+
+    def _schedule(self, due, timer):
+        self._seq += 1
+        heapq.heappush(self._timers, (due, self._seq, timer))
+
+    def advance_to(self, t):
+        """ Move the time forward, running the timers which are due on the way, in order """
+        while self._timers and self._timers[0][0] <= t:
+            due, _, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            self._now = max(self._now, due)
+            timer.function()
+            self._schedule(due + timer.interval, timer)
+        self._now = max(self._now, t)
+
+
+class LoopTimer:
+    def __init__(self, loop, interval, function):
+        self.interval = interval
+        self.function = function
+        self._loop = loop
+        self._handle = loop.call_later(interval, self._run)
+
+    def _run(self):
+        self._handle = self._loop.call_later(self.interval, self._run)
+        self.function()
+
+    def cancel(self):
+        self._handle.cancel()
+
+
+class LoopClock:
+    """ Wall clock which timers are run by an asyncio event loop instead of threads """
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def now(self):
+        return time.time()
+
+    def monotonic(self):
+        return self._loop.time()
+
+    def repeat(self, interval, function):
+        return LoopTimer(self._loop, interval, function)
+
+
+def set_clock(clock):
+    """ Install a clock (None for the wall clock) """
+    global _clock
+    _clock = clock
+
+
+def get_clock():
+    return _clock
+
+
+def now():
+    if _clock is not None:
+        return _clock.now()
+    return time.time()
+
+
+def monotonic():
+    """ Time to measure intervals with, not affected by the changes of the wall clock """
+    if _clock is not None:
+        return _clock.monotonic()
+    return time.monotonic()
+
+
+def repeat(interval, function):
+    """ Call function every interval seconds, return an object with a cancel() method """
+    if _clock is not None:
+        return _clock.repeat(interval, function)
+    timer = RepeatTimer(interval, function)
+    timer.daemon = True
+    timer.start()
+    return timer
@@ -0,0 +1,116 @@
+# Output layer of the equipment commands (scr/{id}/in, wifi_plug/{id}/in).
+#
+# The equipments call set_current_power() far more often than their command actually needs to change: the same value
+# is sent again on each readiness check, and an SCR percentage often moves by a fraction of a percent only. This layer
+# sits between the equipments and MQTT and, for each device (topic):
+# - keeps the last value sent, an identical value is never sent again
+# - ignores changes within a deadband of the last value sent (switching on or off is never ignored)
+# - sends at most one command every min_interval seconds: a command arriving sooner is kept pending and only the
+#   latest pending value is sent once the interval is over (switching on or off is never delayed)
+# - sends the last value again every keepalive seconds, so that a device which restarted or missed a message gets
+#   its command back
+# The pending commands and the keepalives are handled by tick(), called every second by a timer started by start().
+
+import threading
+
+import clock
+from debug import debug as debug
+
+
+class _Device:
+    __slots__ = ('value', 'payload', 'retain', 'last_sent', 'pending')
+
+    def __init__(self):
+        self.value = None
+        self.payload = None
+        self.retain = False
+        self.last_sent = None
+        self.pending = None
+
+
+class CommandPublisher:
+    def __init__(self, client, deadband=0.5, min_interval=1.0, keepalive=60.0, tick_period=1.0):
+        self.client = client
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.keepalive = keepalive
+        self.tick_period = tick_period
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+        # counters
+        self.sent = 0
+        self.suppressed = 0
+        self.delayed = 0
+        self.keepalives = 0
+
+    def _publish(self, topic, device, value, payload, retain, now):
+        device.value = value
+        device.payload = payload
+        device.retain = retain
+        device.last_sent = now
+        device.pending = None
+        self.client.publish(topic, payload, retain=retain)
+
+    def send(self, topic, value, payload, retain=False, deadband=None):
+        """ Send the command, unless it's suppressed or delayed. Return True if it has been sent now """
+        if deadband is None:
+            deadband = self.deadband
+        now = clock.now()
+        with self._lock:
+            device = self._devices.get(topic)
+            if device is None:
+                device = self._devices[topic] = _Device()
+            elif device.value is not None:
+                switching = (value == 0) != (device.value == 0)
+                if value == device.value or (not switching and abs(value - device.value) <= deadband):
+                    # close enough to what the device already has, a pending command is not needed anymore
+                    device.pending = None
+                    self.suppressed += 1
+                    return False
+                if not switching and now - device.last_sent < self.min_interval:
+                    device.pending = (value, payload, retain)
+                    self.delayed += 1
+                    return False
+            self._publish(topic, device, value, payload, retain, now)
+            self.sent += 1
+            return True
+
+    def tick(self):
+        """ Send the pending commands which interval is over and the keepalives """
+        now = clock.now()
+        with self._lock:
+            for topic, device in self._devices.items():
+                if device.pending is not None:
+                    if now - device.last_sent >= self.min_interval:
+                        self._publish(topic, device, *device.pending, now)
+                        self.sent += 1
+                elif self.keepalive and device.last_sent is not None and now - device.last_sent >= self.keepalive:
+                    debug(4, "keepalive {} {}".format(topic, device.payload))
+                    self._publish(topic, device, device.value, device.payload, device.retain, now)
+                    self.keepalives += 1
+
+    def forget(self, topic):
+        """ Drop the device of topic (equipment removed), its pending command and keepalives are not sent anymore """
+        with self._lock:
+            self._devices.pop(topic, None)
+
+    def start(self):
+        if self._timer is None:
+            self._timer = clock.repeat(self.tick_period, self.tick)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def stats(self):
+        return {
+            'devices': len(self._devices),
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'delayed': self.delayed,
+            'pending': sum(1 for d in self._devices.values() if d.pending is not None),
+            'keepalives': self.keepalives,
+        }
@@ -12,6 +12,69 @@ Configuration can be overridden using environment variables:
 - INFLUXDB_DATABASE: InfluxDB database name
 - INFLUXDB_USERNAME: InfluxDB authentication username 
 - INFLUXDB_PASSWORD: InfluxDB authentication password
+- INFLUXDB_RAW_RETENTION: Retention of the raw measurements (retention policy 'raw'), for instance '7d'
+- INFLUXDB_ROLLUP_MINUTE_RETENTION: Retention of the 1 minute rollups (retention policy 'rollup_1m')
+- INFLUXDB_ROLLUP_HOUR_RETENTION: Retention of the 1 hour rollups (retention policy 'rollup_1h'), 'INF' to keep them
+
+- MEASUREMENT_BATCH_SIZE: Maximum number of points sent to InfluxDB in one request
+- MEASUREMENT_FLUSH_INTERVAL: Maximum age (seconds) of a queued point before the queue is flushed
+- MEASUREMENT_QUEUE_SIZE: Maximum number of points kept in memory, oldest points are dropped beyond
+- SPOOL_DIR: Directory of the disk spools of the points which could not be written to InfluxDB, one sub-directory
+  per program (no spool when empty)
+- SPOOL_MAX_SIZE: Maximum size in MB of a spool, the oldest points are dropped beyond
+- SPOOL_SEGMENT_SIZE: Size in KB of the spool segment files
+- SPOOL_RETRY_INTERVAL: Interval in seconds between two write attempts while InfluxDB is not reachable
+- TELEINFO_MAX_PENDING_FRAMES: Maximum number of TIC frames kept in memory for retry when InfluxDB is not reachable
+  and there is no spool
+- TELEINFO_HEARTBEAT: Maximum interval in seconds between two points of a static or slow TIC label (address,
+  contract, status words, indexes), which is otherwise only written when it changes
+- TIC_MODE: TIC mode of the meter, 'standard' (9600 bauds), 'historic' (1200 bauds) or 'auto' (9600 bauds, mode
+  detected on each frame)
+- TIC_TOPICS: MQTT messages published by teleinfo for each frame, 'frame' (a single JSON message on tic/frame with
+  all the measurements used by the regulation), 'labels' (one message per measurement, tic/SINSTI, tic/SINSTS...)
+  or 'both'
+- INDEX_POWER_WINDOW: Time window in seconds of the index transitions from which a power is derived for an energy
+  index of the meter (EAST, EASF01.., EAIT, ERQT..), see index_estimator.py
+- ALLOCATION_ENGINE: Allocation of the power between equipments, 'greedy' (one equipment at a time) or 'numpy'
+  (whole fleet at once, requires numpy)
+- CONSTANT_ALLOCATION: Switching on of consecutive constant power equipments by the greedy engine, 'greedy' (one by
+  one, in priority order) or 'knapsack' (best fitting combination)
+- CONTROLLER: Power added or removed at each evaluation, 'step' (a quarter of the surplus or deficit), 'gain' (gain
+  scheduling, converges in one or two evaluations) or 'pi' (PI with anti-windup)
+- CONTROLLER_SETTLE_TIME: Time in seconds for a load change to show in the measurements, the 'gain' and 'pi'
+  controllers don't count on a measurement taken sooner after a correction
+- INJECTED_FILTERS: Filters applied to the SINSTI measurements before they're used by the regulation, for instance
+  "spike:1500,median:3" (see filters.py), none when empty
+- CONSUMED_FILTERS: Filters applied to the SINSTS measurements
+- KNAPSACK_RESOLUTION: Power resolution in watts of the constant equipments combination
+- COMMAND_DEADBAND: Changes of an SCR command (in percent) below which no new command is sent
+- COMMAND_MIN_INTERVAL: Minimum interval in seconds between two commands sent to a device
+- COMMAND_KEEPALIVE: Interval in seconds after which the last command of a device is sent again (0 to disable)
+- STATUS_HEARTBEAT: Maximum interval in seconds between two full (retained) status snapshots
+- STATUS_ENCODING: Encoding of the status messages, 'json' or 'msgpack' (requires msgpack)
+- STATUS_POWER_TOLERANCE: Power change in watts below which a status value or a power series is not updated
+- STATUS_ENERGY_TOLERANCE: Energy change in Wh below which a status value or an energy series is not updated
+- SERIES_MAX_INTERVAL: Maximum interval in seconds between two points of an equipment series
+- REGULATION_ENGINE: 'threads' (paho network thread, worker and timer threads) or 'asyncio' (everything in one
+  asyncio event loop, uses aiohttp for InfluxDB when installed)
+- HISTORY_DURATION: Duration in seconds of the recent history kept in memory by the regulation
+- HISTORY_RESOLUTION: Minimum interval in seconds between two samples of the history, closer samples replace the
+  previous one
+- HISTORY_RECENT: Duration in seconds of the most recent part of the history kept at HISTORY_RESOLUTION, the older
+  samples are downsampled (defaults to HISTORY_DURATION: the whole history at HISTORY_RESOLUTION)
+- HISTORY_COARSE_RESOLUTION: Duration in seconds of the buckets (mean, min, max, count) of the downsampled history
+- CHECKPOINT_FILE: File where the state of the regulation is saved for a warm restart (no checkpoint when empty)
+- CHECKPOINT_INTERVAL: Interval in seconds between two saves of the state
+- CHECKPOINT_MAX_AGE: Maximum age in seconds of a checkpoint for its power set points to be resumed at startup
+- EQUIPMENT_CONFIG_RELOAD_INTERVAL: Interval in seconds between two checks of the equipment configuration files,
+  a changed file is applied without restarting the regulation (0 to disable)
+- SITES_CONFIG: YAML file listing the sites regulated by the process (name, topic prefix, equipment configuration),
+  a single site without prefix when empty
+- HC_WINDOWS: Off-peak windows of working days, "HH:MM-HH:MM" separated by commas (default HC_START_TIME-HC_END_TIME)
+- HC_WEEKEND_WINDOWS: Off-peak windows of saturdays and sundays (default HC_WINDOWS)
+- HC_HOLIDAY_WINDOWS: Off-peak windows of holidays (default HC_WEEKEND_WINDOWS)
+- HC_HOLIDAYS: Holidays, "YYYY-MM-DD" separated by commas
+- HC_TIMEZONE: Time zone of the off-peak windows
 """
 
 import os
@@ -29,7 +92,61 @@ INFLUXDB_PORT = int(os.getenv('INFLUXDB_PORT', '8086'))
 INFLUXDB_DATABASE = os.getenv('INFLUXDB_DATABASE', 'teleinfo')
 INFLUXDB_USERNAME = os.getenv('INFLUXDB_USERNAME', '')
 INFLUXDB_PASSWORD = os.getenv('INFLUXDB_PASSWORD', '')
+INFLUXDB_RAW_RETENTION = os.getenv('INFLUXDB_RAW_RETENTION', '7d')
+INFLUXDB_ROLLUP_MINUTE_RETENTION = os.getenv('INFLUXDB_ROLLUP_MINUTE_RETENTION', '400d')
+INFLUXDB_ROLLUP_HOUR_RETENTION = os.getenv('INFLUXDB_ROLLUP_HOUR_RETENTION', 'INF')
+
+# Measurement writer Settings (batched InfluxDB writes)
+MEASUREMENT_BATCH_SIZE = int(os.getenv('MEASUREMENT_BATCH_SIZE', '500'))
+MEASUREMENT_FLUSH_INTERVAL = float(os.getenv('MEASUREMENT_FLUSH_INTERVAL', '2'))
+MEASUREMENT_QUEUE_SIZE = int(os.getenv('MEASUREMENT_QUEUE_SIZE', '10000'))
+
+# Disk spool Settings (points kept while InfluxDB is not reachable)
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool'))
+SPOOL_MAX_SIZE = float(os.getenv('SPOOL_MAX_SIZE', '100'))
+SPOOL_SEGMENT_SIZE = int(os.getenv('SPOOL_SEGMENT_SIZE', '1024'))
+SPOOL_RETRY_INTERVAL = float(os.getenv('SPOOL_RETRY_INTERVAL', '30'))
+
+# Teleinfo Settings
+TELEINFO_MAX_PENDING_FRAMES = int(os.getenv('TELEINFO_MAX_PENDING_FRAMES', '600'))
+TELEINFO_HEARTBEAT = float(os.getenv('TELEINFO_HEARTBEAT', '300'))
+TIC_MODE = os.getenv('TIC_MODE', 'standard')
+TIC_TOPICS = os.getenv('TIC_TOPICS', 'frame')
+INDEX_POWER_WINDOW = float(os.getenv('INDEX_POWER_WINDOW', '30'))
+
+# Regulation Settings
+ALLOCATION_ENGINE = os.getenv('ALLOCATION_ENGINE', 'greedy')
+CONSTANT_ALLOCATION = os.getenv('CONSTANT_ALLOCATION', 'greedy')
+CONTROLLER = os.getenv('CONTROLLER', 'step')
+CONTROLLER_SETTLE_TIME = float(os.getenv('CONTROLLER_SETTLE_TIME', '2'))
+INJECTED_FILTERS = os.getenv('INJECTED_FILTERS', '')
+CONSUMED_FILTERS = os.getenv('CONSUMED_FILTERS', '')
+KNAPSACK_RESOLUTION = int(os.getenv('KNAPSACK_RESOLUTION', '10'))
+COMMAND_DEADBAND = float(os.getenv('COMMAND_DEADBAND', '0.5'))
+COMMAND_MIN_INTERVAL = float(os.getenv('COMMAND_MIN_INTERVAL', '1'))
+COMMAND_KEEPALIVE = float(os.getenv('COMMAND_KEEPALIVE', '300'))
+STATUS_HEARTBEAT = float(os.getenv('STATUS_HEARTBEAT', '60'))
+STATUS_ENCODING = os.getenv('STATUS_ENCODING', 'json')
+STATUS_POWER_TOLERANCE = float(os.getenv('STATUS_POWER_TOLERANCE', '10'))
+STATUS_ENERGY_TOLERANCE = float(os.getenv('STATUS_ENERGY_TOLERANCE', '10'))
+SERIES_MAX_INTERVAL = float(os.getenv('SERIES_MAX_INTERVAL', '300'))
+HISTORY_DURATION = float(os.getenv('HISTORY_DURATION', '86400'))
+HISTORY_RESOLUTION = float(os.getenv('HISTORY_RESOLUTION', '1'))
+HISTORY_RECENT = float(os.getenv('HISTORY_RECENT', HISTORY_DURATION))
+HISTORY_COARSE_RESOLUTION = float(os.getenv('HISTORY_COARSE_RESOLUTION', '60'))
+CHECKPOINT_FILE = os.getenv('CHECKPOINT_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'regulation_state.json'))
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '60'))
+CHECKPOINT_MAX_AGE = float(os.getenv('CHECKPOINT_MAX_AGE', '600'))
+EQUIPMENT_CONFIG_RELOAD_INTERVAL = float(os.getenv('EQUIPMENT_CONFIG_RELOAD_INTERVAL', '5'))
+SITES_CONFIG = os.getenv('SITES_CONFIG', '')
+REGULATION_ENGINE = os.getenv('REGULATION_ENGINE', 'threads')
 
 # Heures Creuses (Off-peak hours) Settings
 HC_START_TIME = os.getenv('HC_START_TIME', '02:05')
 HC_END_TIME = os.getenv('HC_END_TIME', '06:50')
+HC_WINDOWS = os.getenv('HC_WINDOWS', HC_START_TIME + '-' + HC_END_TIME)
+HC_WEEKEND_WINDOWS = os.getenv('HC_WEEKEND_WINDOWS', HC_WINDOWS)
+HC_HOLIDAY_WINDOWS = os.getenv('HC_HOLIDAY_WINDOWS', HC_WEEKEND_WINDOWS)
+HC_HOLIDAYS = os.getenv('HC_HOLIDAYS', '')
+HC_TIMEZONE = os.getenv('HC_TIMEZONE', 'Europe/Paris')
@@ -0,0 +1,175 @@
+# Controllers of the regulation loop.
+#
+# At each evaluation, the controller turns the measured surplus (power available minus power consumed, in watts,
+# negative when power is imported from the grid) into the power to add to (positive) or remove from (negative) the
+# equipments.
+# - 'step' divides the surplus by 4: robust, but a 2 kW surplus takes about 10 evaluations to be absorbed
+# - 'gain' applies a gain close to 1 to large errors and a lower one near the balance, where the measurement noise
+#   dominates. The error threshold is derived from the power of the equipments (a share of the largest max_power or
+#   nominal_power)
+# - 'pi' is a discrete PI in velocity form (the equipments hold the load, the controller gives its variation)
+# Both adaptive controllers:
+# - compensate the corrections the meter has not seen yet: a correction applied less than settle_time seconds before
+#   the last measurement is subtracted from the measured error, so that a late measurement doesn't get the same
+#   correction applied twice (which makes a high gain oscillate)
+# - clamp the correction to what the equipments can actually absorb or release (max_power/nominal_power of the
+#   equipments in auto mode, their current power), which is the anti-windup of the PI: a saturated fleet doesn't
+#   accumulate an error which would have to be unwound later
+
+from equipment import ConstantPowerEquipment
+
+CONTROLLER_STEP = 'step'
+CONTROLLER_GAIN = 'gain'
+CONTROLLER_PI = 'pi'
+
+
+def _max_power(e):
+    if isinstance(e, ConstantPowerEquipment):
+        return e.nominal_power
+    return getattr(e, 'max_power', 0)
+
+
+def capacity(equipments):
+    """ Return (power which can be added, power which can be removed) by the equipments in auto mode """
+    up = 0
+    down = 0
+    for e in equipments:
+        if not e.isAutoMode():
+            continue
+        p = e.get_current_power() or 0
+        up += max(_max_power(e) - p, 0)
+        down += p
+    return up, down
+
+
+class StepController:
+    # no load tracking needed, see Regulator.evaluate()
+    predictive = False
+
+    def __init__(self, divisor=4):
+        self.divisor = divisor
+
+    def correction(self, error, equipments, now, measure_ts):
+        return error / self.divisor
+
+    def applied(self, now, power):
+        pass
+
+    def stats(self):
+        return {'type': CONTROLLER_STEP}
+
+
+class PredictiveController:
+    """ Base of the adaptive controllers: compensation of the unseen corrections and clamping """
+    predictive = True
+
+    def __init__(self, deadband=50, settle_time=1.0):
+        self.deadband = deadband
+        self.settle_time = settle_time
+        # (date, power) of the recent corrections
+        self._corrections = []
+
+        # counters
+        self.corrections = 0
+        self.saturations = 0
+        self.compensated = 0
+
+    def _predicted_error(self, error, now, measure_ts):
+        # corrections the last measurement doesn't include yet
+        if measure_ts is None:
+            measure_ts = now
+        seen = measure_ts - self.settle_time
+        self._corrections = [c for c in self._corrections if c[0] > seen]
+        unseen = sum(p for ts, p in self._corrections)
+        if unseen:
+            self.compensated += 1
+        return error - unseen
+
+    def _clamp(self, power, equipments):
+        up, down = capacity(equipments)
+        if power > up or power < -down:
+            self.saturations += 1
+            return max(min(power, up), -down), True
+        return power, False
+
+    def _output(self, error):
+        raise NotImplementedError
+
+    def correction(self, error, equipments, now, measure_ts):
+        error = self._predicted_error(error, now, measure_ts)
+        if abs(error) <= self.deadband:
+            error = 0.0
+        power, saturated = self._clamp(self._output(error), equipments)
+        self._saturated(saturated)
+        self.corrections += 1
+        return power
+
+    def _saturated(self, saturated):
+        pass
+
+    def applied(self, now, power):
+        """ Record the power actually added (or removed) by the equipments for the correction """
+        if power:
+            self._corrections.append((now, power))
+
+    def stats(self):
+        return {
+            'corrections': self.corrections,
+            'saturations': self.saturations,
+            'compensated': self.compensated,
+        }
+
+
+class GainScheduledController(PredictiveController):
+    def __init__(self, equipments=(), high_gain=0.9, low_gain=0.6, band=0.2, deadband=50, settle_time=1.0):
+        PredictiveController.__init__(self, deadband, settle_time)
+        self.high_gain = high_gain
+        self.low_gain = low_gain
+        self.band = band
+        self.threshold = 0
+        self.set_equipments(equipments)
+
+    def set_equipments(self, equipments):
+        # errors above a share of the largest equipment are far from the balance
+        self.threshold = self.band * max((_max_power(e) for e in equipments), default=0)
+
+    def _output(self, error):
+        gain = self.high_gain if abs(error) >= self.threshold else self.low_gain
+        return gain * error
+
+    def stats(self):
+        stats = PredictiveController.stats(self)
+        stats['type'] = CONTROLLER_GAIN
+        stats['threshold'] = self.threshold
+        return stats
+
+
+class PIController(PredictiveController):
+    def __init__(self, kp=0.1, ki=0.8, deadband=50, settle_time=1.0):
+        PredictiveController.__init__(self, deadband, settle_time)
+        self.kp = kp
+        self.ki = ki
+        self._previous_error = 0.0
+
+    def _output(self, error):
+        output = self.kp * (error - self._previous_error) + self.ki * error
+        self._previous_error = error
+        return output
+
+    def _saturated(self, saturated):
+        # anti-windup: the error the equipments couldn't absorb is not carried to the next proportional term
+        if saturated:
+            self._previous_error = 0.0
+
+    def stats(self):
+        stats = PredictiveController.stats(self)
+        stats['type'] = CONTROLLER_PI
+        return stats
+
+
+def make_controller(kind, equipments=(), deadband=50, settle_time=1.0):
+    if kind == CONTROLLER_GAIN:
+        return GainScheduledController(equipments, deadband=deadband, settle_time=settle_time)
+    if kind == CONTROLLER_PI:
+        return PIController(deadband=deadband, settle_time=settle_time)
+    return StepController()
@@ -1,8 +1,3 @@
-import time
-import math
-from threading import Timer
-
-
 # Copyright (C) 2018-2019 Pierre Hébert
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -33,6 +28,8 @@ from threading import Timer
 #       loop to match power consumption and production faster.
 
 from debug import debug as debug
+import clock
+from calibration import default_calibration
 
 _mqtt_client = None
 _send_commands = True
@@ -45,7 +42,7 @@ def setup(mqtt_client, send_commands):
 
 
 def now_ts():
-    return time.time()
+    return clock.now()
 
 
 class Equipment:
@@ -59,8 +56,17 @@ class Equipment:
         self.last_power_change_date = None
         self.is_on = True
         self.is_ready = False
+        # deadband of the commands of this equipment, None for the one of the command publisher
+        self.command_deadband = None
+        # set by the regulator of the site: prefix of the command topics and command publisher
+        self.topic_prefix = ''
+        self.publisher = None
+        # the configuration entry of the equipment (see equipment_loader.py) and the topics of its commands
+        self.config = None
+        self.command_topics = set()
         self.previous_energy = None
         self.current_energy = None
+        self._mode_auto = True
 
     def decrease_power_by(self, watt):
         """ Return the amount of power that has been canceled, None if unknown """
@@ -72,6 +78,15 @@ class Equipment:
         # implement in subclasses
         pass
 
+    def publish_command(self, topic, value, payload, retain=False):
+        # through the command publisher (deadband, rate limit, keepalive) when there is one
+        topic = self.topic_prefix + topic
+        self.command_topics.add(topic)
+        if self.publisher is not None:
+            self.publisher.send(topic, value, payload, retain, self.command_deadband)
+        else:
+            _mqtt_client.publish(topic, payload, retain=retain)
+
     def set_current_power(self, power):
         if self.last_power_change_date is not None:
             now = now_ts()
@@ -103,7 +118,7 @@ class Equipment:
         pass
 
     def isAutoMode(self):
-        return self.__mode_auto
+        return self._mode_auto
 
     def isReady(self):
         # implement in subclasses
@@ -127,6 +142,29 @@ class Equipment:
         self.energy += energy
         
 
+    def get_state(self):
+        """ Return the state to save in a checkpoint, see restore_state() """
+        return {
+            'current_power': self.current_power,
+            'energy': self.get_energy() if self.last_power_change_date is not None else self.energy,
+            'previous_energy': self.previous_energy,
+            'current_energy': self.current_energy,
+            'auto': self._mode_auto,
+        }
+
+    def restore_state(self, state):
+        """ Restore a saved state, except the power: the caller sets it again with set_current_power() """
+        self.energy = state['energy']
+        self.previous_energy = state['previous_energy']
+        self.current_energy = state['current_energy']
+        self._mode_auto = state['auto']
+        # the time the process was stopped is not counted
+        self.last_power_change_date = now_ts()
+
+    def stop(self):
+        """ Release the timers of an equipment removed from the configuration """
+        pass
+
     def reset_energy(self):
         if self.last_power_change_date is not None:
             now = now_ts()
@@ -139,26 +177,22 @@ class Equipment:
         self.last_power_change_date = now_ts()
         return self.previous_energy
 
-class RepeatTimer(Timer):  
-    def run(self):  
-        while not self.finished.wait(self.interval):  
-            self.function(*self.args,**self.kwargs)  
-            debug(4,'*** retarting timer for next period : sleeping process for ' + str(self.interval) + ' seconds')
-
 class VariablePowerEquipment(Equipment):
     MINIMUM_POWER = 50
     MINIMUM_PERCENT = 0
 
-    def __init__(self,id,name, max_power,min_energy,period):
+    def __init__(self,id,name, max_power,min_energy,period,calibration=None):
         Equipment.__init__(self,id, name)
-        _mqtt_client.subscribe('scr/{0}/control'.format(self.id))
         self.max_power = max_power
+        self.calibration = calibration or default_calibration()
         self.min_energy = min_energy
         self._mode_auto = True
         self.reset_energy()
         self.period = period
-        self.timer = RepeatTimer(period, self.timer_call_back)
-        self.timer.start()
+        self.timer = clock.repeat(period, self.timer_call_back)
+
+    def stop(self):
+        self.timer.cancel()
     
     def timer_call_back(self):
        
@@ -196,7 +230,8 @@ class VariablePowerEquipment(Equipment):
         if self.get_energy() >= self.min_energy:
            self.is_ready = True
            self.setAutoMode()
-           self.set_current_power(0)
+           if self.current_power > 0:
+              self.set_current_power(0)
         else :
            self.is_ready = False
         return self.is_ready
@@ -221,21 +256,10 @@ class VariablePowerEquipment(Equipment):
            power = self.max_power
         super(VariablePowerEquipment, self).set_current_power(power)
 
-        # regression factors computed from the response measurement of the SCR regulator
-        a=1156.7360635374
-        b=-2733.09296216279
-        c=2365.91298447422
-        d=-924.443712230202
-        e=218.242717162968
-        f=-0.010002294517421
-        g=11.3205979917473
-
-        z = self.current_power / float(self.max_power)
-#            percent = g + f/z + e*z + d*z*z + c*z*z*z + b*z*z*z*z + a*z*z*z*z*z
-        percent = math.acos(1-(2*z))/math.pi * 100
+        percent = self.calibration.percent(self.current_power / float(self.max_power))
 
         if _send_commands:
-            _mqtt_client.publish('scr/{0}/in'.format(self.id), str(percent))
+            self.publish_command('scr/{0}/in'.format(self.id), percent, str(percent))
         debug(4, "sending power command {}W ({}%) for {}".format(self.current_power, percent, self.name))
 
 
@@ -288,11 +312,10 @@ class TempDrivenVariablePowerEquipment(Equipment):
     MINIMUM_POWER = 50
     MINIMUM_PERCENT = 0
 
-    def __init__(self,id,name, max_power,temp_min,temp_eco,temp_sol_min,temp_max):
+    def __init__(self,id,name, max_power,temp_min,temp_eco,temp_sol_min,temp_max,calibration=None):
         Equipment.__init__(self,id, name)
-        _mqtt_client.subscribe('scr/{0}/control'.format(self.id))
-        _mqtt_client.subscribe('scr/{0}/temperature'.format(self.id))
         self.max_power = max_power
+        self.calibration = calibration or default_calibration()
         self._temp_min = temp_min
         self._temp_sol_min = temp_sol_min
         self._temp_max = temp_max
@@ -323,6 +346,15 @@ class TempDrivenVariablePowerEquipment(Equipment):
     def setEcoTemp(self,temp):
         self._temp_eco=temp
 
+    def get_state(self):
+        state = Equipment.get_state(self)
+        state['temps'] = [self._temp_min, self._temp_eco, self._temp_sol_min, self._temp_max, self._current_temp]
+        return state
+
+    def restore_state(self, state):
+        Equipment.restore_state(self, state)
+        self._temp_min, self._temp_eco, self._temp_sol_min, self._temp_max, self._current_temp = state['temps']
+
     def isReady(self):
         if self._current_temp >= self._temp_max:
            debug(4, self.name +" temperature : " + str(self._current_temp) + " greater than max : " + str(self._temp_max))
@@ -367,21 +399,10 @@ class TempDrivenVariablePowerEquipment(Equipment):
            power = self.max_power
         Equipment.set_current_power(self,power)
 
-        # regression factors computed from the response measurement of the SCR regulator
-        a=1156.7360635374
-        b=-2733.09296216279
-        c=2365.91298447422
-        d=-924.443712230202
-        e=218.242717162968
-        f=-0.010002294517421
-        g=11.3205979917473
-
-        z = self.current_power / float(self.max_power)
-        #percent = g + f/z + e*z + d*z*z + c*z*z*z + b*z*z*z*z + a*z*z*z*z*z
-        percent = math.acos(1-(2*z))/math.pi * 100
+        percent = self.calibration.percent(self.current_power / float(self.max_power))
 
         if _send_commands:
-            _mqtt_client.publish('scr/{0}/in'.format(self.id), str(percent))
+            self.publish_command('scr/{0}/in'.format(self.id), percent, str(percent))
         debug(4, "sending power command {}W ({}%) for {}".format(self.current_power, percent, self.name))
 
 
@@ -428,11 +449,14 @@ class TempDrivenVariablePowerEquipment(Equipment):
         else:
             debug(4, "not increasing power of {} because it is already at maximum power {}W".format(self.name, self.max_power))
 
+        return remaining
+
 
 class ConstantPowerEquipment(Equipment):
-    def __init__(self, name, nominal_power):
-        Equipment.__init__(self, name)
+    def __init__(self, id, name, nominal_power, plug_id=0):
+        Equipment.__init__(self, id, name)
         self.nominal_power = nominal_power
+        self.plug_id = plug_id
         self.is_on = False
 
     def set_current_power(self, power):
@@ -440,7 +464,7 @@ class ConstantPowerEquipment(Equipment):
         self.is_on = power != 0
         msg = '1' if self.is_on else '0'
         if _send_commands:
-            _mqtt_client.publish('wifi_plug/0/in', msg, retain=True)
+            self.publish_command('wifi_plug/{}/in'.format(self.plug_id), int(self.is_on), msg, retain=True)
         debug(4, "sending power command {} for {}".format(self.is_on, self.name))
 
     def decrease_power_by(self, watt):
@@ -467,8 +491,8 @@ class ConstantPowerEquipment(Equipment):
 
 
 class UnknownPowerEquipment(Equipment):
-    def __init__(self, name):
-        Equipment.__init__(self, name)
+    def __init__(self, id, name):
+        Equipment.__init__(self, id, name)
         self.is_on = False
 
     def send_power_command(self):
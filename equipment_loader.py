@@ -5,49 +5,95 @@ from equipment import (
     ConstantPowerEquipment,
     UnknownPowerEquipment
 )
+from calibration import load_calibration
 
-def load_equipment_from_config(config_file='equipment_config.yml'):
-    """Load equipment configurations from YAML file."""
+# required parameters of each equipment type, besides type and name
+REQUIRED_PARAMETERS = {
+    'VariablePowerEquipment': ('max_power', 'min_energy', 'period'),
+    'TempDrivenVariablePowerEquipment': ('max_power', 'temp_min', 'temp_eco', 'temp_sol_min', 'temp_max'),
+    'ConstantPowerEquipment': ('nominal_power',),
+    'UnknownPowerEquipment': (),
+}
+
+
+def read_equipment_config(config_file='equipment_config.yml'):
+    """ Return the validated equipment entries of the YAML file, raise ValueError if it is invalid.
+    The id of an entry is its 'id' parameter, or its position in the list when it has none """
     with open(config_file, 'r') as file:
         config = yaml.safe_load(file)
+    if not isinstance(config, dict) or not isinstance(config.get('equipment'), list):
+        raise ValueError("{}: no equipment list".format(config_file))
 
-    equipment_list = []
-    i=0
-    for equip in config['equipment']:
-        equipment_type = equip['type']
-        equipment_id=i
-        i=i+1
-               
-        if equipment_type == 'VariablePowerEquipment':
-            equipment = VariablePowerEquipment(
-                id=equipment_id,
-                name=equip['name'],
-                max_power=equip['max_power'],
-                min_energy=equip['min_energy'],
-                period=equip['period']
-            )
-        elif equipment_type == 'TempDrivenVariablePowerEquipment':
-            equipment = TempDrivenVariablePowerEquipment(
-                id=equipment_id,
-                name=equip['name'],
-                max_power=equip['max_power'],
-                temp_min=equip['temp_min'],
-                temp_eco=equip['temp_eco'],
-                temp_sol_min=equip['temp_sol_min'],
-                temp_max=equip['temp_max']
-            )
-        elif equipment_type == 'ConstantPowerEquipment':
-            equipment = ConstantPowerEquipment(
-                name=equip['name'],
-                nominal_power=equip['nominal_power']
-            )
-        elif equipment_type == 'UnknownPowerEquipment':
-            equipment = UnknownPowerEquipment(
-                name=equip['name']
-            )
-        else:
+    entries = []
+    ids = set()
+    names = set()
+    for i, equip in enumerate(config['equipment']):
+        if not isinstance(equip, dict):
+            raise ValueError("{}: equipment #{} is not a mapping".format(config_file, i))
+        equipment_type = equip.get('type')
+        if equipment_type not in REQUIRED_PARAMETERS:
             raise ValueError(f"Unknown equipment type: {equipment_type}")
-            
-        equipment_list.append(equipment)
-    
-    return equipment_list
\ No newline at end of file
+        missing = [p for p in ('name',) + REQUIRED_PARAMETERS[equipment_type] if p not in equip]
+        if missing:
+            raise ValueError("{}: equipment #{} has no {}".format(config_file, i, ', '.join(missing)))
+        entry = dict(equip)
+        entry['id'] = equip.get('id', i)
+        if entry['id'] in ids:
+            raise ValueError("{}: duplicate equipment id {}".format(config_file, entry['id']))
+        if entry['name'] in names:
+            raise ValueError("{}: duplicate equipment name {}".format(config_file, entry['name']))
+        ids.add(entry['id'])
+        names.add(entry['name'])
+        entries.append(entry)
+    return entries
+
+
+def create_equipment(equip):
+    """ Create the equipment of a validated entry, see read_equipment_config() """
+    equipment_type = equip['type']
+    equipment_id = equip['id']
+
+    if equipment_type == 'VariablePowerEquipment':
+        equipment = VariablePowerEquipment(
+            id=equipment_id,
+            name=equip['name'],
+            max_power=equip['max_power'],
+            min_energy=equip['min_energy'],
+            period=equip['period'],
+            calibration=load_calibration(equip.get('calibration'), equip['max_power'])
+        )
+    elif equipment_type == 'TempDrivenVariablePowerEquipment':
+        equipment = TempDrivenVariablePowerEquipment(
+            id=equipment_id,
+            name=equip['name'],
+            max_power=equip['max_power'],
+            temp_min=equip['temp_min'],
+            temp_eco=equip['temp_eco'],
+            temp_sol_min=equip['temp_sol_min'],
+            temp_max=equip['temp_max'],
+            calibration=load_calibration(equip.get('calibration'), equip['max_power'])
+        )
+    elif equipment_type == 'ConstantPowerEquipment':
+        equipment = ConstantPowerEquipment(
+            id=equipment_id,
+            name=equip['name'],
+            nominal_power=equip['nominal_power'],
+            plug_id=equip.get('plug_id', 0)
+        )
+    elif equipment_type == 'UnknownPowerEquipment':
+        equipment = UnknownPowerEquipment(
+            id=equipment_id,
+            name=equip['name']
+        )
+    else:
+        raise ValueError(f"Unknown equipment type: {equipment_type}")
+
+    equipment.command_deadband = equip.get('command_deadband')
+    # the entry it was created from, compared with the new one when the file is reloaded
+    equipment.config = equip
+    return equipment
+
+
+def load_equipment_from_config(config_file='equipment_config.yml'):
+    """Load equipment configurations from YAML file."""
+    return [create_equipment(equip) for equip in read_equipment_config(config_file)]
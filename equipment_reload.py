@@ -0,0 +1,116 @@
+# Hot reload of the equipment configuration.
+#
+# The equipments used to be loaded once at startup, changing a load meant restarting the regulation, which switched
+# every equipment off and lost its energy counters (unless the checkpoint was recent enough). The configuration file
+# is now watched while the regulation runs:
+# - EquipmentConfigWatcher polls the modification time and size of the file, a new version is read and validated
+#   (equipment_loader.read_equipment_config), an invalid file is logged and ignored, the current equipments are kept
+# - diff_equipments() matches the equipments of both versions by their id (the 'id' parameter of the file, see
+#   equipment_loader.py), not by their position: moving an equipment in the list only changes its priority
+# - the regulator applies the diff in its regulation thread, between two evaluations (Regulator.reload_equipments):
+#   an unchanged equipment is kept as is, with its state and power set point, a changed one is replaced by a new
+#   equipment which takes over the state of the previous one (carry_state()), a removed one is switched off, its
+#   timers are cancelled and its command topics are forgotten by the command publisher
+
+import os
+
+import clock
+from debug import debug as debug
+from equipment import ConstantPowerEquipment
+from equipment_loader import read_equipment_config
+
+# temperature parameters of a TempDrivenVariablePowerEquipment, in the order of its 'temps' state
+TEMP_PARAMETERS = ('temp_min', 'temp_eco', 'temp_sol_min', 'temp_max')
+
+
+def diff_equipments(equipments, entries):
+    """ Return the (added, removed, changed) ids between the current equipments and the entries of the new file """
+    current = {e.id: e for e in equipments}
+    ids = set(entry['id'] for entry in entries)
+    added = [entry['id'] for entry in entries if entry['id'] not in current]
+    removed = [e.id for e in equipments if e.id not in ids]
+    changed = [entry['id'] for entry in entries if entry['id'] in current and current[entry['id']].config != entry]
+    return added, removed, changed
+
+
+def carried_power(e, power):
+    """ Return the power set point of e taking over the power of the equipment it replaces """
+    if not power:
+        return 0
+    if isinstance(e, ConstantPowerEquipment):
+        return e.nominal_power
+    return min(power, getattr(e, 'max_power', power))
+
+
+def carry_state(old, new):
+    """ Move the energy, mode, temperatures and power of old to new, its replacement with a changed configuration.
+    Return False if they are not of the same type: new starts switched off """
+    if type(old) is not type(new):
+        new.set_current_power(0)
+        return False
+    state = old.get_state()
+    if 'temps' in state:
+        # a temperature changed in the file replaces the one set over MQTT, the other ones are kept
+        for i, key in enumerate(TEMP_PARAMETERS):
+            if old.config is None or new.config[key] != old.config.get(key):
+                state['temps'][i] = new.config[key]
+    new.restore_state(state)
+    new.set_current_power(carried_power(new, old.get_current_power()))
+    return True
+
+
+class EquipmentConfigWatcher:
+    """ Call apply(entries) with the validated entries of config_file each time it changes """
+
+    def __init__(self, config_file, apply, interval=5.0):
+        self.config_file = config_file
+        self.apply = apply
+        self.interval = interval
+        self._signature = self._stat()
+        self._timer = None
+
+        # counters
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def check(self):
+        """ Read the file if it changed since the last check, return True if a new version was passed to apply() """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            entries = read_equipment_config(self.config_file)
+        except Exception as e:
+            # the file may also be in the middle of being written, it is read again on its next change
+            self.errors += 1
+            self.last_error = str(e)
+            debug(0, "invalid equipment configuration {}, not applied: {}".format(self.config_file, e))
+            return False
+        self.reloads += 1
+        self.apply(entries)
+        return True
+
+    def start(self):
+        if self._timer is None:
+            self._timer = clock.repeat(self.interval, self.check)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def stats(self):
+        return {
+            'reloads': self.reloads,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
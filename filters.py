@@ -0,0 +1,127 @@
+# Streaming filters of the power measurements.
+#
+# on_message used to store the raw SINSTI/SINSTS values in the state read by evaluate(), so a single frame spike (a
+# kettle, the inrush current of a compressor) was enough to shed and then restore the SCR loads. A pipeline of
+# filters can be put on each channel, each one with an O(1) (or O(window) for a small window) cost per sample:
+# - ewma:<alpha>: exponentially weighted moving average, y += alpha * (x - y)
+# - median:<window>: running median of the last `window` samples
+# - spike:<threshold>[:<confirm>]: a sample which moved by more than threshold watts from the last accepted one is
+#   replaced by the last accepted one, unless `confirm` consecutive samples (default 2) agree on the new level (all
+#   within threshold watts of each other), in which case the change is real and it's accepted
+# A pipeline is written as a comma separated list, applied from left to right, for instance "spike:1500,median:3".
+
+from bisect import insort
+from collections import deque
+
+
+class Ewma:
+    def __init__(self, alpha=0.5):
+        self.alpha = alpha
+        self.value = None
+
+    def __call__(self, x):
+        if self.value is None:
+            self.value = float(x)
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class RunningMedian:
+    def __init__(self, window=3):
+        self.window = window
+        self._samples = deque()
+        self._sorted = []
+
+    def __call__(self, x):
+        self._samples.append(x)
+        insort(self._sorted, x)
+        if len(self._samples) > self.window:
+            old = self._samples.popleft()
+            del self._sorted[self._sorted.index(old)]
+        n = len(self._sorted)
+        if n % 2:
+            return float(self._sorted[n // 2])
+        return (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2.0
+
+
+class SpikeRejector:
+    def __init__(self, threshold=1500, confirm=2):
+        self.threshold = threshold
+        self.confirm = confirm
+        self.value = None
+        # consecutive samples away from the accepted value, and their range
+        self._pending = 0
+        self._low = None
+        self._high = None
+
+        # counters
+        self.rejected = 0
+
+    def __call__(self, x):
+        if self.value is None or abs(x - self.value) <= self.threshold:
+            self.value = x
+            self._pending = 0
+            return x
+        if self._pending and max(self._high, x) - min(self._low, x) <= self.threshold:
+            self._pending += 1
+            self._low = min(self._low, x)
+            self._high = max(self._high, x)
+        else:
+            # the first sample away from the accepted value, or one which doesn't agree with the previous ones
+            self._pending = 1
+            self._low = self._high = x
+        if self._pending >= self.confirm:
+            # the new level lasts, it's not a spike
+            self.value = x
+            self._pending = 0
+            return x
+        self.rejected += 1
+        return self.value
+
+
+FILTERS = {
+    'ewma': (Ewma, float),
+    'median': (RunningMedian, int),
+    'spike': (SpikeRejector, float),
+}
+
+
+class FilterPipeline:
+    def __init__(self, filters=()):
+        self.filters = list(filters)
+        self.raw = None
+        self.value = None
+
+    def __call__(self, x):
+        self.raw = x
+        for f in self.filters:
+            x = f(x)
+        self.value = x
+        return x
+
+    def __bool__(self):
+        return bool(self.filters)
+
+    def stats(self):
+        return {
+            'raw': self.raw,
+            'filtered': self.value,
+            'rejected': sum(getattr(f, 'rejected', 0) for f in self.filters),
+        }
+
+
+def parse_pipeline(spec):
+    """ Return the FilterPipeline described by spec ("spike:1500,median:3"), raise ValueError if it is invalid """
+    filters = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, *args = item.split(':')
+        if name not in FILTERS:
+            raise ValueError("unknown filter {!r}".format(name))
+        cls, arg_type = FILTERS[name]
+        # the optional second argument of spike is a number of samples
+        filters.append(cls(*[arg_type(a) if i == 0 else int(a) for i, a in enumerate(args)]))
+    return FilterPipeline(filters)
@@ -0,0 +1,98 @@
+# Power estimation from the energy indexes of the meter.
+#
+# The TIC gives energy counters in Wh (EAST, EASF01/02, EAIT, ERQ1..4) which only move once per Wh: at 80 W, the
+# index changes every 45 s. The regulation used to turn the reactive index into a power with fixed thresholds (wait for
+# 5 Wh, or 2 Wh in a minute, or report 0 after 2 minutes without 2 Wh), which left the power unchanged for up to 2
+# minutes. IndexPowerEstimator follows one counter:
+# - the transitions of the index (first sample showing a new value) are the points where the energy crossed an
+#   integer, they are on the energy curve within a sample period, whatever the power. The power is the least-squares
+#   slope of the transitions of the last `window` seconds, the 2 last transitions being kept whatever their age, so
+#   that a low power is still measured with 2 transitions
+# - as long as the index doesn't move, less than 1 Wh has been used since the last transition: the power is at most
+#   3600 / (seconds since the last transition), which brings the estimate down as soon as the index stalls for longer
+#   than expected, and to 0 W over time
+# - an index going backwards (meter reset) restarts the estimation
+# The slope is only computed on a transition, from timestamps and indexes relative to the oldest transition, so that
+# the sums keep their precision with epoch timestamps and 9 digits indexes.
+
+from collections import deque
+
+
+class IndexPowerEstimator:
+    def __init__(self, window=30.0):
+        self.window = window
+        self._transitions = deque()
+        # (ts, index) of the last sample, timestamp of the first sample
+        self._last = None
+        self._start = None
+        self._slope = None
+        self.power = None
+
+    def reset(self):
+        self._transitions.clear()
+        self._last = None
+        self._start = None
+        self._slope = None
+        self.power = None
+
+    def add(self, ts, index):
+        """ Add a sample of the counter (Wh) and return the estimated power in W, None until it is known """
+        last = self._last
+        if last is not None and (index < last[1] or ts < last[0]):
+            self.reset()
+            last = None
+        if last is None:
+            self._start = ts
+        elif index != last[1]:
+            transitions = self._transitions
+            transitions.append((ts, index))
+            while len(transitions) > 2 and transitions[0][0] < ts - self.window:
+                transitions.popleft()
+            self._slope = self._fit()
+        self._last = (ts, index)
+        self.power = self._estimate(ts)
+        return self.power
+
+    def _fit(self):
+        transitions = self._transitions
+        n = len(transitions)
+        if n < 2:
+            return None
+        t0, x0 = transitions[0]
+        st = sx = stt = stx = 0.0
+        for ts, x in transitions:
+            t = ts - t0
+            x -= x0
+            st += t
+            sx += x
+            stt += t * t
+            stx += t * x
+        d = n * stt - st * st
+        if d <= 0:
+            return None
+        # Wh per second to W
+        return max(0.0, (n * stx - st * sx) / d * 3600)
+
+    def _estimate(self, ts):
+        since = ts - (self._transitions[-1][0] if self._transitions else self._start)
+        if self._slope is None:
+            # not enough transitions yet, a stalled index still bounds the power
+            return 3600.0 / since if since >= self.window else None
+        if since > 0:
+            return min(self._slope, 3600.0 / since)
+        return self._slope
+
+    def get_state(self):
+        # copied at once, the transitions may be added by another thread (MQTT) meanwhile
+        return {'transitions': list(self._transitions.copy()), 'last': self._last, 'start': self._start}
+
+    def restore_state(self, state):
+        self.reset()
+        if not state:
+            return
+        self._transitions = deque((ts, index) for ts, index in state['transitions'])
+        self._last = tuple(state['last']) if state['last'] else None
+        self._start = state['start']
+        self._slope = self._fit()
+        if self._last is not None:
+            self.power = self._estimate(self._last[0])
@@ -0,0 +1,96 @@
+# Subset selection of constant power equipments.
+#
+# The greedy loop turns on a ConstantPowerEquipment only if the remaining available power covers its nominal power,
+# strictly in priority order: with plugs of mixed powers a large part of the surplus may be left unused (a 1500W plug
+# which doesn't fit stops nothing, but a 800W + 600W combination is never considered once a 300W one is on).
+#
+# ConstantLoadSelector solves a 0/1 knapsack over the constant equipments which are off and may be switched on: it
+# picks the combination which uses the most of the available power without exceeding it, and among the combinations
+# using the same power the one with the highest priorities. Powers are counted in units of `resolution` watts,
+# rounded up so that a selection never exceeds the available power.
+#
+# The dynamic programming table only depends on the powers of the candidate equipments, not on the available power:
+# it's computed once for given powers (and kept in a small cache), each evaluation is then a lookup and a backtracking
+# over the candidates, i.e. O(number of candidates).
+
+from collections import OrderedDict
+
+from debug import debug as debug
+
+
+class ConstantLoadSelector:
+    def __init__(self, resolution=10, cache_size=16):
+        self.resolution = resolution
+        self.cache_size = cache_size
+        self._tables = OrderedDict()
+
+        # counters
+        self.selections = 0
+        self.tables_built = 0
+
+    def _weight(self, e):
+        return -(-int(e.nominal_power) // self.resolution)
+
+    def _table(self, candidates):
+        # the table only depends on the weights of the candidates, in priority order: equipments rebuilt by a reload
+        # of the configuration with the same powers share it, a changed power never reuses it
+        weights = [self._weight(e) for e in candidates]
+        key = tuple(weights)
+        table = self._tables.get(key)
+        if table is not None:
+            self._tables.move_to_end(key)
+            return table
+
+        n = len(candidates)
+        # the filled power always prevails, the priority bonus (higher for the first candidates) only breaks ties
+        scale = n * n + 1
+        total = sum(weights)
+        best = [0] * (total + 1)
+        keep = []
+        for i, w in enumerate(weights):
+            value = w * scale + (n - i)
+            row = bytearray(total + 1)
+            for c in range(total, w - 1, -1):
+                v = best[c - w] + value
+                if v > best[c]:
+                    best[c] = v
+                    row[c] = 1
+            keep.append(row)
+
+        table = (weights, keep, total)
+        self._tables[key] = table
+        self.tables_built += 1
+        if len(self._tables) > self.cache_size:
+            self._tables.popitem(last=False)
+        return table
+
+    def select(self, candidates, available_power):
+        """ Return the list of candidates to switch on to use at most available_power """
+        if not candidates or available_power <= 0:
+            return []
+        weights, keep, total = self._table(candidates)
+        c = min(int(available_power // self.resolution), total)
+        selected = []
+        for i in range(len(candidates) - 1, -1, -1):
+            if keep[i][c]:
+                selected.append(candidates[i])
+                c -= weights[i]
+        selected.reverse()
+        self.selections += 1
+        return selected
+
+    def switch_on(self, candidates, available_power):
+        """ Turn on the best combination of candidates, return the amount of power that is left to use """
+        selected = self.select(candidates, available_power)
+        for e in selected:
+            available_power = e.increase_power_by(available_power)
+        debug(2, "{} of {} constant equipments turned on, {}W left".format(len(selected), len(candidates),
+                                                                           available_power))
+        return available_power
+
+    def stats(self):
+        return {
+            'selections': self.selections,
+            'tables_built': self.tables_built,
+            'cached_tables': len(self._tables),
+        }
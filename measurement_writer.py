@@ -0,0 +1,250 @@
+# Batched and asynchronous InfluxDB writer.
+# Measurements are pushed in a bounded in-memory queue and a background thread sends them to InfluxDB in batches,
+# either when a batch is full or when the oldest queued point is older than the flush interval. This way a slow
+# database never blocks the MQTT network thread nor the regulation loop. When the queue is full, the oldest points
+# are dropped (and counted).
+# With a spool (spool.DiskSpool), the batches which could not be written are stored on disk instead of being dropped,
+# and the next batches go straight to the spool until retry_interval seconds have passed. Once a write succeeds
+# again, the spooled points are sent in bulk. The database is prepared (created if needed) by the prepare callable
+# before the first write, in the writer thread, so that the startup never waits for InfluxDB.
+# Only the failures which may succeed later are spooled (connection errors, timeouts, 5xx answers): a batch rejected
+# by InfluxDB (4xx answer, a field type conflict or points older than the retention policy for instance) would be
+# rejected again, it is dropped and counted instead of blocking the batches spooled behind it.
+# A point has a "retention_policy" key, the raw measurements go to RAW_RETENTION_POLICY and the rollups to theirs (see
+# rollup.py): the points of a batch are written with one request per retention policy. The raw measurements name
+# their policy instead of relying on the default one, which is left as it is (one_year on the former installations)
+# with the history written before the rollups.
+
+import threading
+import time
+from collections import deque
+
+from debug import debug as debug
+
+# Tags attached to every point, used to identify the probe and the meter
+DEFAULT_TAGS = {
+    "host": "raspberry",
+    "region": "linky"
+}
+
+# Retention policy of the raw measurements, kept for a short time only
+RAW_RETENTION_POLICY = 'raw'
+
+
+def make_point(measurement, value, ts=None, tags=DEFAULT_TAGS):
+    """ Build an InfluxDB point of the raw retention policy with a numeric timestamp in milliseconds """
+    if ts is None:
+        ts = time.time()
+    return {
+        "measurement": measurement,
+        "tags": tags,
+        "time": int(ts * 1000),
+        "fields": {
+            "value": value
+        },
+        "retention_policy": RAW_RETENTION_POLICY,
+    }
+
+
+# 4xx answers which are worth retrying (request timeout, too many requests)
+RETRYABLE_CODES = (408, 429)
+
+
+def is_rejected(e):
+    """ Return True if the write failed because InfluxDB rejected the points (HTTP 4xx), writing them again is useless """
+    code = getattr(e, 'code', None)
+    return isinstance(code, int) and 400 <= code < 500 and code not in RETRYABLE_CODES
+
+
+def split_by_retention(points):
+    """ Return [(retention policy, points)], None being the default policy, in the order of the points """
+    groups = {}
+    for p in points:
+        groups.setdefault(p.get('retention_policy'), []).append(p)
+    return list(groups.items())
+
+
+class MeasurementWriter:
+    def __init__(self, client, batch_size=500, flush_interval=2.0, max_queue=10000, spool=None, retry_interval=30.0,
+                 prepare=None):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.prepare = prepare
+        self._prepared = prepare is None
+        self._retry_at = None
+
+        self._queue = deque()
+        self._oldest_ts = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+        # counters
+        self.points_enqueued = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.points_failed = 0
+        self.points_rejected = 0
+        self.queue_max_depth = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def add(self, measurement, value, ts=None, tags=DEFAULT_TAGS):
+        self.write(make_point(measurement, value, ts, tags))
+
+    def write(self, point):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.points_dropped += 1
+            if not self._queue:
+                self._oldest_ts = time.monotonic()
+            self._queue.append(point)
+            self.points_enqueued += 1
+            depth = len(self._queue)
+            if depth > self.queue_max_depth:
+                self.queue_max_depth = depth
+            if depth >= self.batch_size:
+                self._cond.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='measurement-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and len(self._queue) < self.batch_size:
+                    if self._oldest_ts is None:
+                        timeout = self.flush_interval
+                    else:
+                        timeout = self.flush_interval - (time.monotonic() - self._oldest_ts)
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+            self.flush()
+
+    def _take_batch(self):
+        with self._cond:
+            n = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(n)]
+            self._oldest_ts = time.monotonic() if self._queue else None
+            return batch
+
+    def _offline(self):
+        """ Return True while the batches must go straight to the spool, after a failed write """
+        if self._retry_at is None:
+            return False
+        if time.monotonic() >= self._retry_at:
+            self._retry_at = None
+            return False
+        return True
+
+    def _write_points(self, points):
+        if not self._prepared:
+            self.prepare()
+            self._prepared = True
+        for retention_policy, group in split_by_retention(points):
+            self.client.write_points(group, time_precision='ms', retention_policy=retention_policy)
+
+    def _failed(self, batch, e):
+        self.points_failed += len(batch)
+        if is_rejected(e):
+            self.points_rejected += len(batch)
+            debug(0, "{} points rejected by InfluxDB, dropped: {}".format(len(batch), e))
+            return
+        if self.spool is None:
+            debug(0, "unable to write {} points: {}".format(len(batch), e))
+            return
+        debug(0, "unable to write {} points, spooled, next try in {}s: {}".format(len(batch), self.retry_interval, e))
+        self.spool.append(batch)
+        self._retry_at = time.monotonic() + self.retry_interval
+
+    def _batch_sent(self, batch, start):
+        latency = time.monotonic() - start
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    def drain_spool(self):
+        """ Send the spooled points in bulk. Return the number of points written """
+        if self.spool is None or not self.spool.pending() or self._offline():
+            return 0
+        try:
+            written = self.spool.drain(self._write_points, rejected=is_rejected)
+        except Exception as e:
+            debug(0, "unable to drain the spool, next try in {}s: {}".format(self.retry_interval, e))
+            self._retry_at = time.monotonic() + self.retry_interval
+            return 0
+        debug(0, "{} spooled points written".format(written))
+        return written
+
+    def flush(self):
+        """ Send every queued point, batch by batch. Return the number of points written """
+        written = 0
+        with self._flush_lock:
+            batch = self._take_batch()
+            while batch:
+                if self.spool is not None and self._offline():
+                    self.spool.append(batch)
+                    batch = self._take_batch()
+                    continue
+                start = time.monotonic()
+                try:
+                    self._write_points(batch)
+                except Exception as e:
+                    self._failed(batch, e)
+                else:
+                    written += len(batch)
+                    self.points_written += len(batch)
+                self._batch_sent(batch, start)
+                batch = self._take_batch()
+            self.drain_spool()
+        return written
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self._queue),
+            'queue_max_depth': self.queue_max_depth,
+            'points_enqueued': self.points_enqueued,
+            'points_written': self.points_written,
+            'points_dropped': self.points_dropped,
+            'points_failed': self.points_failed,
+            'points_rejected': self.points_rejected,
+            'batches': self.batches,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'last_flush_latency': round(self.last_flush_latency, 4),
+            'max_flush_latency': round(self.max_flush_latency, 4),
+            'avg_flush_latency': round(self.total_flush_latency / self.batches, 4) if self.batches else 0.0,
+            'spool': self.spool.stats() if self.spool is not None else None,
+        }
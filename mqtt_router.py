@@ -0,0 +1,82 @@
+# MQTT topic routing.
+# The router is built once at startup from the loaded equipments. Equipment topics are subscribed with wildcards
+# (scr/+/temperature for instance) and every concrete topic (scr/0/temperature) is mapped to its handler and equipment
+# in a dict, so that dispatching a message costs a single lookup whatever the number of equipments and topics.
+# Control payloads are parsed with a small command grammar: "ON", "OFF", "AUTO", "MIN;<temp>", "MAX;<temp>",
+# "ECO;<temp>".
+
+from debug import debug as debug
+
+# command name -> type of its argument, None when the command has no argument
+COMMANDS = {
+    'ON': None,
+    'OFF': None,
+    'AUTO': None,
+    'MIN': float,
+    'MAX': float,
+    'ECO': float,
+}
+
+
+def parse_command(payload):
+    """ Return (command, argument) from a control payload, raise ValueError if it is invalid """
+    command, sep, arg = payload.strip().partition(';')
+    if command not in COMMANDS:
+        raise ValueError("unknown command {!r}".format(payload))
+    arg_type = COMMANDS[command]
+    if arg_type is None:
+        return command, None
+    if not sep:
+        raise ValueError("missing argument for command {!r}".format(payload))
+    return command, arg_type(arg)
+
+
+class TopicRouter:
+    def __init__(self):
+        self.subscriptions = []
+        self._topics = {}
+        self._equipment_patterns = []
+        self._routes = {}
+        self.unrouted = 0
+
+    def add_topic(self, topic, handler):
+        """ handler(payload) is called for messages received on topic """
+        self._topics[topic] = handler
+        self.subscriptions.append(topic)
+
+    def add_equipment_topic(self, pattern, handler):
+        """ pattern contains a single '+' standing for the equipment id, handler(equipment, payload) is called """
+        self._equipment_patterns.append((pattern, handler))
+        self.subscriptions.append(pattern)
+
+    def set_equipments(self, equipments):
+        """ (Re)build the routing table, to be called whenever the list of equipments changes """
+        routes = {}
+        for topic, handler in self._topics.items():
+            routes[topic] = (handler, None)
+        for pattern, handler in self._equipment_patterns:
+            for e in equipments:
+                routes[pattern.replace('+', str(e.id))] = (handler, e)
+        self._routes = routes
+
+    def topics(self):
+        """ Return the concrete topics which have a route """
+        return list(self._routes)
+
+    def subscribe(self, client):
+        for topic in self.subscriptions:
+            client.subscribe(topic)
+
+    def dispatch(self, topic, payload):
+        """ Call the handler of the topic, return False if there is none """
+        route = self._routes.get(topic)
+        if route is None:
+            self.unrouted += 1
+            debug(0, "no route for topic {}".format(topic))
+            return False
+        handler, e = route
+        if e is None:
+            handler(payload)
+        else:
+            handler(e, payload)
+        return True
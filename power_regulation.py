@@ -33,10 +33,17 @@
 # See the "equipment module" for the definitions of the loads.
 
 
+# Several sites (households) can be regulated by the same process: each one is a Regulator holding its own
+# measurements, equipments, publishers and worker, with its own topic prefix. They share the MQTT connection, the
+# InfluxDB writer (points are tagged with the site name) and the tariff calendar. Sites are listed in the file given
+# by SITES_CONFIG, without it a single site without prefix is regulated, as before.
+
+
+import functools
 import json
-import time
-import pytz
+import os
 import math
+import signal
 from datetime import datetime
 
 from influxdb import InfluxDBClient
@@ -44,9 +51,36 @@ import paho.mqtt.client as mqtt
 
 # Initialize InfluxDB client
 from config import (INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_USERNAME,
-                   INFLUXDB_PASSWORD, INFLUXDB_DATABASE, HC_START_TIME, HC_END_TIME)
+                   INFLUXDB_PASSWORD, INFLUXDB_DATABASE, HC_WINDOWS, HC_WEEKEND_WINDOWS, HC_HOLIDAY_WINDOWS,
+                   HC_HOLIDAYS, HC_TIMEZONE, ALLOCATION_ENGINE, CONSTANT_ALLOCATION, KNAPSACK_RESOLUTION,
+                   COMMAND_DEADBAND, COMMAND_MIN_INTERVAL, COMMAND_KEEPALIVE,
+                   STATUS_HEARTBEAT, STATUS_ENCODING, STATUS_POWER_TOLERANCE, STATUS_ENERGY_TOLERANCE,
+                   SERIES_MAX_INTERVAL, SITES_CONFIG, REGULATION_ENGINE,
+                   MEASUREMENT_BATCH_SIZE, MEASUREMENT_FLUSH_INTERVAL, MEASUREMENT_QUEUE_SIZE,
+                   SPOOL_DIR, SPOOL_MAX_SIZE, SPOOL_SEGMENT_SIZE, SPOOL_RETRY_INTERVAL,
+                   HISTORY_DURATION, HISTORY_RESOLUTION, HISTORY_RECENT, HISTORY_COARSE_RESOLUTION,
+                   CHECKPOINT_FILE, CHECKPOINT_INTERVAL, CHECKPOINT_MAX_AGE, CONTROLLER,
+                   CONTROLLER_SETTLE_TIME, INJECTED_FILTERS, CONSUMED_FILTERS, INDEX_POWER_WINDOW,
+                   INFLUXDB_RAW_RETENTION, INFLUXDB_ROLLUP_MINUTE_RETENTION, INFLUXDB_ROLLUP_HOUR_RETENTION,
+                   EQUIPMENT_CONFIG_RELOAD_INTERVAL)
 
 from debug import debug as debug
+import clock
+from checkpoint import Checkpointer, load_checkpoint
+from command_publisher import CommandPublisher
+from controller import make_controller
+from equipment_reload import EquipmentConfigWatcher, carry_state, diff_equipments
+from filters import parse_pipeline
+from index_estimator import IndexPowerEstimator
+from knapsack import ConstantLoadSelector
+from measurement_writer import DEFAULT_TAGS, MeasurementWriter
+from mqtt_router import TopicRouter, parse_command
+from regulation_worker import RegulationWorker
+from rollup import Rollups, create_retention_policies
+from spool import DiskSpool
+from status_publisher import SeriesFilter, StatusPublisher
+from tariff import TariffCalendar, parse_windows, parse_dates
+from timeseries import TimeSeriesStore
 import equipment
 from equipment import ConstantPowerEquipment, UnknownPowerEquipment, VariablePowerEquipment,TempDrivenVariablePowerEquipment
 
@@ -61,343 +95,742 @@ BALANCE_THRESHOLD = 50
 # knowing that there may be measurement inaccuracy.
 MARGIN = 20
 
-# A debug switch to toggle simulation (uses distinct MQTT topics for instance)
-SIMULATION = False
-
-last_evaluation_date = None
-
-power_available = 0 
-power_available_active = 0
-power_consumed = 0
-power_consumed_tot = 0
-power_reactive = 0
-previous_index_CR = 0
-previous_ts_CR = None
+# The per-label measurements (tic/SINSTI...) are ignored while combined frames (tic/frame) are received, a frame older
+# than this (seconds) lets them through again
+FRAME_TIMEOUT = 10
 
-mqtt_client = None
+# Measurements aggregated per minute and per hour (rollup.py), in addition to the power and temperature of each
+# equipment
+ROLLUP_MEASUREMENTS = frozenset(("power_available", "power_consumed_tot", "power_consumed", "power_available_active",
+                                 "power_reactive"))
 
-equipments = None
-equipment_water_heater = None
+# A debug switch to toggle simulation (uses distinct MQTT topics for instance)
+SIMULATION = False
 
-# MQTT topics on which to subscribe and send messages
+# MQTT topics on which to subscribe and send messages, relative to the prefix of the site
 prefix = 's/' if SIMULATION else ''
 TOPIC_INJECTED = prefix + "tic/SINSTI"
 TOPIC_CONSUMED = prefix + "tic/SINSTS"
 TOPIC_CONSUMED_REACTIVE = prefix + "tic/ERQT"
-TOPIC_WATER_HEATER_TEMP = "scr/0/temperature"
+TOPIC_FRAME = prefix + "tic/frame"
+TOPIC_EQUIPMENT_TEMP = "scr/+/temperature"
+TOPIC_EQUIPMENT_CONTROL = "scr/+/control"
 TOPIC_STATUS = prefix + "regulation/status"
+TOPIC_HISTORY_QUERY = prefix + "regulation/history/query"
+TOPIC_HISTORY_RESULT = prefix + "regulation/history/result"
 
-# connexion a la base de données InfluxDB
-client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, database=INFLUXDB_DATABASE)
+# regulated sites, and the site of each topic they receive messages on, see main()
+regulators = []
+topic_sites = {}
+
+
+def connect_database(client):
+    # called by the measurement writer before its first write, an exception (InfluxDB not reachable) makes it spool
+    # the points and call it again later, the startup never waits for the database
+    print("Database %s exists?" % INFLUXDB_DATABASE)
+    if not {'name': INFLUXDB_DATABASE} in client.get_list_database():
+        print("Database %s creation.." % INFLUXDB_DATABASE)
+        client.create_database(INFLUXDB_DATABASE)
+        print("Database %s created!" % INFLUXDB_DATABASE)
+    client.switch_database(INFLUXDB_DATABASE)
+    create_retention_policies(client, INFLUXDB_DATABASE, INFLUXDB_RAW_RETENTION, INFLUXDB_ROLLUP_MINUTE_RETENTION,
+                              INFLUXDB_ROLLUP_HOUR_RETENTION)
+    print("Connected to %s!" % INFLUXDB_DATABASE)
+
+
+def open_spool(name):
+    """ Return the disk spool of the points which could not be written, None when disabled """
+    if not SPOOL_DIR:
+        return None
+    return DiskSpool(os.path.join(SPOOL_DIR, name), max_size=SPOOL_MAX_SIZE * 1024 * 1024,
+                     segment_size=SPOOL_SEGMENT_SIZE * 1024)
+
+# off-peak hours, the transitions are precomputed by the calendar
+tariff_calendar = TariffCalendar(parse_windows(HC_WINDOWS), parse_windows(HC_WEEKEND_WINDOWS),
+                                 parse_windows(HC_HOLIDAY_WINDOWS), parse_dates(HC_HOLIDAYS), HC_TIMEZONE)
 
-connected = False
-while not connected:
-    try:
-        print("Database %s exists?" % INFLUXDB_DATABASE)
-        if not {'name': INFLUXDB_DATABASE} in client.get_list_database():
-            print("Database %s creation.." % INFLUXDB_DATABASE)
-            client.create_database(INFLUXDB_DATABASE)
-            print("Database %s created!" % INFLUXDB_DATABASE)
-        client.switch_database(INFLUXDB_DATABASE)
-        print("Connected to %s!" % INFLUXDB_DATABASE)
-    except Exception:
-        print('InfluxDB is not reachable. Waiting 5 seconds to retry.')
-        time.sleep(5)
-    else:
-        connected = True
 
 def HC_ok():
-    tz = pytz.timezone('Europe/Paris')
-    now = datetime.now(tz)
-    current_time = now.strftime("%H:%M")
-    
-    if is_between(current_time, (HC_START_TIME, HC_END_TIME)):
-       return True
-    else:
-       return False
-
-def is_between(time, time_range):
-    if time_range[1] < time_range[0]:
-        return time >= time_range[0] or time <= time_range[1]
-    return time_range[0] <= time <= time_range[1]
-
-def add_measures(key,val):
-  try:
-    points = []
-    point = {
-        "measurement": key,
-        "tags": {
-           # identification de la sonde et du compteur
-           "host": "raspberry",
-           "region": "linky"
-        },
-       "time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-       "fields": {
-           "value": val
-       }
-    }
-    #print(point)
-    points.append(point)
-    client.write_points(points)
-  except Exception as e:
-    debug(0, e)
+    return tariff_calendar.is_off_peak(now_ts())
 
 def now_ts():
-    # python2 support
-    return time.time()
+    return clock.now()
 
 
-def get_equipment_by_id(id):
-    for e in equipments:
-        if e.id == int(id):
-            return e
-    return None
-
 def set_instant_power(power):
     return power
 
-def evaluate_power(previous_ts, previous_index,current_index,power):
-    current_ts = now_ts()
-
-    if previous_ts is not None:
-       delta_ts = current_ts - previous_ts
-       delta_index = current_index - previous_index
-       if delta_index > 4: #on attend d'avoir au moins 5 W
-          power = round(delta_index / delta_ts * 3600)
-          previous_ts = current_ts
-          previous_index = current_index
-       elif delta_ts > 60 and delta_index > 1: # ou bien 2w en plus d'1 minute cad max 60wh
-          power = round(delta_index / delta_ts * 3600)
-          previous_ts = current_ts
-          previous_index = current_index
-       elif delta_ts > 120: # ou bien pls de 2 minutes on considere 0w
-          power = 0.00
-          previous_ts = current_ts
-          previous_index = current_index
-    else:
-       previous_ts = current_ts
-       previous_index = current_index
-    return [previous_ts, previous_index,current_index,float(power)]
+
+def control_on(e, arg):
+    e.setManualMode()
+    e.switchOn()
+
+
+def control_off(e, arg):
+    e.setManualMode()
+    e.switchOff()
+
+
+CONTROL_HANDLERS = {
+    'ON': control_on,
+    'OFF': control_off,
+    'AUTO': lambda e, arg: e.setAutoMode(),
+    'MIN': lambda e, arg: e.setMinTemp(arg),
+    'MAX': lambda e, arg: e.setMaxTemp(arg),
+    'ECO': lambda e, arg: e.setEcoTemp(arg),
+}
+
+
+class Regulator:
+    """ Regulation of one site: its measurements, equipments, command and status publishers and worker """
+
+    def __init__(self, measurement_writer, name='', prefix='', equipment_config='equipment_config.yml',
+                 history_duration=HISTORY_DURATION, history_recent=HISTORY_RECENT):
+        self.name = name
+        self.prefix = prefix
+        self.equipment_config = equipment_config
+        self.topic_injected = prefix + TOPIC_INJECTED
+        self.topic_consumed = prefix + TOPIC_CONSUMED
+        self.topic_consumed_reactive = prefix + TOPIC_CONSUMED_REACTIVE
+        self.topic_frame = prefix + TOPIC_FRAME
+        self.label_topics = {self.topic_injected, self.topic_consumed, self.topic_consumed_reactive}
+        self.topic_equipment_temp = prefix + TOPIC_EQUIPMENT_TEMP
+        self.topic_equipment_control = prefix + TOPIC_EQUIPMENT_CONTROL
+        self.topic_status = prefix + TOPIC_STATUS
+        self.topic_history_query = prefix + TOPIC_HISTORY_QUERY
+        self.topic_history_result = prefix + TOPIC_HISTORY_RESULT
+
+        # (power_available, power_consumed_tot, power_reactive) read by evaluate(): the tuple is replaced in a single
+        # assignment by the MQTT thread, so that an evaluation never mixes the measurements of two frames
+        self.measures = (0, 0, 0)
+        self.power_available_active = 0
+        self.power_consumed = 0
+        # date of the last combined frame, see on_frame()
+        self.last_frame_date = None
+        self.frames = 0
+        self.invalid_frames = 0
+        self.labels_ignored = 0
+
+        # Specific fallback: the energy put in the water heater yesterday
+        self.energy_yesterday = 0
+
+        self.mqtt_client = None
+        self.equipments = ()
+        self.router = None
+        # watcher of the equipment configuration file, see watch_equipment_config()
+        self.config_watcher = None
+        self.on_reload = None
+
+        # measurements are queued and written in batches by a background thread shared by the sites
+        self.measurement_writer = measurement_writer
+        self.tags = dict(DEFAULT_TAGS, site=name) if name else DEFAULT_TAGS
+
+        # equipment commands go through this publisher (deadband, rate limit, keepalive)
+        self.command_publisher = CommandPublisher(None, deadband=COMMAND_DEADBAND, min_interval=COMMAND_MIN_INTERVAL,
+                                                  keepalive=COMMAND_KEEPALIVE)
+
+        # the status is published on change (and at a heartbeat)
+        self.status_publisher = StatusPublisher(None, self.topic_status, heartbeat=STATUS_HEARTBEAT,
+                                                power_tolerance=STATUS_POWER_TOLERANCE,
+                                                energy_tolerance=STATUS_ENERGY_TOLERANCE, encoding=STATUS_ENCODING)
+        self.series_filter = SeriesFilter(SERIES_MAX_INTERVAL)
+
+        # filters of the SINSTI and SINSTS measurements, see filters.py
+        self.injected_filter = parse_pipeline(INJECTED_FILTERS)
+        self.consumed_filter = parse_pipeline(CONSUMED_FILTERS)
+
+        # reactive power derived from the ERQT index, see index_estimator.py
+        self.reactive_estimator = IndexPowerEstimator(INDEX_POWER_WINDOW)
+
+        # recent history of the measurements and of the equipments, see query_history()
+        self.history = TimeSeriesStore(history_duration, HISTORY_RESOLUTION, history_recent, HISTORY_COARSE_RESOLUTION)
+
+        # 1 minute and 1 hour aggregates of the powers, the temperatures and the power of the equipments, see rollup.py
+        self.rollups = Rollups(tags=self.tags)
+
+        # subset selection of the constant equipments in the greedy loop, None to switch them on one by one
+        if CONSTANT_ALLOCATION == 'knapsack':
+            self.constant_selector = ConstantLoadSelector(KNAPSACK_RESOLUTION)
+        else:
+            self.constant_selector = None
+
+        # allocation engine used by evaluate(), None for the greedy loops below
+        if ALLOCATION_ENGINE == 'numpy':
+            from allocation import VectorAllocator
+            self.allocator = VectorAllocator()
+        else:
+            self.allocator = None
+
+        # power to add or remove at each evaluation, see controller.py
+        self.controller = make_controller(CONTROLLER, deadband=BALANCE_THRESHOLD, settle_time=CONTROLLER_SETTLE_TIME)
+        # date of the last power measurement, the corrections applied since are not measured yet
+        self.measure_ts = None
+
+        # evaluations are run by a dedicated thread, see start()
+        self.regulation_worker = RegulationWorker(self.evaluate, EVALUATION_PERIOD)
+
+    def setup(self, mqtt_client, equipments):
+        """ Attach the MQTT client and the equipments, and build the topic routes """
+        self.mqtt_client = mqtt_client
+        self.command_publisher.client = mqtt_client
+        self.status_publisher.client = mqtt_client
+        for e in equipments:
+            e.topic_prefix = self.prefix
+            e.publisher = self.command_publisher
+        self.equipments = tuple(equipments)
+        self.router = self.build_router(self.equipments)
+        if hasattr(self.controller, 'set_equipments'):
+            self.controller.set_equipments(self.equipments)
+
+    def load_equipments(self, mqtt_client, checkpoint=None):
+        # Load equipment configurations from YAML file
+        from equipment_loader import load_equipment_from_config
+        self.setup(mqtt_client, load_equipment_from_config(self.equipment_config))
+
+        # At startup, reset everything, unless the state saved by the previous run is available (warm restart): the
+        # energy counters, modes and temperatures are restored, and the power set points too if the checkpoint is
+        # recent enough
+        state = checkpoint['sites'].get(self.name) if checkpoint else None
+        saved = {}
+        resume = False
+        if state is not None:
+            self.restore_state(state)
+            saved = state['equipments']
+            resume = now_ts() - checkpoint['date'] <= CHECKPOINT_MAX_AGE
+            debug(0, "warm restart{}: {} equipment(s) restored, set points {}".format(
+                ' of ' + self.name if self.name else '', len(set(saved) & set(e.name for e in self.equipments)),
+                'resumed' if resume else 'reset (checkpoint too old)'))
+        for e in self.equipments:
+            if e.name in saved:
+                e.restore_state(saved[e.name])
+                e.set_current_power(saved[e.name]['current_power'] if resume else 0)
+            else:
+                e.set_current_power(0)
+
+    def watch_equipment_config(self, interval, on_reload=None):
+        """ Reload the equipment configuration file when it changes, on_reload() is called after a new version is
+        applied """
+        self.on_reload = on_reload
+        self.config_watcher = EquipmentConfigWatcher(
+            self.equipment_config, lambda entries: self.regulation_worker.submit(lambda: self.reload_equipments(entries)),
+            interval)
+        self.config_watcher.start()
+
+    def reload_equipments(self, entries):
+        """ Apply a new version of the equipment configuration, see equipment_reload.py. Run by the regulation
+        thread, never concurrently with an evaluation """
+        from equipment_loader import create_equipment
+        added, removed, changed = diff_equipments(self.equipments, entries)
+        if not (added or removed or changed) and [e.id for e in self.equipments] == [entry['id'] for entry in entries]:
+            return
+        current = {e.id: e for e in self.equipments}
+        equipments = []
+        replaced = []
+        for entry in entries:
+            old = current.get(entry['id'])
+            if old is not None and old.config == entry:
+                equipments.append(old)
+                continue
+            e = create_equipment(entry)
+            e.topic_prefix = self.prefix
+            e.publisher = self.command_publisher
+            if old is None:
+                e.set_current_power(0)
+            else:
+                carry_state(old, e)
+                replaced.append((old, e))
+            equipments.append(e)
+        replaced.extend((current[i], None) for i in removed)
+        for old, e in replaced:
+            old.stop()
+            # the devices the new version doesn't drive anymore are switched off and forgotten, no more keepalives
+            stale = old.command_topics - (e.command_topics if e is not None else set())
+            if stale and old.get_current_power():
+                old.set_current_power(0)
+            for topic in stale:
+                self.command_publisher.forget(topic)
+
+        self.equipments = tuple(equipments)
+        self.router.set_equipments(self.equipments)
+        if hasattr(self.controller, 'set_equipments'):
+            self.controller.set_equipments(self.equipments)
+        debug(0, "equipment configuration{} reloaded: {} added, {} removed, {} changed, {} kept".format(
+            ' of ' + self.name if self.name else '', len(added), len(removed), len(changed),
+            len(equipments) - len(added) - len(changed)))
+        if self.on_reload is not None:
+            self.on_reload()
+
+    def get_state(self):
+        """ Return the state to save in a checkpoint, see checkpoint.py """
+        return {
+            'power_reactive': self.power_reactive,
+            'reactive_index': self.reactive_estimator.get_state(),
+            'energy_yesterday': self.energy_yesterday,
+            'equipments': {e.name: e.get_state() for e in self.equipments},
+        }
+
+    def restore_state(self, state):
+        self.power_reactive = state['power_reactive']
+        self.reactive_estimator.restore_state(state.get('reactive_index'))
+        self.energy_yesterday = state['energy_yesterday']
+
+    def start(self):
+        self.command_publisher.start()
+        self.regulation_worker.start()
+
+    def add_measures(self, key, val):
+        # never blocks: the point is only queued, the measurement writer thread sends it later with other ones
+        self.measurement_writer.add(key, val, now_ts(), self.tags)
+        if key in ROLLUP_MEASUREMENTS:
+            self.add_rollup(key, val, now_ts())
+
+    def add_rollup(self, key, val, ts):
+        for point in self.rollups.add_power(key, ts, val):
+            self.measurement_writer.write(point)
+
+    @property
+    def power_available(self):
+        return self.measures[0]
+
+    @power_available.setter
+    def power_available(self, value):
+        self.measures = (value,) + self.measures[1:]
+
+    @property
+    def power_consumed_tot(self):
+        return self.measures[1]
+
+    @power_consumed_tot.setter
+    def power_consumed_tot(self, value):
+        self.measures = (self.measures[0], value, self.measures[2])
+
+    @property
+    def power_reactive(self):
+        return self.measures[2]
+
+    @power_reactive.setter
+    def power_reactive(self, value):
+        self.measures = self.measures[:2] + (value,)
+
+    def injected_power(self, payload):
+        """ Record a SINSTI measurement, return the value read by evaluate() (filtered) """
+        raw = set_instant_power(int(payload))
+        self.measure_ts = now_ts()
+        self.add_measures("power_available",raw)
+        self.history.append("SINSTI", raw, now_ts())
+        if not self.injected_filter:
+            return raw
+        # a float whatever the filters return, InfluxDB rejects the points of a field which type changes
+        power = float(self.injected_filter(raw))
+        self.add_measures("power_available_filtered", power)
+        return power
+
+    def consumed_power(self, payload):
+        """ Record a SINSTS measurement, return the value read by evaluate() (filtered) """
+        raw = set_instant_power(int(payload))
+        self.measure_ts = now_ts()
+        self.add_measures("power_consumed_tot",raw)
+        self.history.append("SINSTS", raw, now_ts())
+        if not self.consumed_filter:
+            return raw
+        power = float(self.consumed_filter(raw))
+        self.add_measures("power_consumed_tot_filtered", power)
+        return power
+
+    def reactive_power(self, payload):
+        """ Record an ERQT index, return the reactive power derived from it """
+        index = int(payload)
+        power = self.reactive_estimator.add(now_ts(), index)
+        # the previous power is kept until the index has moved twice
+        power = self.power_reactive if power is None else float(round(power))
+        self.add_measures("power_reactive",power)
+        self.history.append("ERQT", index, now_ts())
+        return power
+
+    def on_injected(self, payload):
+        self.power_available = self.injected_power(payload)
+
+    def on_consumed(self, payload):
+        self.power_consumed_tot = self.consumed_power(payload)
+
+    def on_consumed_reactive(self, payload):
+        self.power_reactive = self.reactive_power(payload)
+
+    def on_frame(self, payload):
+        # all the measurements of a TIC frame in one message, the evaluation which follows sees a coherent snapshot
+        try:
+            frame = json.loads(payload)
+            injected = frame.get('SINSTI')
+            consumed = frame.get('SINSTS')
+            reactive = frame.get('ERQT')
+        except (ValueError, AttributeError) as ex:
+            self.invalid_frames += 1
+            debug(0, "invalid frame {!r}: {}".format(payload, ex))
+            return
+        self.frames += 1
+        self.last_frame_date = now_ts()
+        available, consumed_tot, power_reactive = self.measures
+        if injected is not None:
+            available = self.injected_power(injected)
+        if consumed is not None:
+            consumed_tot = self.consumed_power(consumed)
+        if reactive is not None:
+            power_reactive = self.reactive_power(reactive)
+        # the values of the frame replace the previous ones at once
+        self.measures = (available, consumed_tot, power_reactive)
+
+    def on_temperature(self, e, payload):
+        temp=float(payload)
+        self.add_measures(e.name + "-temp",temp)
+        self.history.append(e.name + "-temp", temp, now_ts())
+        self.add_rollup(e.name + "-temp", temp, now_ts())
+        e.setCurrentTemp(temp)
+
+    def query_history(self, key, seconds):
+        """ Return the aggregates (mean, min, max, last, count) of the last seconds of a history series """
+        return self.history.summary(key, seconds, now_ts())
+
+    def on_history_query(self, payload):
+        # "<series>;<seconds>", the aggregates are sent back on the history result topic
+        key, _, seconds = payload.strip().partition(';')
+        try:
+            result = self.query_history(key, float(seconds or 60))
+        except ValueError as ex:
+            debug(0, "invalid history query {!r}: {}".format(payload, ex))
+            return
+        result['key'] = key
+        result['seconds'] = float(seconds or 60)
+        self.mqtt_client.publish(self.topic_history_result, json.dumps(result))
+
+    def on_control(self, e, payload):
+        try:
+            command, arg = parse_command(payload)
+        except ValueError as ex:
+            debug(0, "invalid control for {}: {}".format(e.name, ex))
+            return
+        # applied by the regulation thread, never concurrently with an evaluation
+        handler = CONTROL_HANDLERS[command]
+        self.regulation_worker.submit(lambda: handler(e, arg))
+
+    def build_router(self, equipments):
+        r = TopicRouter()
+        r.add_topic(self.topic_injected, self.on_injected)
+        r.add_topic(self.topic_consumed, self.on_consumed)
+        r.add_topic(self.topic_consumed_reactive, self.on_consumed_reactive)
+        r.add_topic(self.topic_frame, self.on_frame)
+        r.add_topic(self.topic_history_query, self.on_history_query)
+        r.add_equipment_topic(self.topic_equipment_temp, self.on_temperature)
+        r.add_equipment_topic(self.topic_equipment_control, self.on_control)
+        r.set_equipments(equipments)
+        return r
+
+    def on_message(self, client, userdata, msg):
+        # Receive power consumption and production values and triggers the evaluation. We also take into account
+        # manual control messages in case we want to turn on/off a given equipment.
+        # This runs in the MQTT network thread: it only stores the latest values, the evaluation is done by the
+        # regulation worker.
+        if msg.topic in self.label_topics and self.last_frame_date is not None and \
+                now_ts() - self.last_frame_date < FRAME_TIMEOUT:
+            # the same measurements come in the frames, teleinfo publishes both (TIC_TOPICS = 'both')
+            self.labels_ignored += 1
+            return
+        self.router.dispatch(msg.topic, msg.payload.decode())
+        self.regulation_worker.notify()
+
+    def decrease_load(self, excess_power, off_peak):
+        # Greedy allocation: decrease the power of the equipments one by one, from the lowest priority
+        for e in reversed(self.equipments):
+            debug(2, "examining " + e.name)
+            if e.needToBeForced() and off_peak:
+                debug(4, "skipping this equipment because it's in forced state")
+                continue
+            if not e.isAutoMode():
+                debug(4, "skipping this equipment because it's in manual mode")
+                continue
+            result = e.decrease_power_by(excess_power)
+            if result is None:
+                debug(2, "stopping here and waiting for the next measurement to see the effect")
+                break
+            excess_power -= result
+            if excess_power <= 0:
+                debug(2, "no more excess power consumption, stopping here")
+                break
+            else:
+                debug(2, "there is {}W left to cancel, continuing".format(excess_power))
+        debug(2, "no more equipment to check")
+
+    def constant_candidates(self, start, off_peak):
+        # the run of consecutive constant equipments starting at start, and the ones which may be switched on
+        equipments = self.equipments
+        end = start
+        while end < len(equipments) and isinstance(equipments[end], ConstantPowerEquipment):
+            end += 1
+        candidates = [e for e in equipments[start:end]
+                      if not e.is_on and e.isAutoMode() and not (e.needToBeForced() and off_peak)]
+        return end, candidates
+
+    def increase_load(self, available_power, off_peak):
+        # Greedy allocation: increase the power of the equipments one by one, from the highest priority
+        equipments = self.equipments
+        skip_until = 0
+        for i, e in enumerate(equipments):
+            if available_power <= 0:
+                debug(2, "no more available power")
+                break
+            if i < skip_until:
+                continue
+            debug(2, "examining " + e.name)
+            if self.constant_selector is not None and isinstance(e, ConstantPowerEquipment):
+                # consecutive constant equipments are switched on together, as the best fitting combination
+                skip_until, candidates = self.constant_candidates(i, off_peak)
+                available_power = self.constant_selector.switch_on(candidates, available_power)
+                continue
+            if e.needToBeForced() and off_peak:
+                debug(4, "skipping this equipment because it's in force state")
+                continue
+            if e.isReady():
+                debug(4, "skipping this equipment because it's in ready state")
+                continue
+            if not e.isAutoMode():
+                debug(4, "skipping this equipment because it's in manual mode")
+                continue
+            #debug(4," ***** " + str(e.needToBeForced()) + " **** " + str(HC_ok()))
+            result = e.increase_power_by(available_power)
+            if result is None:
+                debug(2, "stopping here and waiting for the next measurement to see the effect")
+                break
+            elif result == 0:
+                debug(2, "no more available power to use, stopping here")
+                break
+            elif result < 0:
+                debug(2, "not enough available power to turn on this equipment, trying to recover power on lower priority equipments")
+                freeable_power = 0
+                needed_power = -result
+                for j in range(i + 1, len(equipments)):
+                    o = equipments[j]
+                    if o.needToBeForced() and off_peak:
+                        continue
+                    p = o.get_current_power()
+                    if p is not None:
+                        freeable_power += p
+                debug(2, "power used by other equipments: {}W, needed: {}W".format(freeable_power, needed_power))
+                if freeable_power >= needed_power:
+                    debug(2, "recovering power")
+                    freed_power = 0
+                    for j in reversed(range(i + 1, len(equipments))):
+                        o = equipments[j]
+                        if o.needToBeForced() and off_peak:
+                            continue
+                        result = o.decrease_power_by(needed_power)
+                        freed_power += result
+                        needed_power -= result
+                        if needed_power <= 0:
+                            debug(2, "enough power has been recovered, stopping here")
+                            break
+                    new_available_power = available_power + freed_power
+                    debug(2, "now trying again to increase power of {} with {}W".format(e.name, new_available_power))
+                    available_power = e.increase_power_by(new_available_power)
+                else:
+                    debug(2, "this is not possible to recover enough power on lower priority equipments")
+            else:
+                available_power = result
+                debug(2, "there is {}W left to use, continuing".format(available_power))
+        debug(2, "no more equipment to check")
+
+    def evaluate(self):
+        # This is where all the magic happen. This function takes decision according to the current power
+        # measurements. It examines the list of equipments by priority order, their current state and computes which
+        # one should be turned on/off.
+        equipments = self.equipments
+
+        # the minimum duration between two evaluations is ensured by the regulation worker
+        t=now_ts()
+
+        # a single read of the measurements, they may be replaced by the MQTT thread meanwhile
+        power_available, power_consumed_tot, power_reactive = self.measures
+#        power_consumed=power_consumed_HP + power_consumed_HC
+        power_consumed=power_consumed_tot - power_available
+        power_available_active=-1* power_consumed
+        if power_available_active >0:
+           power_available_active = math.sqrt(abs(power_available_active**2 - power_reactive**2))
+           power_consumed=float(0)
+        else:
+           power_available_active=float(0)
+           power_consumed = math.sqrt(abs(power_consumed**2 - power_reactive**2))
+        self.power_consumed = power_consumed
+        self.power_available_active = power_available_active
+
+        self.add_measures("power_available_active",power_available_active)
+        self.history.append("power_available_active", power_available_active, t)
+        self.add_measures("power_consumed",power_consumed)
+        # the off-peak state can't change during an evaluation
+        off_peak = HC_ok()
+        try:
+            if off_peak:
+              debug(0, "HEURES CREUSES : checking equipment to be forced")
+              for i, e in enumerate(equipments):
+                if not e.isAutoMode():
+                   debug(1, "skipping this equipment because it's in manual mode")
+                   continue
+
+                if e.needToBeForced():
+                   if e.get_current_power() != e.max_power:
+
+                      debug(1, "Switching on equipment " + e.name + " because it is to be forced and power is " + str(e.get_current_power()))
+                      e.set_current_power(e.max_power)
+                   else:
+                      debug(1, "equipment " + e.name + " is already forced")
+
+            debug(0, '')
+            debug(0, '{}evaluating power consumption={}, power production={}'.format(
+                '[{}] '.format(self.name) if self.name else '', power_consumed, power_available))
+
+
+           # Here starts the real work, compare powers. The controller gives the power to add (or remove).
+            controller = self.controller
+            correction = controller.correction(power_available_active - power_consumed, equipments, t,
+                                               self.measure_ts)
+            if controller.predictive:
+                load = sum(e.get_current_power() or 0 for e in equipments)
+            if power_available_active <= 0 and power_consumed > BALANCE_THRESHOLD:
+                # Too much power consumption, we need to decrease the load
+                excess_power = -correction
+                if excess_power > 0:
+                    debug(0, "decreasing global power consumption by {}W".format(excess_power))
+                    if self.allocator is not None:
+                        self.allocator.decrease(equipments, excess_power, off_peak)
+                    else:
+                        self.decrease_load(excess_power, off_peak)
+            elif power_available_active >0 and power_available_active <= BALANCE_THRESHOLD:
+                # Nice, this is the goal: consumption is equal to production
+                debug(0, "power consumption and production are balanced")
+            elif power_available_active > 0:
+                # There's power in excess, try to increase the load to consume this available power
+                available_power = correction
+                if available_power > 0:
+                    debug(0, "increasing global power consumption by {}W".format(available_power))
+                    if self.allocator is not None:
+                        self.allocator.increase(equipments, available_power, off_peak)
+                    else:
+                        self.increase_load(available_power, off_peak)
+            if controller.predictive:
+                controller.applied(t, sum(e.get_current_power() or 0 for e in equipments) - load)
+
+            # Build a status message
+            status = {
+                'date': t,
+                'date_str': datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S'),
+                'power_available': power_available,
+                'power_consumed': power_consumed,
+            }
+            if self.name:
+                status['site'] = self.name
+            es = []
+            series_filter = self.series_filter
+            for e in equipments:
+                p = e.get_current_power()
+                energy = e.get_energy()
+                forced = e.needToBeForced()
+                es.append({
+                    'name': e.name,
+                    'current_power': 'unknown' if p is None else p,
+                    'energy': energy,
+                    'forced': forced
+                })
+                # the series are only written when their value moved, see SeriesFilter
+                key = "{}-power".format(e.name)
+                if p is not None:
+                    self.history.append(key, p, t)
+                    self.add_rollup(key, p, t)
+                if series_filter.changed(key, p, t, STATUS_POWER_TOLERANCE):
+                    self.add_measures(key,round(p))
+                key = "{}-energy".format(e.name)
+                if series_filter.changed(key, energy, t, STATUS_ENERGY_TOLERANCE):
+                    self.add_measures(key,round(energy))
+                key = "{}-is_forced".format(e.name)
+                if series_filter.changed(key, forced, t):
+                    self.add_measures(key,forced)
+
+            status['equipments'] = es
+            status['writer'] = self.measurement_writer.stats()
+            status['worker'] = self.regulation_worker.stats()
+            status['commands'] = self.command_publisher.stats()
+            if self.constant_selector is not None:
+                status['constant_selector'] = self.constant_selector.stats()
+            status['status'] = self.status_publisher.stats()
+            status['history'] = self.history.stats()
+            status['controller'] = self.controller.stats()
+            status['rollups'] = self.rollups.stats()
+            if self.config_watcher is not None:
+                status['config'] = self.config_watcher.stats()
+            if self.frames or self.invalid_frames:
+                status['frames'] = {'received': self.frames, 'invalid': self.invalid_frames,
+                                    'labels_ignored': self.labels_ignored}
+            if self.injected_filter or self.consumed_filter:
+                status['filters'] = {'injected': self.injected_filter.stats(),
+                                     'consumed': self.consumed_filter.stats()}
+            self.status_publisher.publish(status)
+
+        except Exception as e:
+            debug(2, e)
+
+
+def load_sites(measurement_writer, sites_config=None):
+    """ Return the regulators of the sites listed in sites_config, a single site without prefix if there is none """
+    if not sites_config:
+        return [Regulator(measurement_writer)]
+    import yaml
+    with open(sites_config, 'r') as f:
+        config = yaml.safe_load(f)
+    sites = []
+    for site in config['sites']:
+        sites.append(Regulator(measurement_writer, name=site['name'], prefix=site.get('prefix', site['name'] + '/'),
+                               equipment_config=site.get('equipment_config', 'equipment_config.yml'),
+                               history_duration=site.get('history_duration', HISTORY_DURATION),
+                               history_recent=site.get('history_recent', HISTORY_RECENT)))
+    return sites
+
+
+def route_sites(sites):
+    """ Map each topic to the site receiving it """
+    global regulators, topic_sites
+    regulators = list(sites)
+    topic_sites = {topic: r for r in regulators for topic in r.router.topics()}
 
 
 def on_connect(client, userdata, flags, rc):
     debug(0, 'ready')
 
-    client.subscribe(TOPIC_INJECTED)
-    client.subscribe(TOPIC_CONSUMED)
-    client.subscribe(TOPIC_CONSUMED_REACTIVE)
+    # subscriptions are done here so that they are restored after a reconnection
+    for r in regulators:
+        r.router.subscribe(client)
 
 
 def on_message(client, userdata, msg):
-    # Receive power consumption and production values and triggers the evaluation. We also take into account manual
-    # control messages in case we want to turn on/off a given equipment.
-    global power_available,power_consumed_tot,power_reactive, previous_index_CR, previous_ts_CR
-    if msg.topic == TOPIC_INJECTED:
-        power_available=set_instant_power(int(msg.payload.decode()))
-        add_measures("power_available",power_available)
-    elif "/temperature" in msg.topic:
-        id_equipment=msg.topic.split("/")[1]
-        e = get_equipment_by_id(id_equipment)
-        temp=float(msg.payload.decode())
-        add_measures(e.name + "-temp",temp)
-        e.setCurrentTemp(temp)
-    elif "/control" in msg.topic:
-        id_equipment=msg.topic.split("/")[1]
-        e = get_equipment_by_id(id_equipment)
-        wh_command=str(msg.payload.decode())
-        if wh_command=="ON":
-           e.setManualMode()
-           e.switchOn()
-        elif wh_command=="OFF":
-           e.setManualMode()
-           e.switchOff()
-        elif wh_command=="AUTO":
-           e.setAutoMode()
-        elif "MIN" in wh_command:
-           temp=wh_command.split(";")[1]
-           e.setMinTemp(float(temp))
-        elif "MAX" in wh_command:
-           temp=wh_command.split(";")[1]
-           e.setMaxTemp(float(temp))
-        elif "ECO" in wh_command:
-           temp=wh_command.split(";")[1]
-           e.setEcoTemp(float(temp))
-    elif msg.topic == TOPIC_CONSUMED_REACTIVE:
-        [previous_ts_CR,previous_index_CR,current_index_CR,power_reactive]=evaluate_power(previous_ts_CR,previous_index_CR,int(msg.payload.decode()),power_reactive)
-        add_measures("power_reactive",power_reactive)
-    elif msg.topic == TOPIC_CONSUMED:
-        power_consumed_tot=set_instant_power(int(msg.payload.decode()))
-        add_measures("power_consumed_tot",power_consumed_tot)
-    evaluate()
-
-
-# Specific fallback: the energy put in the water heater yesterday (see below)
-energy_yesterday = 0
-
-def evaluate():
-    # This is where all the magic happen. This function takes decision according to the current power measurements.
-    # It examines the list of equipments by priority order, their current state and computes which one should be
-    # turned on/off.
-
-    global last_evaluation_date
-    
-    t=now_ts()
-    if last_evaluation_date is not None:
-       # ensure there's a minimum duration between two evaluations
-       if t - last_evaluation_date < EVALUATION_PERIOD:
-          return
-
-    last_evaluation_date = t
-
-#    power_consumed=power_consumed_HP + power_consumed_HC
-    power_consumed=power_consumed_tot - power_available
-    power_available_active=-1* power_consumed
-    if power_available_active >0:
-       power_available_active = math.sqrt(abs(power_available_active**2 - power_reactive**2))
-       power_consumed=float(0)
-    else:
-       power_available_active=float(0)
-       power_consumed = math.sqrt(abs(power_consumed**2 - power_reactive**2))
-       
-    add_measures("power_available_active",power_available_active)
-    add_measures("power_consumed",power_consumed)
-    try:
-        if HC_ok():
-          debug(0, "HEURES CREUSES : checking equipment to be forced")
-          for i, e in enumerate(equipments):
-            if not e.isAutoMode():
-               debug(1, "skipping this equipment because it's in manual mode")
-               continue
-          
-            if e.needToBeForced():
-               if e.get_current_power() != e.max_power:
-               
-                  debug(1, "Switching on equipment " + e.name + " because it is to be forced and power is " + str(e.get_current_power()))
-                  e.set_current_power(e.max_power)
-               else:
-                  debug(1, "equipment " + e.name + " is already forced")
-
-        debug(0, '')
-        debug(0, 'evaluating power consumption={}, power production={}'.format(power_consumed, power_available))
-
- 
-       # Here starts the real work, compare powers
-        if power_available_active <= 0 and power_consumed > BALANCE_THRESHOLD:
-            # Too much power consumption, we need to decrease the load
-            excess_power = power_consumed / 4
-            debug(0, "decreasing global power consumption by {}W".format(excess_power))
-            for e in reversed(equipments):
-                debug(2, "examining " + e.name)
-                if e.needToBeForced() and HC_ok():
-                    debug(4, "skipping this equipment because it's in forced state")
-                    continue
-                if not e.isAutoMode():
-                    debug(4, "skipping this equipment because it's in manual mode")
-                    continue
-                result = e.decrease_power_by(excess_power)
-                if result is None:
-                    debug(2, "stopping here and waiting for the next measurement to see the effect")
-                    break
-                excess_power -= result
-                if excess_power <= 0:
-                    debug(2, "no more excess power consumption, stopping here")
-                    break
-                else:
-                    debug(2, "there is {}W left to cancel, continuing".format(excess_power))
-            debug(2, "no more equipment to check")
-        elif power_available_active >0 and power_available_active <= BALANCE_THRESHOLD:
-            # Nice, this is the goal: consumption is equal to production
-            debug(0, "power consumption and production are balanced")
-        elif power_available_active > 0:
-            # There's power in excess, try to increase the load to consume this available power
-            available_power = power_available_active/4
-            debug(0, "increasing global power consumption by {}W".format(available_power))
-            for i, e in enumerate(equipments):
-                if available_power <= 0:
-                    debug(2, "no more available power")
-                    break
-                debug(2, "examining " + e.name)
-                if e.needToBeForced() and HC_ok():
-                    debug(4, "skipping this equipment because it's in force state")
-                    continue
-                if e.isReady():
-                    debug(4, "skipping this equipment because it's in ready state")
-                    continue
-                if not e.isAutoMode():
-                    debug(4, "skipping this equipment because it's in manual mode")
-                    continue
-                #debug(4," ***** " + str(e.needToBeForced()) + " **** " + str(HC_ok()))
-                result = e.increase_power_by(available_power)
-                if result is None:
-                    debug(2, "stopping here and waiting for the next measurement to see the effect")
-                    break
-                elif result == 0:
-                    debug(2, "no more available power to use, stopping here")
-                    break
-                elif result < 0:
-                    debug(2, "not enough available power to turn on this equipment, trying to recover power on lower priority equipments")
-                    freeable_power = 0
-                    needed_power = -result
-                    for j in range(i + 1, len(equipments)):
-                        o = equipments[j]
-                        if o.needToBeForced() and HC_ok():
-                            continue
-                        p = o.get_current_power()
-                        if p is not None:
-                            freeable_power += p
-                    debug(2, "power used by other equipments: {}W, needed: {}W".format(freeable_power, needed_power))
-                    if freeable_power >= needed_power:
-                        debug(2, "recovering power")
-                        freed_power = 0
-                        for j in reversed(range(i + 1, len(equipments))):
-                            o = equipments[j]
-                            if o.needToBeForced() and HC_ok():
-                                continue
-                            result = o.decrease_power_by(needed_power)
-                            freed_power += result
-                            needed_power -= result
-                            if needed_power <= 0:
-                                debug(2, "enough power has been recovered, stopping here")
-                                break
-                        new_available_power = available_power + freed_power
-                        debug(2, "now trying again to increase power of {} with {}W".format(e.name, new_available_power))
-                        available_power = e.increase_power_by(new_available_power)
-                    else:
-                        debug(2, "this is not possible to recover enough power on lower priority equipments")
-                else:
-                    available_power = result
-                    debug(2, "there is {}W left to use, continuing".format(available_power))
-            debug(2, "no more equipment to check")
-
-        # Build a status message
-        status = {
-            'date': t,
-            'date_str': datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S'),
-            'power_available': power_available,
-            'power_consumed': power_consumed,
-        }
-        es = []
-        for e in equipments:
-            p = e.get_current_power()
-            es.append({
-                'name': e.name,
-                'current_power': 'unknown' if p is None else p,
-                'energy': e.get_energy(),
-                'forced': e.needToBeForced()
-            })
-            add_measures("{}-power".format(e.name),round(p))
-            add_measures("{}-energy".format(e.name),round(e.get_energy()))
-            add_measures("{}-is_forced".format(e.name),e.needToBeForced())
-            
-        status['equipments'] = es
-        mqtt_client.publish(TOPIC_STATUS, json.dumps(status))
-
-    except Exception as e:
-        debug(2, e)
+    r = topic_sites.get(msg.topic)
+    if r is None:
+        debug(0, "no site for topic {}".format(msg.topic))
+        return
+    r.on_message(client, userdata, msg)
 
 
 def main():
-    global mqtt_client, equipments, equipment_water_heater
+    if REGULATION_ENGINE == 'asyncio':
+        import async_engine
+        async_engine.main()
+        return
+
+    # connexion a la base de données InfluxDB
+    client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD, database=INFLUXDB_DATABASE)
+
+    # measurements of all the sites are queued and written in batches by a background thread, spooled on disk while
+    # InfluxDB is not reachable
+    measurement_writer = MeasurementWriter(client, batch_size=MEASUREMENT_BATCH_SIZE,
+                                           flush_interval=MEASUREMENT_FLUSH_INTERVAL,
+                                           max_queue=MEASUREMENT_QUEUE_SIZE,
+                                           spool=open_spool('power_regulation'),
+                                           retry_interval=SPOOL_RETRY_INTERVAL,
+                                           prepare=functools.partial(connect_database, client))
 
     mqtt_client = mqtt.Client()
     from config import (MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE,
@@ -409,17 +842,38 @@ def main():
 
     mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_KEEPALIVE)
 
-    equipment.setup(mqtt_client, not SIMULATION)
-
-    # Load equipment configurations from YAML file
-    from equipment_loader import load_equipment_from_config
-    equipments = tuple(load_equipment_from_config())
+    measurement_writer.start()
 
-    # At startup, reset everything
-    for e in equipments:
-        e.set_current_power(0)
+    equipment.setup(mqtt_client, not SIMULATION)
 
-    mqtt_client.loop_forever()
+    sites = load_sites(measurement_writer, SITES_CONFIG)
+    checkpoint = load_checkpoint(CHECKPOINT_FILE)
+    for r in sites:
+        r.load_equipments(mqtt_client, checkpoint)
+    route_sites(sites)
+    if EQUIPMENT_CONFIG_RELOAD_INTERVAL:
+        for r in sites:
+            # the routes of the sites are rebuilt when the equipments of one of them change
+            r.watch_equipment_config(EQUIPMENT_CONFIG_RELOAD_INTERVAL, lambda: route_sites(sites))
+    checkpointer = Checkpointer(CHECKPOINT_FILE, sites, CHECKPOINT_INTERVAL) if CHECKPOINT_FILE else None
+    if checkpointer is not None:
+        checkpointer.start()
+
+    def on_sigterm(signum, frame):
+        # the default action of SIGTERM (systemctl stop) kills the process without running the finally block below
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    for r in sites:
+        r.start()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        # last save, the next start resumes from the current state
+        for r in sites:
+            r.regulation_worker.stop()
+        if checkpointer is not None:
+            checkpointer.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+# Regulation worker.
+# The MQTT network thread only stores the latest value of each measurement and notifies this worker, the evaluation
+# (and the commands it sends) runs in a dedicated thread. Notifications received while an evaluation is already
+# pending are coalesced: the worker waits for the evaluation period and then evaluates once, on the freshest values,
+# never on a backlog of messages. The worker is the only gate of the evaluation period, measured on clock.monotonic():
+# an evaluation which is not due yet stays pending. Actions which must be applied in the regulation thread (manual
+# controls for instance) are queued and run before the next evaluation.
+# LoopRegulationWorker does the same in an asyncio event loop, for the asyncio engine.
+
+import threading
+from collections import deque
+
+import clock
+from debug import debug as debug
+
+
+class RegulationWorker:
+    def __init__(self, evaluate, period, max_actions=100):
+        self._evaluate = evaluate
+        self.period = period
+        self._cond = threading.Condition()
+        self._pending = False
+        self._pending_since = None
+        self._actions = deque()
+        self._max_actions = max_actions
+        self._last_run = None
+        self._thread = None
+        self._stopped = False
+
+        # counters
+        self.notifications = 0
+        self.coalesced = 0
+        self.evaluations = 0
+        self.actions_run = 0
+        self.actions_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def notify(self):
+        """ Ask for an evaluation, called from the MQTT thread """
+        with self._cond:
+            self.notifications += 1
+            if self._pending:
+                self.coalesced += 1
+            else:
+                self._pending = True
+                self._pending_since = clock.monotonic()
+            self._cond.notify()
+
+    def submit(self, action):
+        """ Run action() in the regulation thread, before the next evaluation """
+        with self._cond:
+            if len(self._actions) >= self._max_actions:
+                self._actions.popleft()
+                self.actions_dropped += 1
+            self._actions.append(action)
+            self._cond.notify()
+
+    def _run_actions(self):
+        while True:
+            with self._cond:
+                if not self._actions:
+                    return
+                action = self._actions.popleft()
+            try:
+                action()
+            except Exception as e:
+                debug(0, "regulation action failed: {}".format(e))
+            self.actions_run += 1
+
+    def _remaining(self):
+        """ Return the seconds left before the end of the evaluation period """
+        if self._last_run is None:
+            return 0.0
+        return self.period - (clock.monotonic() - self._last_run)
+
+    def run_once(self):
+        """ Run the queued actions and the pending evaluation if it is due, return True if an evaluation was done """
+        self._run_actions()
+        with self._cond:
+            if not self._pending or self._remaining() > 0:
+                return False
+            self._pending = False
+            now = clock.monotonic()
+            lag = now - self._pending_since
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._last_run = now
+        self.evaluations += 1
+        self._evaluate()
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='regulation', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._actions:
+                    if self._pending:
+                        # wait for the end of the evaluation period, more notifications are coalesced meanwhile
+                        timeout = self._remaining()
+                        if timeout <= 0:
+                            break
+                        self._cond.wait(timeout)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+            if self._actions:
+                self._run_actions()
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                debug(0, "evaluation failed: {}".format(e))
+
+    def stats(self):
+        return {
+            'notifications': self.notifications,
+            'coalesced': self.coalesced,
+            'evaluations': self.evaluations,
+            'pending': self._pending,
+            'actions_run': self.actions_run,
+            'actions_dropped': self.actions_dropped,
+            'last_lag': round(self.last_lag, 4),
+            'max_lag': round(self.max_lag, 4),
+        }
+
+
+class LoopRegulationWorker(RegulationWorker):
+    """ Same as RegulationWorker, but the evaluations and actions are run by an asyncio event loop, not a thread """
+
+    def __init__(self, evaluate, period, loop, max_actions=100):
+        RegulationWorker.__init__(self, evaluate, period, max_actions)
+        self._loop = loop
+        self._handle = None
+
+    def notify(self):
+        RegulationWorker.notify(self)
+        self._schedule()
+
+    def _schedule(self):
+        if self._handle is None:
+            # coalesce the notifications until the end of the evaluation period
+            self._handle = self._loop.call_later(max(0.0, self._remaining()), self._fire)
+
+    def submit(self, action):
+        RegulationWorker.submit(self, action)
+        self._loop.call_soon(self._run_actions)
+
+    def _fire(self):
+        self._handle = None
+        try:
+            self.run_once()
+        except Exception as e:
+            debug(0, "evaluation failed: {}".format(e))
+        if self._pending:
+            self._schedule()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
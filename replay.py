@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+# Deterministic replay of the power regulation.
+#
+# A trace of recorded MQTT messages (SINSTI, SINSTS, ERQT, equipment temperatures, controls...) is fed to
+# power_regulation.on_message against a virtual clock, as fast as the CPU allows. The MQTT broker and InfluxDB are
+# replaced by in-memory stand-ins which record the commands sent to the equipments. This allows re-running a whole
+# day of regulation in seconds, for instance to compare the grid import of two versions before deploying one.
+#
+# Trace format: one message per line, either CSV "timestamp,topic,payload" or a JSON object
+# {"ts": ..., "topic": ..., "payload": ...}. Empty lines and lines starting with # are ignored. The measurements are
+# either per-label messages (tic/SINSTI, tic/SINSTS, tic/ERQT) or combined frames (tic/frame); with --frames, the
+# per-label messages of the same timestamp are grouped in a frame, as published by teleinfo.py.
+#
+# Usage:
+#   python replay.py run trace.csv [--config equipment_config.yml] [--closed-loop] [--frames] [--verbose]
+#   python replay.py export trace.csv --start 2024-06-01T00:00:00Z --end 2024-06-02T00:00:00Z
+#
+# With --closed-loop, the trace is considered as the consumption of the house without the regulated equipments:
+# the power of the equipments is added to it before it is given to the regulation, so that the regulation sees the
+# effect of its own decisions.
+
+import argparse
+import json
+import logging
+import sys
+
+import clock
+import equipment
+from debug import logger
+from measurement_writer import RAW_RETENTION_POLICY, MeasurementWriter
+
+
+class ReplayMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode() if isinstance(payload, str) else payload
+        self.qos = 0
+        self.retain = False
+
+
+class MemoryMqttClient:
+    """ Stand-in for the paho client: records subscriptions and published messages """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.published = {}
+        self.last_payload = {}
+        self.on_message = None
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return (0, len(self.subscriptions))
+
+    def unsubscribe(self, topic):
+        if topic in self.subscriptions:
+            self.subscriptions.remove(topic)
+        return (0, 0)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published[topic] = self.published.get(topic, 0) + 1
+        self.last_payload[topic] = payload
+        return None
+
+    def publish_count(self):
+        return sum(self.published.values())
+
+
+class MemoryInfluxClient:
+    """ Stand-in for the InfluxDB client: keeps the number of points and the last value of each measurement """
+
+    def __init__(self):
+        self.points = 0
+        self.requests = 0
+        self.last_values = {}
+
+    def write_points(self, points, time_precision=None, retention_policy=None, **kwargs):
+        self.requests += 1
+        self.points += len(points)
+        if retention_policy == RAW_RETENTION_POLICY:
+            # the rollups (see rollup.py) are only counted
+            for p in points:
+                self.last_values[p['measurement']] = p['fields']['value']
+        return True
+
+
+def read_trace(path):
+    """ Yield (timestamp, topic, payload) tuples in the order of the file """
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                m = json.loads(line)
+                payload = m['payload']
+                yield float(m['ts']), m['topic'], payload if isinstance(payload, str) else json.dumps(payload)
+            else:
+                ts, topic, payload = line.split(',', 2)
+                yield float(ts), topic, payload
+
+
+FRAME_LABELS = {'tic/SINSTI': 'SINSTI', 'tic/SINSTS': 'SINSTS', 'tic/ERQT': 'ERQT'}
+
+
+def group_frames(trace):
+    """ Yield the messages of trace with the per-label measurements of a same timestamp grouped in tic/frame """
+    frame = {}
+    frame_ts = None
+    for ts, topic, payload in trace:
+        label = FRAME_LABELS.get(topic)
+        if frame and (label is None or ts != frame_ts or label in frame):
+            yield frame_ts, 'tic/frame', json.dumps(frame, separators=(',', ':'))
+            frame = {}
+        if label is None:
+            yield ts, topic, payload
+            continue
+        frame_ts = ts
+        frame[label] = int(float(payload))
+    if frame:
+        yield frame_ts, 'tic/frame', json.dumps(frame, separators=(',', ':'))
+
+
+class Replay:
+    def __init__(self, config_file='equipment_config.yml', closed_loop=False):
+        import power_regulation
+
+        self.pr = power_regulation
+        self.reg = None
+        self.closed_loop = closed_loop
+        self.mqtt = MemoryMqttClient()
+        self.influx = MemoryInfluxClient()
+        self.config_file = config_file
+
+        # household measurements as recorded in the trace
+        self.recorded_consumed = 0
+        self.recorded_injected = 0
+
+        # results
+        self.messages = 0
+        self.grid_import_wh = 0.0
+        self.grid_export_wh = 0.0
+        self.equipment_wh = {}
+        self._last_ts = None
+        self._grid_power = 0
+
+    def setup(self, start_ts):
+        clock.set_clock(clock.VirtualClock(start_ts))
+        # the measurements are written synchronously after each message, see _deliver()
+        self.reg = self.pr.Regulator(MeasurementWriter(self.influx), equipment_config=self.config_file)
+        equipment.setup(self.mqtt, True)
+        self.reg.load_equipments(self.mqtt)
+        self.reg.command_publisher.start()
+        for e in self.reg.equipments:
+            self.equipment_wh[e.name] = 0.0
+        self._last_ts = start_ts
+
+    def _integrate(self, ts):
+        delta = (ts - self._last_ts) / 3600.0
+        if delta <= 0:
+            return
+        if self._grid_power > 0:
+            self.grid_import_wh += self._grid_power * delta
+        else:
+            self.grid_export_wh -= self._grid_power * delta
+        for e in self.reg.equipments:
+            p = e.get_current_power()
+            if p:
+                # equipments may be added by a reload of the configuration
+                self.equipment_wh[e.name] = self.equipment_wh.get(e.name, 0.0) + p * delta
+        self._last_ts = ts
+
+    def _load_power(self):
+        return sum(e.get_current_power() or 0 for e in self.reg.equipments)
+
+    def _deliver(self, topic, payload):
+        self.messages += 1
+        self.reg.on_message(self.mqtt, None, ReplayMessage(topic, payload))
+        self.reg.regulation_worker.run_once()
+        self.reg.measurement_writer.flush()
+
+    def step(self, ts, topic, payload):
+        clock.get_clock().advance_to(ts)
+        self._integrate(ts)
+        reg = self.reg
+        if topic == reg.topic_frame:
+            frame = json.loads(payload)
+            self.recorded_consumed = int(frame.get('SINSTS', self.recorded_consumed))
+            self.recorded_injected = int(frame.get('SINSTI', self.recorded_injected))
+            if self.closed_loop:
+                net = self.recorded_consumed - self.recorded_injected + self._load_power()
+                frame['SINSTI'] = int(max(-net, 0))
+                frame['SINSTS'] = int(max(net, 0))
+                payload = json.dumps(frame, separators=(',', ':'))
+            self._deliver(topic, payload)
+        elif topic in (reg.topic_consumed, reg.topic_injected):
+            if topic == reg.topic_consumed:
+                self.recorded_consumed = int(float(payload))
+            else:
+                self.recorded_injected = int(float(payload))
+            net = self.recorded_consumed - self.recorded_injected
+            if self.closed_loop:
+                net += self._load_power()
+                # the meter only reports positive values, one for each direction
+                self._deliver(reg.topic_injected, str(int(max(-net, 0))))
+                self._deliver(reg.topic_consumed, str(int(max(net, 0))))
+            else:
+                self._deliver(topic, payload)
+        else:
+            self._deliver(topic, payload)
+        if self.closed_loop:
+            net = self.recorded_consumed - self.recorded_injected + self._load_power()
+        else:
+            net = self.recorded_consumed - self.recorded_injected
+        self._grid_power = net
+
+    def run(self, trace):
+        started = False
+        for ts, topic, payload in trace:
+            if not started:
+                self.setup(ts)
+                started = True
+            self.step(ts, topic, payload)
+        return self.summary()
+
+    def summary(self):
+        status_publisher = self.reg.status_publisher
+        commands = {t: n for t, n in self.mqtt.published.items() if not t.startswith(status_publisher.topic)}
+        return {
+            'messages': self.messages,
+            'evaluations': status_publisher.updates,
+            'status_messages': status_publisher.snapshots + status_publisher.deltas,
+            'commands': sum(commands.values()),
+            'commands_by_topic': commands,
+            'commands_suppressed': self.reg.command_publisher.suppressed,
+            'grid_import_wh': round(self.grid_import_wh, 1),
+            'grid_export_wh': round(self.grid_export_wh, 1),
+            'equipment_wh': {k: round(v, 1) for k, v in self.equipment_wh.items()},
+            'influx_points': self.influx.points,
+        }
+
+
+def export_trace(path, start, end, config_file='equipment_config.yml', retention_policy=RAW_RETENTION_POLICY):
+    """ Build a trace from the measurements stored in InfluxDB by teleinfo.py and power_regulation.py """
+    import yaml
+    from influxdb import InfluxDBClient
+    from config import (INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_USERNAME, INFLUXDB_PASSWORD, INFLUXDB_DATABASE)
+
+    client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME,
+                            password=INFLUXDB_PASSWORD, database=INFLUXDB_DATABASE)
+    series = {"SINSTI": "tic/SINSTI", "SINSTS": "tic/SINSTS", "ERQT": "tic/ERQT"}
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    for i, equip in enumerate(config['equipment']):
+        if equip['type'] == 'TempDrivenVariablePowerEquipment':
+            series[equip['name'] + '-temp'] = 'scr/{}/temperature'.format(equip.get('id', i))
+
+    messages = []
+    for measurement, topic in series.items():
+        query = 'SELECT "value" FROM "{}"."{}" WHERE time >= \'{}\' AND time < \'{}\''.format(
+            retention_policy, measurement, start, end)
+        for p in client.query(query, epoch='ms').get_points():
+            messages.append((p['time'] / 1000.0, topic, p['value']))
+    messages.sort(key=lambda m: m[0])
+
+    with open(path, 'w') as f:
+        f.write('# exported from InfluxDB {} - {}\n'.format(start, end))
+        for ts, topic, value in messages:
+            f.write('{:.3f},{},{}\n'.format(ts, topic, value))
+    return len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded trace through the power regulation')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run')
+    run.add_argument('trace')
+    run.add_argument('--config', default='equipment_config.yml')
+    run.add_argument('--closed-loop', action='store_true')
+    run.add_argument('--frames', action='store_true', help='group the per-label measurements in frames')
+    run.add_argument('--verbose', action='store_true')
+    export = sub.add_parser('export')
+    export.add_argument('trace')
+    export.add_argument('--start', required=True)
+    export.add_argument('--end', required=True)
+    export.add_argument('--config', default='equipment_config.yml')
+    export.add_argument('--retention-policy', default=RAW_RETENTION_POLICY,
+                        help='one_year for the measurements written before the rollups')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        n = export_trace(args.trace, args.start, args.end, args.config, args.retention_policy)
+        print("{} messages written to {}".format(n, args.trace))
+        return
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    replay = Replay(args.config, args.closed_loop)
+    trace = read_trace(args.trace)
+    if args.frames:
+        trace = group_frames(trace)
+    result = replay.run(trace)
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
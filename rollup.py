@@ -0,0 +1,193 @@
+# In-memory rollups of the measurements.
+#
+# The raw measurements are written once per frame (or per evaluation), and the dashboards used to compute the energy
+# per minute over them (difference(first("value")) ... GROUP BY time(1m)), which scans millions of points over a
+# month. The rollups are computed as the measurements arrive, in fixed tiers: 1 minute buckets, merged into 1 hour
+# buckets, each tier written to its own retention policy (rollup_1m, rollup_1h) under the name of the raw measurement.
+# The raw measurements can then be kept for a short time only.
+# - an index (EAST, EAIT..., in Wh) gives the energy of the bucket (sum of the increments of the index, a meter reset
+#   is not counted), the mean power over the bucket and the last index
+# - a power (SINSTS, <equipment>-power...) is held between two samples (for at most `hold` seconds) and gives the mean
+#   and max power and the energy of the bucket, so that the power of an equipment, only sampled at each evaluation,
+#   gives its energy
+# A bucket is written when the first sample of a later bucket arrives, the buckets are aligned on the epoch (UTC).
+
+from measurement_writer import DEFAULT_TAGS, RAW_RETENTION_POLICY
+
+# (period in seconds, retention policy) of the tiers, each tier is built from the buckets of the previous one
+TIERS = ((60, 'rollup_1m'), (3600, 'rollup_1h'))
+
+
+class Bucket:
+    __slots__ = ('start', 'end', 'energy', 'seconds', 'max', 'last', 'samples')
+
+    def __init__(self, start, period):
+        self.start = start
+        self.end = start + period
+        self.energy = 0.0
+        self.seconds = 0.0
+        self.max = None
+        self.last = None
+        self.samples = 0
+
+    def add_max(self, value):
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.energy += other.energy
+        self.seconds += other.seconds
+        if other.max is not None:
+            self.add_max(other.max)
+        if other.last is not None:
+            self.last = other.last
+        self.samples += other.samples
+
+
+class RollupSeries:
+    """ The open buckets of one measurement, a bucket of each tier """
+
+    def __init__(self, key, index, tiers, tags):
+        self.key = key
+        self.index = index
+        self.tiers = tiers
+        self.tags = tags
+        self.buckets = [None] * len(tiers)
+
+    def bucket(self, ts, out):
+        """ Return the bucket of the first tier for ts, the closed buckets are appended to out as points """
+        b = self.buckets[0]
+        if b is not None and ts < b.end:
+            return b
+        if b is not None:
+            self._close(0, b, out)
+        period = self.tiers[0][0]
+        b = self.buckets[0] = Bucket(ts - ts % period, period)
+        return b
+
+    def _close(self, level, b, out):
+        out.append(self._point(level, b))
+        if level + 1 >= len(self.tiers):
+            return
+        upper = self.buckets[level + 1]
+        if upper is not None and b.start >= upper.end:
+            self._close(level + 1, upper, out)
+            upper = None
+        if upper is None:
+            period = self.tiers[level + 1][0]
+            upper = self.buckets[level + 1] = Bucket(b.start - b.start % period, period)
+        upper.merge(b)
+
+    def _point(self, level, b):
+        period, retention_policy = self.tiers[level]
+        if self.index:
+            fields = {'energy': b.energy, 'mean': round(b.energy * 3600 / period, 1), 'last': b.last}
+        else:
+            # the samples may be int or float (an equipment power starts at 0), InfluxDB keeps the type of the first
+            # point of a field and rejects the other one
+            mean = b.energy * 3600 / b.seconds if b.seconds else b.max
+            fields = {'energy': round(b.energy, 3), 'mean': float(round(mean, 1)), 'max': float(b.max)}
+        return {
+            "measurement": self.key,
+            "tags": self.tags,
+            "time": int(b.start * 1000),
+            "fields": fields,
+            "retention_policy": retention_policy,
+        }
+
+    def flush(self, out):
+        """ Close all the open buckets, from the shortest tier """
+        for level, b in enumerate(self.buckets):
+            if b is not None:
+                self.buckets[level] = None
+                self._close(level, b, out)
+
+
+class Rollups:
+    def __init__(self, tiers=TIERS, hold=300.0, tags=DEFAULT_TAGS):
+        self.tiers = tiers
+        self.hold = hold
+        self.tags = tags
+        self._series = {}
+        # last (ts, value) of each series
+        self._last = {}
+
+        # counters
+        self.samples = 0
+        self.points = 0
+        self.resets = 0
+
+    def _get(self, key, index):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = RollupSeries(key, index, self.tiers, self.tags)
+        return series
+
+    def add_index(self, key, ts, value):
+        """ Add a sample of an energy index (Wh), return the points of the buckets it closed """
+        out = []
+        series = self._get(key, True)
+        b = series.bucket(ts, out)
+        last = self._last.get(key)
+        if last is not None:
+            if value >= last[1]:
+                b.energy += value - last[1]
+            else:
+                self.resets += 1
+        b.last = value
+        b.samples += 1
+        self._last[key] = (ts, value)
+        self.samples += 1
+        self.points += len(out)
+        return out
+
+    def add_power(self, key, ts, value):
+        """ Add a sample of a power (W), return the points of the buckets it closed """
+        out = []
+        series = self._get(key, False)
+        last = self._last.get(key)
+        if last is not None and ts > last[0]:
+            # the previous value is held until this sample, split between the buckets it spans
+            t, power = last
+            end = min(ts, t + self.hold)
+            while t < end:
+                b = series.bucket(t, out)
+                segment = min(end, b.end) - t
+                b.add_max(power)
+                b.energy += power * segment / 3600
+                b.seconds += segment
+                t += segment
+        b = series.bucket(ts, out)
+        b.add_max(value)
+        b.samples += 1
+        self._last[key] = (ts, value)
+        self.samples += 1
+        self.points += len(out)
+        return out
+
+    def flush(self):
+        """ Return the points of all the open buckets, to be called before exiting """
+        out = []
+        for series in self._series.values():
+            series.flush(out)
+        self.points += len(out)
+        return out
+
+    def stats(self):
+        return {
+            'series': len(self._series),
+            'samples': self.samples,
+            'points': self.points,
+            'resets': self.resets,
+        }
+
+
+def create_retention_policies(client, database, raw='7d', minute='400d', hour='INF'):
+    """ Create (or update) the retention policies of the raw measurements and of the rollups. The default policy is
+    not changed: it keeps the history written before the upgrade, the points name their policy """
+    for name, duration in ((RAW_RETENTION_POLICY, raw), (TIERS[0][1], minute), (TIERS[1][1], hour)):
+        try:
+            client.create_retention_policy(name, duration, 1, database=database)
+        except Exception:
+            # already there, its duration may have changed
+            client.alter_retention_policy(name, database=database, duration=duration)
@@ -0,0 +1,153 @@
+# Store-and-forward disk spool of InfluxDB points.
+#
+# When InfluxDB is not reachable, the points which could not be written are appended to the spool instead of being
+# dropped, and they are sent again in bulk once the database answers. The spool is a directory of append-only segment
+# files, one JSON batch of points per line:
+# - a new segment is started when the current one reaches segment_size bytes
+# - the total size is capped to max_size bytes: beyond, the oldest segments are deleted (oldest points first)
+# - the segments are drained oldest first, and a segment is deleted once all its batches have been written
+# The spool survives a restart: the segments left by the previous run are drained like the others. A segment
+# interrupted by a restart in the middle of its drain is written again from its start, which is harmless since
+# InfluxDB overwrites a point with the same measurement, tags and timestamp. A truncated last line (power cut while
+# writing) is skipped. A batch which the database rejects (see measurement_writer.is_rejected) is dropped, so that it
+# doesn't block the batches behind it.
+
+import json
+import os
+import threading
+
+from debug import debug as debug
+
+SEGMENT_SUFFIX = '.spool'
+
+
+class DiskSpool:
+    def __init__(self, directory, max_size=100 * 1024 * 1024, segment_size=1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # segments, oldest first: [path, size, points]
+        self._segments = []
+        self._next_id = 0
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(directory, name)
+            points = sum(len(batch) for batch in self._read(path))
+            self._segments.append([path, os.path.getsize(path), points])
+            self._next_id = max(self._next_id, int(name[:-len(SEGMENT_SUFFIX)]) + 1)
+        self._file = None
+        # line of the oldest segment from which the drain resumes
+        self._drain_line = 0
+
+        # counters
+        self.points_spooled = 0
+        self.points_drained = 0
+        self.points_evicted = 0
+        self.points_rejected = 0
+        if self._segments:
+            debug(0, "spool {}: {} points left by the previous run".format(directory, self.pending()))
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    debug(0, "spool: skipping a truncated line of {}".format(path))
+
+    def _close_current(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _new_segment(self):
+        self._close_current()
+        path = os.path.join(self.directory, '{:012d}{}'.format(self._next_id, SEGMENT_SUFFIX))
+        self._next_id += 1
+        self._file = open(path, 'a')
+        self._segments.append([path, 0, 0])
+
+    def _evict(self):
+        while len(self._segments) > 1 and sum(s[1] for s in self._segments) > self.max_size:
+            path, size, points = self._segments.pop(0)
+            os.remove(path)
+            self._drain_line = 0
+            self.points_evicted += points
+            debug(0, "spool full, {} oldest points dropped".format(points))
+
+    def append(self, points):
+        """ Append a batch of points at the end of the spool """
+        if not points:
+            return
+        line = json.dumps(points, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None or self._segments[-1][1] >= self.segment_size:
+                self._new_segment()
+            self._file.write(line)
+            self._file.flush()
+            segment = self._segments[-1]
+            segment[1] += len(line)
+            segment[2] += len(points)
+            self.points_spooled += len(points)
+            self._evict()
+
+    def pending(self):
+        """ Return the number of points waiting in the spool """
+        return sum(s[2] for s in self._segments)
+
+    def drain(self, write, batch_size=5000, rejected=None):
+        """ Write the spooled points oldest first, batch_size points per call of write(points). Stop at the first
+        failure (the exception is raised), the points which could not be written are kept, unless rejected(exception)
+        is true: the batch is then dropped and the drain goes on. Return the number of points written """
+        written = 0
+        with self._lock:
+            while self._segments:
+                segment = self._segments[0]
+                path = segment[0]
+                if self._file is not None and len(self._segments) == 1:
+                    # the segment being appended is closed so that the next points go to a new one
+                    self._close_current()
+                lines = list(self._read(path))
+                start = self._drain_line
+                while start < len(lines):
+                    batch = []
+                    end = start
+                    while end < len(lines) and (not batch or len(batch) + len(lines[end]) <= batch_size):
+                        batch.extend(lines[end])
+                        end += 1
+                    try:
+                        write(batch)
+                    except Exception as e:
+                        if rejected is None or not rejected(e):
+                            raise
+                        self.points_rejected += len(batch)
+                        debug(0, "{} spooled points rejected, dropped: {}".format(len(batch), e))
+                    else:
+                        written += len(batch)
+                        self.points_drained += len(batch)
+                    segment[2] -= len(batch)
+                    start = self._drain_line = end
+                self._segments.pop(0)
+                self._drain_line = 0
+                os.remove(path)
+        return written
+
+    def close(self):
+        with self._lock:
+            self._close_current()
+
+    def stats(self):
+        return {
+            'segments': len(self._segments),
+            'size': sum(s[1] for s in self._segments),
+            'pending': self.pending(),
+            'spooled': self.points_spooled,
+            'drained': self.points_drained,
+            'evicted': self.points_evicted,
+            'rejected': self.points_rejected,
+        }
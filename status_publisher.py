@@ -0,0 +1,144 @@
+# Change-only publication of the regulation status.
+#
+# evaluate() builds a status document every EVALUATION_PERIOD seconds, most of the time almost identical to the
+# previous one. StatusPublisher sends:
+# - a full snapshot, retained, on the status topic when the state of an equipment changes (power beyond the power
+#   tolerance, forced flag) and at least every heartbeat seconds, so that a new subscriber always gets a complete
+#   and recent state
+# - in between, a small delta message on <status topic>/delta with only the values which moved beyond their
+#   tolerance, nothing at all when nothing moved
+# Messages are JSON by default, or MessagePack (compact binary, requires the msgpack package).
+#
+# SeriesFilter applies the same idea to the per-equipment InfluxDB series: a value is only written when it moved
+# beyond its tolerance since the last written one, or when the last write is older than max_interval.
+
+import json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is only required by the binary encoding
+    msgpack = None
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+
+
+def _moved(old, new, tolerance):
+    if old is None or new is None or isinstance(new, (bool, str)) or isinstance(old, (bool, str)):
+        return old != new
+    return abs(new - old) > tolerance
+
+
+class StatusPublisher:
+    def __init__(self, client, topic, heartbeat=60, power_tolerance=10, energy_tolerance=10,
+                 encoding=ENCODING_JSON):
+        if encoding == ENCODING_MSGPACK and msgpack is None:
+            raise ImportError("the msgpack status encoding requires msgpack (pip install msgpack)")
+        self.client = client
+        self.topic = topic
+        self.delta_topic = topic + '/delta'
+        self.heartbeat = heartbeat
+        self.power_tolerance = power_tolerance
+        self.energy_tolerance = energy_tolerance
+        self.encoding = encoding
+
+        # values as of the last snapshot or delta sent
+        self._last_snapshot_ts = None
+        self._powers = {}
+        self._equipments = {}
+
+        # counters
+        self.updates = 0
+        self.snapshots = 0
+        self.deltas = 0
+        self.unchanged = 0
+        self.bytes_sent = 0
+
+    def encode(self, message):
+        if self.encoding == ENCODING_MSGPACK:
+            return msgpack.packb(message, use_bin_type=True)
+        return json.dumps(message, separators=(',', ':'))
+
+    def _send(self, topic, message, retain):
+        payload = self.encode(message)
+        self.bytes_sent += len(payload)
+        self.client.publish(topic, payload, retain=retain)
+
+    def _equipment_changes(self, e):
+        last = self._equipments.get(e['name'])
+        if last is None:
+            return dict(e)
+        changes = {}
+        if _moved(last['current_power'], e['current_power'], self.power_tolerance):
+            changes['current_power'] = e['current_power']
+        if _moved(last['energy'], e['energy'], self.energy_tolerance):
+            changes['energy'] = e['energy']
+        if last['forced'] != e['forced']:
+            changes['forced'] = e['forced']
+        return changes
+
+    def publish(self, status):
+        """ Send a snapshot, a delta or nothing for this status. Return what has been sent """
+        self.updates += 1
+        ts = status['date']
+        changes = {}
+        state_changed = False
+        for e in status['equipments']:
+            c = self._equipment_changes(e)
+            if c:
+                changes[e['name']] = c
+                if 'current_power' in c or 'forced' in c:
+                    state_changed = True
+
+        if state_changed or self._last_snapshot_ts is None or ts - self._last_snapshot_ts >= self.heartbeat:
+            self._send(self.topic, status, True)
+            self._last_snapshot_ts = ts
+            self._powers = {k: status[k] for k in ('power_available', 'power_consumed')}
+            self._equipments = {e['name']: dict(e) for e in status['equipments']}
+            self.snapshots += 1
+            return 'snapshot'
+
+        delta = {}
+        for k in ('power_available', 'power_consumed'):
+            if _moved(self._powers.get(k), status[k], self.power_tolerance):
+                delta[k] = self._powers[k] = status[k]
+        for name, c in changes.items():
+            self._equipments[name].update(c)
+        if changes:
+            delta['equipments'] = changes
+        if not delta:
+            self.unchanged += 1
+            return None
+        delta['date'] = ts
+        self._send(self.delta_topic, delta, False)
+        self.deltas += 1
+        return 'delta'
+
+    def stats(self):
+        return {
+            'updates': self.updates,
+            'snapshots': self.snapshots,
+            'deltas': self.deltas,
+            'unchanged': self.unchanged,
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+class SeriesFilter:
+    def __init__(self, max_interval=300):
+        self.max_interval = max_interval
+        self._last = {}
+
+        # counters
+        self.written = 0
+        self.skipped = 0
+
+    def changed(self, key, value, ts, tolerance=0):
+        """ Return True if the value must be written, and remember it as the last written one """
+        last = self._last.get(key)
+        if last is not None and not _moved(last[0], value, tolerance) and ts - last[1] < self.max_interval:
+            self.skipped += 1
+            return False
+        self._last[key] = (value, ts)
+        self.written += 1
+        return True
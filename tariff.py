@@ -0,0 +1,105 @@
+# Tariff calendar: off-peak hours ("heures creuses").
+# The off-peak windows are given as local times, possibly several per day, with distinct windows for the weekend
+# and for holidays. The calendar converts them once to absolute timestamps (taking DST changes into account) and keeps
+# the current state with the timestamp of the next transition, so that "is it off-peak now?" is a single float
+# comparison until that transition.
+#
+# Windows are written "HH:MM-HH:MM", separated by commas, for instance "01:30-07:30,12:00-14:00". A window ending before
+# it starts crosses midnight ("22:00-06:00"), "24:00" stands for the end of the day.
+
+from datetime import date, datetime, timedelta
+
+import pytz
+
+
+def parse_windows(text):
+    """ Return a list of (start, end) in minutes since midnight from a "HH:MM-HH:MM,..." string """
+    windows = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        start, end = item.split('-')
+        windows.append((_minutes(start), _minutes(end)))
+    return windows
+
+
+def _minutes(hhmm):
+    h, m = hhmm.strip().split(':')
+    minutes = int(h) * 60 + int(m)
+    if not 0 <= minutes <= 24 * 60:
+        raise ValueError("invalid time {!r}".format(hhmm))
+    return minutes
+
+
+def parse_dates(text):
+    return {date.fromisoformat(d.strip()) for d in text.split(',') if d.strip()}
+
+
+class TariffCalendar:
+    def __init__(self, windows, weekend_windows=None, holiday_windows=None, holidays=(), timezone='Europe/Paris'):
+        self.tz = pytz.timezone(timezone)
+        self.windows = windows
+        self.weekend_windows = windows if weekend_windows is None else weekend_windows
+        self.holiday_windows = self.weekend_windows if holiday_windows is None else holiday_windows
+        self.holidays = set(holidays)
+
+        self._valid_from = None
+        self._next_transition = None
+        self._state = False
+
+    def windows_for(self, day):
+        if day in self.holidays:
+            return self.holiday_windows
+        if day.weekday() >= 5:
+            return self.weekend_windows
+        return self.windows
+
+    def _timestamp(self, day, minutes):
+        local = datetime(day.year, day.month, day.day) + timedelta(minutes=minutes)
+        # non existent local times (spring DST change) are shifted forward, ambiguous ones use the winter time
+        return self.tz.normalize(self.tz.localize(local, is_dst=False)).timestamp()
+
+    def _compute(self, ts):
+        day = datetime.fromtimestamp(ts, self.tz).date()
+        intervals = []
+        for offset in (-1, 0, 1):
+            d = day + timedelta(days=offset)
+            for start, end in self.windows_for(d):
+                end_day = d + timedelta(days=1) if end <= start else d
+                intervals.append((self._timestamp(d, start), self._timestamp(end_day, end)))
+        intervals.sort()
+
+        # merge overlapping or contiguous windows
+        merged = []
+        for s, e in intervals:
+            if merged and s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s, e])
+
+        # beyond the next day the windows are not known yet, recompute there at the latest
+        horizon = self._timestamp(day + timedelta(days=2), 0)
+        state = False
+        next_transition = horizon
+        for s, e in merged:
+            if s <= ts < e:
+                state = True
+                next_transition = min(e, horizon)
+                break
+            if ts < s:
+                next_transition = s
+                break
+        self._valid_from = ts
+        self._next_transition = next_transition
+        self._state = state
+
+    def is_off_peak(self, ts):
+        if self._next_transition is None or not self._valid_from <= ts < self._next_transition:
+            self._compute(ts)
+        return self._state
+
+    def next_transition(self, ts):
+        """ Return the timestamp at which the off-peak state changes after ts """
+        self.is_off_peak(ts)
+        return self._next_transition
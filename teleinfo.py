@@ -22,13 +22,20 @@
 # }
 
 import paho.mqtt.client as mqtt
+import json
 import logging
 import time
-from datetime import datetime
+from collections import deque
 import serial
 from influxdb import InfluxDBClient
 import config
 import os
+from index_estimator import IndexPowerEstimator
+from measurement_writer import is_rejected, make_point, split_by_retention
+from rollup import Rollups, create_retention_policies
+from spool import DiskSpool
+from status_publisher import SeriesFilter
+from tic_parser import TicFrameAssembler, MODE_HISTORIC, MODE_STANDARD, SLOW_LABELS
 
 
 def on_connect(client, userdata, flags, rc):
@@ -53,29 +60,26 @@ client = InfluxDBClient(config.INFLUXDB_HOST, config.INFLUXDB_PORT,
                        config.INFLUXDB_USERNAME, config.INFLUXDB_PASSWORD)
 DB_NAME = config.INFLUXDB_DATABASE
 connected = False
-while not connected:
-    try:
-        logging.info("Database %s exists?", DB_NAME)
-        if {'name': DB_NAME} not in client.get_list_database():
-            logging.info("Database %s creation..", DB_NAME)
-            client.create_database(DB_NAME)
-            logging.info("Database %s created!", DB_NAME)
-
-        client.switch_database(DB_NAME)
-        
-        # Set retention policy to 1 year
-        try:
-            client.create_retention_policy('one_year', '365d', 1, database=DB_NAME, default=True)
-            logging.info("Retention policy set to 1 year")
-        except Exception as e:
-            logging.info("Retention policy already exists or error: %s", e)
-        
-        logging.info("Connected to %s!", DB_NAME)
-        connected = True 
 
-    except Exception:
-        logging.error("InfluxDB is not reachable. Waiting 5 seconds to retry...", exc_info=True)
-        time.sleep(5)
+
+def connect_database():
+    # one attempt, done before the first write: the frames are read (and spooled) while InfluxDB is not reachable
+    global connected
+    logging.info("Database %s exists?", DB_NAME)
+    if {'name': DB_NAME} not in client.get_list_database():
+        logging.info("Database %s creation..", DB_NAME)
+        client.create_database(DB_NAME)
+        logging.info("Database %s created!", DB_NAME)
+
+    client.switch_database(DB_NAME)
+
+    # mesures brutes sur une courte durée, agrégats à la minute et à l'heure (rollup.py)
+    create_retention_policies(client, DB_NAME, config.INFLUXDB_RAW_RETENTION, config.INFLUXDB_ROLLUP_MINUTE_RETENTION,
+                              config.INFLUXDB_ROLLUP_HOUR_RETENTION)
+    logging.info("Retention policies set, raw measurements kept %s", config.INFLUXDB_RAW_RETENTION)
+
+    logging.info("Connected to %s!", DB_NAME)
+    connected = True
 
 #connection au broker mqtt
 try:
@@ -87,109 +91,185 @@ except:
   logging.info('PB connecting to MQTT Server.')
 
 
+# points of the frame being read, by measurement, they all share the frame timestamp
+frame_points = {}
+# valeurs de la trame en cours, toutes les étiquettes, écrites ou non
+frame_measures = {}
+# étiquettes statiques ou lentes (SLOW_LABELS) : écrites seulement quand leur valeur change, ou toutes les
+# TELEINFO_HEARTBEAT secondes
+label_cache = SeriesFilter(config.TELEINFO_HEARTBEAT)
+# date (time.time()) of the next log of the counters of the cache
+stats_at = 0
+# étiquettes publiées sur MQTT, dans un seul message tic/frame par trame et/ou un message par étiquette (TIC_TOPICS)
+PUBLISHED_KEYS = ("EASF01", "EASF02", "EAIT", "SINSTI", "SINSTS", "EAST", "ERQT")
+PUBLISH_FRAME = config.TIC_TOPICS in ('frame', 'both')
+PUBLISH_LABELS = config.TIC_TOPICS in ('labels', 'both')
+frame_values = {}
+# agrégats à la minute et à l'heure des index et des puissances, écrits avec la trame qui clôt leur intervalle
+POWER_KEYS = ("SINSTI", "SINSTS", "PAPP", "IINST", "IRMS1", "URMS1")
+rollups = Rollups()
+rollup_points = []
+# frames which could not be written are stored in the disk spool and sent in bulk once InfluxDB is back, or kept in
+# memory without spool; a frame rejected by InfluxDB (4xx, see measurement_writer.is_rejected) is dropped
+spool = DiskSpool(os.path.join(config.SPOOL_DIR, 'teleinfo'), max_size=config.SPOOL_MAX_SIZE * 1024 * 1024,
+                  segment_size=config.SPOOL_SEGMENT_SIZE * 1024) if config.SPOOL_DIR else None
+pending_frames = deque(maxlen=config.TELEINFO_MAX_PENDING_FRAMES)
+# no write is attempted before this time (time.monotonic()) after a failure, the frames go straight to the spool
+retry_at = 0
+
+
 def add_measures(key,val, time_measure):
-    points = []
     if str(val).isnumeric():
        try:
         val = int(val)
        except:
         val = float(val)
-       if key in ("EASF01","EASF02","EAIT","SINSTI","SINSTS","EAST","ERQT"):
-          mqtt_client.publish("tic/{}".format(key),val)
-    if key != "ADCO":
-        point = {
-            "measurement": key,
-            "tags": {
-                # identification de la sonde et du compteur
-                "host": "raspberry",
-                "region": "linky"
-            },
-            "time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "fields": {
-                "value": val
-            }
-        }
-        #print(point)
-        points.append(point)
-        client.write_points(points)
-
-def verif_checksum(data, checksum):
-    data_unicode = 0
-    for caractere in data:
-        data_unicode += ord(caractere)
-    sum_unicode = (data_unicode & 63) +  32
-    verif = chr(sum_unicode)
-    logging.debug("{} - {} - {}".format(data,ord(checksum),sum_unicode))
-    return (checksum == chr(sum_unicode))
+       if key in PUBLISHED_KEYS:
+          frame_values[key] = val
+          if PUBLISH_LABELS:
+             mqtt_client.publish("tic/{}".format(key),val)
+    frame_measures[key] = val
+    if key != "ADCO" and (key not in SLOW_LABELS or label_cache.changed(key, val, time_measure)):
+        frame_points[key] = make_point(key, val, time_measure)
+
+
+def write_points(points):
+    if not connected:
+        connect_database()
+    for retention_policy, group in split_by_retention(points):
+        client.write_points(group, time_precision='ms', retention_policy=retention_policy)
+
+
+def write_frame():
+    # one request per frame; frames which could not be written are retried first, oldest first
+    global retry_at
+    if frame_points:
+        points = list(frame_points.values()) + rollup_points
+        frame_points.clear()
+        rollup_points.clear()
+        if spool is not None and time.monotonic() < retry_at:
+            spool.append(points)
+            return False
+        if len(pending_frames) == pending_frames.maxlen:
+            logging.error("Too many frames waiting to be written, dropping the oldest one")
+        pending_frames.append(points)
+    while pending_frames:
+        try:
+            write_points(pending_frames[0])
+        except Exception as e:
+            if is_rejected(e):
+                # la trame serait refusée à nouveau et bloquerait les suivantes
+                logging.error("Frame rejected by InfluxDB, dropped: %s", e)
+                pending_frames.popleft()
+                continue
+            if spool is None:
+                logging.error("Unable to write frame, %d frame(s) kept for retry: %s", len(pending_frames), e)
+                return False
+            logging.error("Unable to write frame, spooled, next try in %ss: %s", config.SPOOL_RETRY_INTERVAL, e)
+            while pending_frames:
+                spool.append(pending_frames.popleft())
+            retry_at = time.monotonic() + config.SPOOL_RETRY_INTERVAL
+            return False
+        pending_frames.popleft()
+    if spool is not None and spool.pending():
+        try:
+            logging.info("%d spooled points written", spool.drain(write_points, rejected=is_rejected))
+        except Exception as e:
+            logging.error("Unable to drain the spool, next try in %ss: %s", config.SPOOL_RETRY_INTERVAL, e)
+            retry_at = time.monotonic() + config.SPOOL_RETRY_INTERVAL
+            return False
+    return True
+
+
+ERQ_KEYS = ("ERQ1", "ERQ2", "ERQ3", "ERQ4")
+# index d'énergie (Wh ou VArh) dont la puissance est dérivée, écrite en <index>_power
+INDEX_KEYS = ("EAST", "EASF01", "EASF02", "EAIT", "ERQ1", "ERQ2", "ERQ3", "ERQ4", "ERQT", "BASE", "HCHC", "HCHP")
+index_estimators = {k: IndexPowerEstimator(config.INDEX_POWER_WINDOW) for k in INDEX_KEYS}
+
+
+def add_index_powers(time_measure):
+    for key, estimator in index_estimators.items():
+        val = frame_measures.get(key)
+        if not isinstance(val, int):
+            continue
+        rollup_points.extend(rollups.add_index(key, time_measure, val))
+        power = estimator.add(time_measure, val)
+        if power is not None:
+            frame_points[key + "_power"] = make_point(key + "_power", round(power), time_measure)
+
+
+def publish_frame(time_measure):
+    # un seul message par trame valide, la régulation évalue une fois sur des valeurs de la même trame
+    if frame_values:
+        if PUBLISH_FRAME:
+            frame_values["ts"] = round(time_measure, 3)
+            mqtt_client.publish("tic/frame", json.dumps(frame_values, separators=(',', ':')))
+        frame_values.clear()
+
+
+def log_stats(time_measure):
+    global stats_at
+    if time_measure >= stats_at:
+        if stats_at:
+            logging.info("static labels: %d points written, %d suppressed", label_cache.written, label_cache.skipped)
+        stats_at = time_measure + 3600
+
+
+def process_frame(frame, time_measure):
+    frame_measures.clear()
+    for key, val in frame.items():
+        add_measures(key, val, time_measure)
+    # énergie réactive totale, calculée une fois par trame avec les 4 index de la même trame
+    if all(k in frame for k in ERQ_KEYS):
+        try:
+            ERQ = sum(int(frame[k]) for k in ERQ_KEYS)
+        except ValueError:
+            logging.info("invalid ERQ values %s", [frame[k] for k in ERQ_KEYS])
+        else:
+            add_measures("ERQT", ERQ, time_measure)
+    add_index_powers(time_measure)
+    for key in POWER_KEYS:
+        val = frame_measures.get(key)
+        if isinstance(val, int):
+            rollup_points.extend(rollups.add_power(key, time_measure, val))
+    publish_frame(time_measure)
+    log_stats(time_measure)
+    # insertion de la trame complète dans influxdb en une seule requête
+    write_frame()
 
 
 def main():
-   with serial.Serial(port='/dev/ttyAMA0', baudrate=9600, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE,
+   baudrate = 1200 if config.TIC_MODE == MODE_HISTORIC else 9600
+   mode = config.TIC_MODE if config.TIC_MODE in (MODE_HISTORIC, MODE_STANDARD) else None
+   with serial.Serial(port='/dev/ttyAMA0', baudrate=baudrate, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE,
                        bytesize=serial.SEVENBITS, timeout=1) as ser:
+      assembler = TicFrameAssembler(mode)
       try:
         logging.info("Teleinfo is reading on /dev/ttyAMA0..")
-        # boucle pour partir sur un début de trame
-        line = ser.readline()
-        while b'\x02' not in line:  # recherche du caractère de début de trame
-            line = ser.readline()
-
-        # lecture de la première ligne de la première trame
-        line = ser.readline()
-
+        # les trames incomplètes d'une précédente lecture sont ignorées, l'assembleur se cale sur le prochain STX
+        frame_points.clear()
         while True:
-            key = val = "<undef>"  # valeurs par défaut pour éviter crash dans except
-
-            line_str = line.decode("utf-8")
-            logging.debug(line)
-            # separation sur espace /!\ attention le caractere de controle 0x32 est un espace aussi
-            logging.debug(line_str)
-            arr=line_str.split("\t")
-            if len(arr) < 2:
-               raise ValueError(f"Trame incomplète: {line_str!r}")
-            rest_ind=len(arr)-1
-            key=arr[0]
-            rest=arr[rest_ind]
-            val=line_str[0:len(line_str)-len(rest)-1][len(key)+1:]
-            #[key, val, rest] = line_str.split("\t")
-            # supprimer les retours charriot et saut de ligne puis selectionne le caractere
-            # de controle en partant de la fin
-            checksum = (rest.replace('\x03\x02', '')).replace("\r\n","")
-            #checksum = rest
-            if verif_checksum(f"{key}\t{val}\t", checksum):
-            # creation du champ pour la trame en cours avec cast des valeurs de mesure en "integer"
-               time_measure = time.time()
-               # insertion dans influxdb
-               add_measures(key, val, time_measure)
-               if key=="ERQ1":
-                   print("ERQ1:"+val)
-                   ERQ1val=int(val)
-               if key=="ERQ2":
-                   ERQ2val=int(val)
-               if key=="ERQ3":
-                   ERQ3val=int(val)
-               if key=="ERQ4":
-                   ERQ4val=int(val)
-               if "ERQ" in key:
-                   ERQ=ERQ1val+ERQ2val+ERQ3val+ERQ4val
-                   add_measures("ERQT", ERQ, time_measure)
-
-            else:
-               logging.info("checksum invalid {} : {}".format(key,val))
-            line = ser.readline()
+            # lecture de tout ce qui est disponible (au moins un octet, bloquant jusqu'au timeout)
+            data = ser.read(max(1, ser.in_waiting))
+            if not data:
+                continue
+            checksum_errors = assembler.checksum_errors
+            for frame in assembler.feed(data):
+                process_frame(frame, time.time())
+            if assembler.checksum_errors != checksum_errors:
+                logging.info("checksum invalid, %d error(s) since start", assembler.checksum_errors)
 
       except Exception as e:
             logging.error("Exception : %s" % e, exc_info=True)
-            logging.error("%s %s" % (key, val))
-     
- 
+            logging.error("%s" % assembler.stats())
+
 
 if __name__ == '__main__':
-    if connected:
-       print('entering main program')
-       while True:
-         try:
-           main()
-         except Exception as e:
-           logging.error("Exception : %s" % e)
-           time.sleep(15)
+    print('entering main program')
+    while True:
+        try:
+          main()
+        except Exception as e:
+          logging.error("Exception : %s" % e)
+          time.sleep(15)
 
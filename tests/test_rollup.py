@@ -0,0 +1,40 @@
+# Field types of the rollup points: InfluxDB 1.x keeps the type of the first point written to a field and rejects
+# the points of another type ("field type conflict").
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from influxdb.line_protocol import make_lines  # noqa: E402
+
+from rollup import Rollups  # noqa: E402
+
+START = 1717200000  # 2024-06-01 00:00 UTC
+
+
+def field_types(point):
+    """ Return {field: 'int' or 'float'} of the line protocol of point """
+    line = make_lines({'points': [point]})
+    fields = line.split(' ')[1].split(',')
+    return {f.split('=')[0]: 'int' if f.endswith('i') else 'float' for f in fields}
+
+
+def test_power_field_types_stay_float():
+    # an equipment power starts at int 0 and becomes a float once it is increased
+    rollups = Rollups(tiers=((60, 'rollup_1m'),))
+    points = rollups.add_power('water_heater-power', START, 0)
+    points += rollups.add_power('water_heater-power', START + 60, 812.5)
+    points += rollups.add_power('water_heater-power', START + 120, 0)
+    points += rollups.flush()
+    types = [field_types(p) for p in points]
+    assert len(types) == 3
+    assert all(t == {'energy': 'float', 'mean': 'float', 'max': 'float'} for t in types)
+
+
+def test_power_field_types_without_held_seconds():
+    # a single int sample in a bucket gives its mean from the max
+    rollups = Rollups(tiers=((60, 'rollup_1m'),))
+    rollups.add_power('power_reactive', START, 0)
+    (point,) = rollups.flush()
+    assert field_types(point) == {'energy': 'float', 'mean': 'float', 'max': 'float'}
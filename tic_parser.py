@@ -0,0 +1,141 @@
+# Streaming parser for the TIC (Télé-Information Client) output of French electricity meters.
+#
+# A TIC frame starts with STX (0x02) and ends with ETX (0x03). It contains groups, each one starts with LF (0x0A) and
+# ends with CR (0x0D):
+# - historic mode (1200 bauds):  LABEL SP VALUE SP CHECKSUM, the checksum covers LABEL SP VALUE
+# - standard mode (9600 bauds):  LABEL HT [DATE HT] VALUE HT CHECKSUM, the checksum covers everything up to the last HT
+# In both cases the checksum is (sum of the bytes & 0x3F) + 0x20.
+#
+# TicFrameAssembler accepts raw bytes in chunks of any size (typically everything available on the serial port) and
+# returns complete frames as {label: value} dicts. Groups are located by precompiled regular expressions and checked
+# directly in the receive buffer, only the label and value of valid groups are decoded to strings.
+
+import re
+
+STX = 0x02
+ETX = 0x03
+EOT = 0x04
+HT = 0x09
+LF = 0x0A
+CR = 0x0D
+SP = 0x20
+
+MODE_HISTORIC = 'historic'
+MODE_STANDARD = 'standard'
+
+# Labels which rarely change (identifiers, contract, status words, relays, daily maximums, 10 and 30 minutes averages)
+# or only once per Wh (energy indexes)
+SLOW_LABELS = frozenset((
+    "ADCO", "ADSC", "PRM", "VTIC", "DATE", "NGTF", "LTARF", "NTARF", "ISOUSC", "PREF", "PCOUP", "OPTARIF", "HHPHC",
+    "PTEC", "IMAX", "MOTDETAT", "STGE", "RELAIS", "NJOURF", "NJOURF+1", "PJOURF+1", "PPOINTE", "MSG1", "MSG2", "DPM1",
+    "FPM1", "DPM2", "FPM2", "DPM3", "FPM3",
+    "SMAXSN", "SMAXSN1", "SMAXSN2", "SMAXSN3", "SMAXSN-1", "SMAXSN1-1", "SMAXSN2-1", "SMAXSN3-1", "SMAXIN", "SMAXIN-1",
+    "CCASN", "CCASN-1", "CCAIN", "CCAIN-1", "UMOY1", "UMOY2", "UMOY3",
+    "BASE", "HCHC", "HCHP", "EAST", "EASF01", "EASF02", "EASF03", "EASF04", "EASF05", "EASF06", "EASF07", "EASF08",
+    "EASF09", "EASF10", "EASD01", "EASD02", "EASD03", "EASD04", "EAIT", "ERQ1", "ERQ2", "ERQ3", "ERQ4", "ERQT",
+))
+
+HT_BYTE = b'\t'
+
+# LABEL HT [DATE HT] VALUE HT CHECKSUM CR, the checksum is never a HT, CR or LF
+STANDARD_GROUP = re.compile(rb'\n([^\t\r\n]+)\t([^\r\n]*)\t([\x20-\x5f])\r')
+# LABEL SP VALUE SP CHECKSUM CR, the checksum can be a SP
+HISTORIC_GROUP = re.compile(rb'\n([^ \r\n]+) ([^\r\n]*) ([\x20-\x5f])\r')
+
+# above this size without any end of frame, the buffer is considered garbage and discarded
+MAX_FRAME_SIZE = 4096
+
+
+def checksum(data):
+    """ Return the TIC checksum byte of the given bytes-like object """
+    return (sum(data) & 0x3F) + 0x20
+
+
+class TicFrameAssembler:
+    def __init__(self, mode=None):
+        # mode is MODE_HISTORIC, MODE_STANDARD, or None to detect it on each frame
+        self.mode = mode
+        self._buf = bytearray()
+
+        # counters
+        self.bytes = 0
+        self.frames = 0
+        self.groups = 0
+        self.checksum_errors = 0
+        self.invalid_groups = 0
+        self.aborted_frames = 0
+
+    def feed(self, data):
+        """ Consume raw bytes and return the list of frames completed by them """
+        self.bytes += len(data)
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(STX, pos)
+            if start < 0:
+                # no frame start yet, everything before is garbage
+                pos = len(buf)
+                break
+            end = buf.find(ETX, start + 1)
+            if end < 0:
+                pos = start
+                if len(buf) - start > MAX_FRAME_SIZE:
+                    self.aborted_frames += 1
+                    pos = len(buf)
+                break
+            if buf.find(EOT, start + 1, end) >= 0:
+                # the meter interrupted the frame
+                self.aborted_frames += 1
+            else:
+                frames.append(self._parse_frame(buf, start + 1, end))
+                self.frames += 1
+            pos = end + 1
+        if pos:
+            del buf[:pos]
+        return frames
+
+    def _parse_frame(self, buf, start, end):
+        frame = {}
+        mode = self.mode
+        if mode is None:
+            mode = MODE_STANDARD if buf.find(HT, start, end) >= 0 else MODE_HISTORIC
+        groups = buf.count(LF, start, end)
+        parsed = 0
+        with memoryview(buf) as mv:
+            if mode == MODE_STANDARD:
+                for m in STANDARD_GROUP.finditer(buf, start, end):
+                    parsed += 1
+                    # the checksum covers label, optional date, value and the separator following the value
+                    end_checked = m.start(3)
+                    if checksum(mv[m.start(1):end_checked]) != buf[end_checked]:
+                        self.checksum_errors += 1
+                        continue
+                    label, value, _ = m.groups()
+                    if HT_BYTE in value:
+                        # horodatage: keep the value, or the date when there is no value (DATE label for instance)
+                        date, value = value.split(HT_BYTE, 1)
+                        if not value:
+                            value = date
+                    frame[label.decode('ascii')] = value.decode('ascii')
+            else:
+                for m in HISTORIC_GROUP.finditer(buf, start, end):
+                    parsed += 1
+                    if checksum(mv[m.start(1):m.end(2)]) != buf[m.start(3)]:
+                        self.checksum_errors += 1
+                        continue
+                    frame[m.group(1).decode('ascii')] = m.group(2).decode('ascii')
+        self.groups += groups
+        self.invalid_groups += groups - parsed
+        return frame
+
+    def stats(self):
+        return {
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'groups': self.groups,
+            'checksum_errors': self.checksum_errors,
+            'invalid_groups': self.invalid_groups,
+            'aborted_frames': self.aborted_frames,
+        }
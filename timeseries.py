@@ -0,0 +1,298 @@
+# In-memory store of the recent measurements.
+#
+# The regulation only keeps the latest value of each measurement, anything which needs the recent history (smoothing,
+# forecasting, a quick look at the last hours) had to query InfluxDB. TimeSeriesStore keeps the last `duration`
+# seconds of a few series in memory, each one in a fixed size ring buffer of two arrays of doubles (timestamps and
+# values, 16 bytes per sample, doubles keep the energy indexes exact):
+# - append is O(1) and never allocates, the oldest sample is overwritten once the buffer is full
+# - samples closer than `resolution` seconds to the previous one replace it, so that the buffer always covers at
+#   least `duration` seconds whatever the measurement rate
+# - the samples of a window are located by bisection on the timestamps, and the aggregates (mean, min, max, last,
+#   count) are computed on a numpy view of the values, without any copy (on array slices by the builtins when numpy
+#   is not installed)
+# - past the `recent` seconds, the samples leaving the ring are downsampled into buckets of `coarse_resolution`
+#   seconds (sum, min, max, count), so that a long history doesn't take one sample per second per series: a window
+#   reaching past the recent samples is aggregated from the buckets for its older part, its start being rounded up
+#   to the next bucket
+# With the defaults (24 h, the last hour at 1 s and 1 minute buckets beyond), a series takes about 115 kB instead of
+# 1.4 MB at 1 s over the whole 24 h.
+
+import threading
+from array import array
+from bisect import bisect_left
+
+import clock
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - numpy is optional, the builtins are used instead
+    numpy = None
+
+AGGREGATES = ('mean', 'min', 'max', 'last', 'count')
+
+
+class RingSeries:
+    __slots__ = ('capacity', 'resolution', '_ts', '_values', '_view', '_next', '_count')
+
+    def __init__(self, capacity, resolution=0.0):
+        self.capacity = capacity
+        self.resolution = resolution
+        self._ts = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        # the arrays are never resized, the view shares their memory
+        self._view = numpy.frombuffer(self._values, dtype=numpy.float64) if numpy is not None else None
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, ts):
+        """ Add a sample, return the (timestamp, value) of the sample it overwrote once the buffer is full """
+        if self._count:
+            last = self._next - 1
+            if ts - self._ts[last] < self.resolution:
+                self._values[last] = value
+                return None
+        i = self._next
+        evicted = (self._ts[i], self._values[i]) if self._count == self.capacity else None
+        self._ts[i] = ts
+        self._values[i] = value
+        self._next = 0 if i + 1 == self.capacity else i + 1
+        if self._count < self.capacity:
+            self._count += 1
+        return evicted
+
+    def _slices(self, since):
+        """ Return the (start, end) index ranges of the samples not older than since, oldest first """
+        return _ring_slices(self._ts, self._count, self.capacity, self._next, since)
+
+    def window(self, since):
+        """ Return (timestamps, values) of the samples not older than since, oldest first """
+        ts = array('d')
+        values = array('d')
+        for start, end in self._slices(since):
+            ts.extend(self._ts[start:end])
+            values.extend(self._values[start:end])
+        return ts, values
+
+    def aggregate(self, since, how='mean'):
+        """ Return the aggregate of the samples not older than since, None when there is none """
+        slices = self._slices(since)
+        count = sum(end - start for start, end in slices)
+        if how == 'count':
+            return count
+        if not slices:
+            return None
+        if how == 'last':
+            return self._values[slices[-1][1] - 1]
+        if self._view is not None:
+            parts = [self._view[start:end] for start, end in slices]
+            if how == 'min':
+                return float(min(p.min() for p in parts))
+            if how == 'max':
+                return float(max(p.max() for p in parts))
+            if how == 'mean':
+                return float(sum(p.sum() for p in parts)) / count
+        else:
+            parts = [self._values[start:end] for start, end in slices]
+            if how == 'min':
+                return min(min(p) for p in parts)
+            if how == 'max':
+                return max(max(p) for p in parts)
+            if how == 'mean':
+                return sum(sum(p) for p in parts) / count
+        raise ValueError("unknown aggregate {!r}".format(how))
+
+
+def _ring_slices(ts, count, capacity, next_, since):
+    if count < capacity:
+        ranges = ((0, count),)
+    else:
+        ranges = ((next_, capacity), (0, next_))
+    slices = []
+    for lo, hi in ranges:
+        if lo == hi:
+            continue
+        start = bisect_left(ts, since, lo, hi)
+        if start < hi:
+            slices.append((start, hi))
+    return slices
+
+
+class BucketSeries:
+    """ Ring of buckets of `period` seconds (start, sum, min, max, count of the samples), oldest overwritten first """
+    __slots__ = ('capacity', 'period', '_start', '_sum', '_min', '_max', '_count', '_next', '_len')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self._start = array('d', bytes(8 * capacity))
+        self._sum = array('d', bytes(8 * capacity))
+        self._min = array('d', bytes(8 * capacity))
+        self._max = array('d', bytes(8 * capacity))
+        self._count = array('d', bytes(8 * capacity))
+        self._next = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, value, ts):
+        start = ts - ts % self.period
+        if self._len:
+            last = self._next - 1
+            if self._start[last] == start:
+                self._sum[last] += value
+                self._count[last] += 1
+                if value < self._min[last]:
+                    self._min[last] = value
+                if value > self._max[last]:
+                    self._max[last] = value
+                return
+        i = self._next
+        self._start[i] = start
+        self._sum[i] = value
+        self._min[i] = value
+        self._max[i] = value
+        self._count[i] = 1
+        self._next = 0 if i + 1 == self.capacity else i + 1
+        if self._len < self.capacity:
+            self._len += 1
+
+    def aggregate(self, since):
+        """ Return (sum, min, max, count, last mean) of the buckets starting at since or later, None if there is none """
+        slices = _ring_slices(self._start, self._len, self.capacity, self._next, since)
+        if not slices:
+            return None
+        total = sum(sum(self._sum[start:end]) for start, end in slices)
+        count = sum(sum(self._count[start:end]) for start, end in slices)
+        low = min(min(self._min[start:end]) for start, end in slices)
+        high = max(max(self._max[start:end]) for start, end in slices)
+        last = slices[-1][1] - 1
+        return total, low, high, int(count), self._sum[last] / self._count[last]
+
+    def window(self, since):
+        """ Return (bucket starts, bucket means) of the buckets starting at since or later """
+        ts = array('d')
+        values = array('d')
+        for start, end in _ring_slices(self._start, self._len, self.capacity, self._next, since):
+            ts.extend(self._start[start:end])
+            values.extend(s / c for s, c in zip(self._sum[start:end], self._count[start:end]))
+        return ts, values
+
+
+class TieredSeries:
+    """ The recent samples of a series in a RingSeries, the older ones downsampled in a BucketSeries """
+    __slots__ = ('recent', 'buckets')
+
+    def __init__(self, capacity, resolution, bucket_capacity, period):
+        self.recent = RingSeries(capacity, resolution)
+        self.buckets = BucketSeries(bucket_capacity, period)
+
+    def __len__(self):
+        return len(self.recent) + len(self.buckets)
+
+    def append(self, value, ts):
+        evicted = self.recent.append(value, ts)
+        if evicted is not None:
+            self.buckets.add(evicted[1], evicted[0])
+
+    def window(self, since):
+        ts, values = self.buckets.window(since)
+        recent_ts, recent_values = self.recent.window(since)
+        ts.extend(recent_ts)
+        values.extend(recent_values)
+        return ts, values
+
+    def aggregate(self, since, how='mean'):
+        older = self.buckets.aggregate(since)
+        if older is None:
+            return self.recent.aggregate(since, how)
+        total, low, high, count, last = older
+        recent_count = self.recent.aggregate(since, 'count')
+        if how == 'count':
+            return count + recent_count
+        if how == 'last':
+            return self.recent.aggregate(since, 'last') if recent_count else last
+        if how == 'mean':
+            if recent_count:
+                total += self.recent.aggregate(since, 'mean') * recent_count
+            return total / (count + recent_count)
+        if how == 'min':
+            return low if not recent_count else min(low, self.recent.aggregate(since, 'min'))
+        if how == 'max':
+            return high if not recent_count else max(high, self.recent.aggregate(since, 'max'))
+        raise ValueError("unknown aggregate {!r}".format(how))
+
+
+class TimeSeriesStore:
+    def __init__(self, duration=86400, resolution=1.0, recent=None, coarse_resolution=60.0):
+        """ Keep duration seconds of each series, the last `recent` ones (all of them when None) at resolution
+        and the older ones in buckets of coarse_resolution seconds """
+        self.duration = duration
+        self.resolution = resolution
+        if recent is None or recent >= duration:
+            recent = duration
+        self.recent = recent
+        self.coarse_resolution = coarse_resolution
+        self.capacity = int(recent / resolution) if resolution > 0 else int(recent)
+        # one more bucket for the one being filled
+        self.bucket_capacity = int((duration - recent) / coarse_resolution) + 1 if recent < duration else 0
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._series
+
+    def keys(self):
+        return sorted(self._series)
+
+    def append(self, key, value, ts=None):
+        if ts is None:
+            ts = clock.now()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                if self.bucket_capacity:
+                    series = TieredSeries(self.capacity, self.resolution, self.bucket_capacity,
+                                          self.coarse_resolution)
+                else:
+                    series = RingSeries(self.capacity, self.resolution)
+                self._series[key] = series
+            series.append(value, ts)
+
+    def window(self, key, seconds, now=None):
+        """ Return (timestamps, values) of the last seconds of a series """
+        if now is None:
+            now = clock.now()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return array('d'), array('d')
+            return series.window(now - seconds)
+
+    def query(self, key, seconds, how='mean', now=None):
+        """ Return the aggregate (mean, min, max, last or count) of the last seconds of a series, None when there is
+        no sample """
+        if how not in AGGREGATES:
+            raise ValueError("unknown aggregate {!r}".format(how))
+        if now is None:
+            now = clock.now()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return 0 if how == 'count' else None
+            return series.aggregate(now - seconds, how)
+
+    def summary(self, key, seconds, now=None):
+        """ Return every aggregate of the last seconds of a series in a dict """
+        return {how: self.query(key, seconds, how, now) for how in AGGREGATES}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'series': len(self._series),
+                'samples': sum(len(s) for s in self._series.values()),
+                'bytes': len(self._series) * (self.capacity * 16 + self.bucket_capacity * 40),
+            }